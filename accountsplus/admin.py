@@ -9,8 +9,13 @@ import django.contrib.admin
 import django.contrib.admin.helpers
 import django.contrib.admin.options
 import django.contrib.admin.models
+import django.contrib.admin.views.main
 import django.contrib.auth.forms
 import django.contrib.auth.admin
+import django.core.paginator
+import django.db.models
+import django.utils.dateparse
+import django.utils.functional
 import django.utils.html
 import django.template.response
 import django.utils.decorators
@@ -21,6 +26,11 @@ from django.contrib import messages
 from django.conf import settings
 from django.apps import apps
 
+import companies
+import export
+import forms
+import masquerading
+import search
 import signals
 import models
 
@@ -117,11 +127,39 @@ class BaseUserAdmin(django.contrib.auth.admin.UserAdmin):
 
     def get_urls(self):
         from django.conf.urls import url
+        info = self.model._meta.app_label, self.model._meta.model_name
         return [
             url(r'^(\d+)/change/password/$',
-             self.admin_site.admin_view(self.user_change_password))
+             self.admin_site.admin_view(self.user_change_password)),
+            url(r'^masquerades/$', self.admin_site.admin_view(self.masquerades_view),
+                name='{}_{}_masquerades'.format(*info)),
         ] + super(BaseUserAdmin, self).get_urls()
 
+    def masquerades_view(self, request):
+        """
+        Lists the active masquerades from the masquerade registry and ends the ones whose ids are POSTed as
+        masquerade_id. With format=json, both respond with JSON.
+        """
+        if not self.has_change_permission(request):
+            raise django.core.exceptions.PermissionDenied
+        as_json = request.GET.get('format') == 'json'
+        if request.method == 'POST':
+            count = masquerading.end_masquerades(request.POST.getlist('masquerade_id'))
+            if as_json:
+                return django.http.JsonResponse({'ended': count})
+            self.message_user(request, 'Ended {} masquerade(s).'.format(count))
+            return django.http.HttpResponseRedirect(request.get_full_path())
+        masquerades = masquerading.active_masquerades()
+        if as_json:
+            return django.http.JsonResponse({'masquerades': masquerades})
+        context = dict(
+            self.admin_site.each_context(request),
+            title='Active masquerades',
+            opts=self.model._meta,
+            masquerades=masquerades,
+        )
+        return django.template.response.TemplateResponse(request, 'admin/accountsplus/active_masquerades.html', context)
+
     def get_readonly_fields(self, request, obj=None):
         readonly_fields = super(BaseUserAdmin, self).get_readonly_fields(
             request, obj)
@@ -251,12 +289,137 @@ class BaseCompanyAdmin(django.contrib.admin.ModelAdmin):
         super(BaseCompanyAdmin, self).save_model(request, obj, form, change)
 
 
+class EstimatedCountPaginator(django.core.paginator.Paginator):
+    """
+    A paginator that stops counting once max_count objects are found, so that large tables are never fully counted.
+    """
+    max_count = 10000
+
+    @django.utils.functional.cached_property
+    def count(self):
+        return self.object_list[:self.max_count].count()
+
+    @property
+    def is_estimate(self):
+        return self.count >= self.max_count
+
+
+class AuditLogChangeList(django.contrib.admin.views.main.ChangeList):
+    """
+    A changelist that pages through audit log events with a (recorded_on, id) cursor instead of an OFFSET, as long as
+    the default ordering is used. Filters and search are applied before the cursor.
+    """
+    CURSOR_VAR = 'cursor'
+    CURSOR_ORDERING = ('-recorded_on', '-id', )
+
+    cursor = None
+    next_cursor = None
+    uses_cursor = False
+    result_count_is_estimate = False
+
+    def get_filters_params(self, params=None):
+        lookup_params = super(AuditLogChangeList, self).get_filters_params(params)
+        lookup_params.pop(self.CURSOR_VAR, None)
+        return lookup_params
+
+    def get_query_string(self, new_params=None, remove=None):
+        # changing filters, search or ordering starts again from the first page
+        remove = list(remove or []) + [self.CURSOR_VAR]
+        return super(AuditLogChangeList, self).get_query_string(new_params, remove)
+
+    @property
+    def first_page_query_string(self):
+        return self.get_query_string()
+
+    @property
+    def next_page_query_string(self):
+        return self.get_query_string({self.CURSOR_VAR: self.next_cursor})
+
+    def encode_cursor(self, obj):
+        return '{},{}'.format(obj.recorded_on.isoformat(), obj.pk)
+
+    def decode_cursor(self, value):
+        try:
+            recorded_on, pk = value.rsplit(',', 1)
+            recorded_on = django.utils.dateparse.parse_datetime(recorded_on)
+            pk = int(pk)
+        except (AttributeError, TypeError, ValueError):
+            return None
+        if recorded_on is None:
+            return None
+        return recorded_on, pk
+
+    def get_results(self, request):
+        ordering = tuple(self.model_admin.get_ordering(request))
+        self.uses_cursor = (
+            django.contrib.admin.views.main.ORDER_VAR not in self.params and ordering == self.CURSOR_ORDERING)
+        if not self.uses_cursor:
+            super(AuditLogChangeList, self).get_results(request)
+            self.result_count_is_estimate = getattr(self.paginator, 'is_estimate', False)
+            return
+
+        paginator = self.model_admin.get_paginator(request, self.queryset, self.list_per_page)
+        if self.model_admin.show_full_result_count:
+            full_result_count = self.root_queryset.count()
+        else:
+            full_result_count = None
+
+        queryset = self.queryset
+        self.cursor = self.decode_cursor(request.GET.get(self.CURSOR_VAR))
+        if self.cursor:
+            recorded_on, pk = self.cursor
+            queryset = queryset.filter(
+                django.db.models.Q(recorded_on__lt=recorded_on) |
+                django.db.models.Q(recorded_on=recorded_on, pk__lt=pk))
+        # fetch one extra row to find out whether there is a next page
+        result_list = list(queryset[:self.list_per_page + 1])
+        if len(result_list) > self.list_per_page:
+            result_list = result_list[:self.list_per_page]
+            self.next_cursor = self.encode_cursor(result_list[-1])
+
+        self.result_count = paginator.count
+        self.result_count_is_estimate = getattr(paginator, 'is_estimate', False)
+        self.show_full_result_count = self.model_admin.show_full_result_count
+        self.show_admin_actions = not self.show_full_result_count or bool(full_result_count)
+        self.full_result_count = full_result_count
+        self.result_list = result_list
+        self.can_show_all = False
+        self.multi_page = bool(self.cursor or self.next_cursor)
+        self.paginator = paginator
+
+
+class CompanyNameListFilter(django.contrib.admin.SimpleListFilter):
+    """
+    Filters audit log events by company name. The names listed come from companies.get_company_names() instead of a
+    SELECT DISTINCT over the whole audit log table.
+    """
+    title = _('Company Name')
+    parameter_name = 'company_name'
+
+    def lookups(self, request, model_admin):
+        names = companies.get_company_names(model_admin.model)
+        # keep filtering by a name that is no longer listed, such as the old name of a renamed company
+        if self.value() and self.value() not in names:
+            names = sorted(names + [self.value()])
+        return [(name, name) for name in names]
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(company_name=self.value())
+        else:
+            return queryset
+
+
 class BaseAuditLogEventAdmin(django.contrib.admin.ModelAdmin):
-    list_filter = ('company_name', )
+    list_filter = ('event_type', CompanyNameListFilter, )
     search_fields = ('user_email', 'message', )
-    list_display = ('recorded_on', 'user', 'company', 'is_masquerading', 'masquerading_user', 'message', )
-    ordering = ('-recorded_on', )
+    list_display = ('recorded_on', 'user', 'company', 'is_masquerading', 'masquerading_user', 'audit_message',
+                    'occurrences', )
+    ordering = AuditLogChangeList.CURSOR_ORDERING
     list_per_page = 50
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    change_list_template = 'admin/accountsplus/audit_log_change_list.html'
     fieldsets = (
         ('', {
             'fields': ('recorded_on', 'user_id', 'user_email', 'company_name', 'company_id', ),
@@ -265,12 +428,16 @@ class BaseAuditLogEventAdmin(django.contrib.admin.ModelAdmin):
             'fields': ('masquerading_user_email', 'masquerading_user_id', ),
         }),
         ('Audit Log Message', {
-            'fields': ('message', ),
+            'fields': ('event_type', 'audit_message', 'event_data', ),
+        }),
+        ('Occurrences', {
+            'fields': ('occurrences', 'last_recorded_on', ),
         }),
     )
     readonly_fields = ('created_on', 'updated_on', 'recorded_on', 'user_id', 'user_email', 'company_name', 'company_id',
-                       'message', 'masquerading_user_email', 'masquerading_user_id', )
-    actions = []
+                       'event_type', 'audit_message', 'event_data', 'occurrences', 'last_recorded_on',
+                       'masquerading_user_email', 'masquerading_user_id', )
+    actions = ('export_as_csv', 'export_as_jsonl', )
 
     def has_delete_permission(self, request, obj=None):
         return False
@@ -278,6 +445,47 @@ class BaseAuditLogEventAdmin(django.contrib.admin.ModelAdmin):
     def has_add_permission(self, request):
         return False
 
+    def get_changelist(self, request, **kwargs):
+        return AuditLogChangeList
+
+    def get_urls(self):
+        from django.conf.urls import url
+        info = self.model._meta.app_label, self.model._meta.model_name
+        return [
+            url(r'^export/$', self.admin_site.admin_view(self.export_view), name='{}_{}_export'.format(*info)),
+        ] + super(BaseAuditLogEventAdmin, self).get_urls()
+
+    def export_view(self, request):
+        """
+        Streams the audit log events matching the user_id, company_id, masquerading_user_id, since and until query
+        parameters as CSV or JSON Lines (format=csv|jsonl). The search parameter searches like the changelist.
+        """
+        if not self.has_change_permission(request):
+            raise django.core.exceptions.PermissionDenied
+        form = forms.AuditLogExportForm(request.GET)
+        if not form.is_valid():
+            return django.http.HttpResponseBadRequest(form.errors.as_text(), content_type='text/plain')
+        filters = dict(form.cleaned_data)
+        export_format = filters.pop('format')
+        queryset = export.filter_audit_events(self.get_queryset(request), **filters)
+        return export.export_response(queryset, export_format)
+
+    def get_search_results(self, request, queryset, search_term):
+        """
+        Searches with the audit log search index instead of LIKE filters on search_fields.
+        """
+        if not search_term:
+            return queryset, False
+        return search.search_audit_events(queryset, search_term), False
+
+    def export_as_csv(self, request, queryset):
+        return export.export_response(queryset, 'csv')
+    export_as_csv.short_description = 'Export selected audit log events as CSV'
+
+    def export_as_jsonl(self, request, queryset):
+        return export.export_response(queryset, 'jsonl')
+    export_as_jsonl.short_description = 'Export selected audit log events as JSON Lines'
+
     def is_masquerading(self, obj):
         return obj.is_masquerading
     is_masquerading.boolean = True
@@ -302,6 +510,16 @@ class BaseAuditLogEventAdmin(django.contrib.admin.ModelAdmin):
     masquerading_user.admin_order_field = 'masquerading_user_id'
     masquerading_user.allow_tags = True
 
+    def audit_message(self, obj):
+        return obj.get_message()
+    audit_message.short_description = 'Message'
+
+
+class BaseCompactAuditLogEventAdmin(BaseAuditLogEventAdmin):
+    readonly_fields = ('recorded_on', 'user_id', 'user_email', 'company_name', 'company_id', 'event_type',
+                       'audit_message', 'event_data', 'occurrences', 'last_recorded_on', 'masquerading_user_email',
+                       'masquerading_user_id', )
+
 
 class ActionFilter(django.contrib.admin.SimpleListFilter):
     title = 'action'
@@ -1,8 +1,17 @@
 from __future__ import unicode_literals
 
 from django.apps import AppConfig
+import django.db.models.signals
 
 
 class AccountsConfig(AppConfig):
     name = 'accountsplus'
     verbose_name = "Accounts Plus"
+
+    def ready(self):
+        import search
+        import signals
+        import timezones
+        signals.configure_audit_log()
+        timezones.configure()
+        django.db.models.signals.post_migrate.connect(search.post_migrate_callback, sender=self)
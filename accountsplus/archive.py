@@ -0,0 +1,242 @@
+from __future__ import unicode_literals
+
+import bisect
+import datetime
+import gzip
+import io
+import json
+import os
+import re
+
+import django.utils.dateparse
+import django.utils.timezone
+
+import serializers
+
+
+ARCHIVE_FILE_TEMPLATE = 'audit-log-{}.jsonl.gz'
+IDS_FILE_TEMPLATE = 'audit-log-{}.ids.json'
+ARCHIVE_FILE_RE = re.compile(r'^audit-log-(\d{4}-\d{2})\.jsonl\.gz$')
+
+
+def partition_for(value):
+    """
+    Returns the monthly partition key ('YYYY-MM', in UTC) that a datetime belongs to.
+    """
+    if django.utils.timezone.is_aware(value):
+        value = value.astimezone(django.utils.timezone.utc)
+    return '{:04d}-{:02d}'.format(value.year, value.month)
+
+
+def partition_bounds(partition):
+    """
+    Returns the [start, end) UTC datetimes covered by a monthly partition key.
+    """
+    year, month = [int(p) for p in partition.split('-')]
+    start = datetime.datetime(year, month, 1, tzinfo=django.utils.timezone.utc)
+    if month == 12:
+        end = start.replace(year=year + 1, month=1)
+    else:
+        end = start.replace(month=month + 1)
+    return start, end
+
+
+def partition_months_before(partition, months):
+    """
+    Returns the monthly partition key that is the given number of months before a partition.
+    """
+    year, month = [int(p) for p in partition.split('-')]
+    month -= months
+    while month < 1:
+        month += 12
+        year -= 1
+    return '{:04d}-{:02d}'.format(year, month)
+
+
+def partitions_between(since, until):
+    """
+    Returns the monthly partition keys overlapping the [since, until) time range in ascending order.
+    """
+    partitions = []
+    partition = partition_for(since)
+    last = partition_for(until - datetime.timedelta(microseconds=1))
+    while partition <= last:
+        partitions.append(partition)
+        partition = partition_for(partition_bounds(partition)[1])
+    return partitions
+
+
+class ArchivedIds(object):
+    """
+    The ids of the events archived in a partition, kept as sorted [first, last] ranges of consecutive ids. Ids don't
+    follow recorded_on and partitions can be archived in parts, so the ranges hold exactly the ids that were written.
+    """
+    def __init__(self, ranges=()):
+        self.ranges = []
+        self._firsts = []
+        self.add_ranges(ranges)
+
+    def __contains__(self, event_id):
+        i = bisect.bisect_right(self._firsts, event_id) - 1
+        return i >= 0 and event_id <= self.ranges[i][1]
+
+    def __len__(self):
+        return sum(last - first + 1 for first, last in self.ranges)
+
+    def add(self, ids):
+        self.add_ranges([[i, i] for i in ids])
+
+    def add_ranges(self, ranges):
+        merged = []
+        for first, last in sorted([list(r) for r in self.ranges] + [list(r) for r in ranges]):
+            if merged and first <= merged[-1][1] + 1:
+                merged[-1][1] = max(merged[-1][1], last)
+            else:
+                merged.append([first, last])
+        self.ranges = merged
+        self._firsts = [first for first, last in merged]
+
+    def last(self):
+        return self.ranges[-1][1] if self.ranges else None
+
+
+class AuditLogArchive(object):
+    """
+    A directory of compressed, append-only JSON Lines files, one per monthly partition. Each append adds a new gzip
+    member to the partition file, so existing archived data is never rewritten. Next to each partition file, a small
+    JSON file keeps the ranges of archived ids and the size of the partition file they were written for.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, partition):
+        return os.path.join(self.directory, ARCHIVE_FILE_TEMPLATE.format(partition))
+
+    def partitions(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(m.group(1) for m in (ARCHIVE_FILE_RE.match(f) for f in os.listdir(self.directory)) if m)
+
+    def ids_path(self, partition):
+        return os.path.join(self.directory, IDS_FILE_TEMPLATE.format(partition))
+
+    def has_partition(self, partition):
+        return os.path.exists(self.path(partition))
+
+    def append(self, partition, events):
+        """
+        Appends the given audit log events (model instances) to a partition, and returns the number written.
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        archived_ids = self.archived_ids(partition)
+        ids = []
+        with open(self.path(partition), 'ab') as f:
+            with gzip.GzipFile(fileobj=f, mode='ab') as archive_file:
+                for e in events:
+                    line = json.dumps(serializers.event_to_dict(e), sort_keys=True, separators=(',', ':'))
+                    archive_file.write(line.encode('utf-8') + b'\n')
+                    ids.append(e.id)
+            f.flush()
+            os.fsync(f.fileno())
+            size = os.fstat(f.fileno()).st_size
+        if ids:
+            archived_ids.add(ids)
+            self.write_archived_ids(partition, archived_ids, size)
+        return len(ids)
+
+    def write_archived_ids(self, partition, archived_ids, size):
+        path = self.ids_path(partition)
+        with io.open(path + '.tmp', 'wb') as f:
+            f.write(json.dumps({'ranges': archived_ids.ranges, 'size': size}).encode('utf-8'))
+        os.rename(path + '.tmp', path)
+
+    def read(self, partition):
+        """
+        Yields every archived event of a partition as a dict, in the order they were archived.
+        """
+        if not self.has_partition(partition):
+            return
+        with open(self.path(partition), 'rb') as f:
+            for data in self._read_members(f):
+                yield data
+
+    def _read_members(self, f):
+        with gzip.GzipFile(fileobj=f, mode='rb') as archive_file:
+            for line in archive_file:
+                if line.strip():
+                    yield json.loads(line.decode('utf-8'))
+
+    def archived_ids(self, partition):
+        """
+        Returns the ArchivedIds of a partition. Only the gzip members appended after the ids were written are read:
+        none, unless an append was interrupted before writing them or the partition was archived before they were
+        kept.
+        """
+        archived_ids = ArchivedIds()
+        if not self.has_partition(partition):
+            return archived_ids
+        size = 0
+        try:
+            with io.open(self.ids_path(partition), 'rb') as f:
+                data = json.loads(f.read().decode('utf-8'))
+            ranges, size = data['ranges'], data['size']
+        except (IOError, OSError, ValueError, KeyError):
+            ranges = ()
+        with open(self.path(partition), 'rb') as f:
+            file_size = os.fstat(f.fileno()).st_size
+            if size > file_size:
+                # the partition file was replaced, so the ids are not its own
+                ranges, size = (), 0
+            archived_ids.add_ranges(ranges)
+            if size < file_size:
+                f.seek(size)
+                archived_ids.add(data['id'] for data in self._read_members(f))
+        return archived_ids
+
+    def last_id(self, partition):
+        """
+        Returns the highest archived event id of a partition, or None if nothing was archived yet. Lower ids are not
+        necessarily archived, use archived_ids() to skip the events that were.
+        """
+        return self.archived_ids(partition).last()
+
+    def events(self, since=None, until=None):
+        """
+        Yields archived events as dicts whose recorded_on is within [since, until), only reading the partition files
+        that overlap the time range.
+        """
+        for partition in self.partitions():
+            start, end = partition_bounds(partition)
+            if (since is not None and end <= since) or (until is not None and start >= until):
+                continue
+            for data in self.read(partition):
+                recorded_on = django.utils.dateparse.parse_datetime(data['recorded_on'])
+                if (since is None or recorded_on >= since) and (until is None or recorded_on < until):
+                    yield data
+
+
+class AuditLogPartitionRouter(object):
+    """
+    Answers time range queries over the audit log by sending each monthly partition in the range either to the hot
+    audit log table or, once it has been archived, to the archive files. Events are yielded as dicts in partition
+    order.
+    """
+    def __init__(self, model, archive):
+        self.model = model
+        self.archive = archive
+
+    def events(self, since, until=None):
+        if until is None:
+            until = django.utils.timezone.now()
+        for partition in partitions_between(since, until):
+            start, end = partition_bounds(partition)
+            start, end = max(start, since), min(end, until)
+            if self.archive.has_partition(partition):
+                for data in self.archive.events(start, end):
+                    yield data
+            # events for an archived month may still arrive late, so the hot table is always checked
+            queryset = self.model.objects.filter(
+                recorded_on__gte=start, recorded_on__lt=end).order_by('recorded_on', 'id')
+            for e in queryset.iterator():
+                yield serializers.event_to_dict(e)
@@ -0,0 +1,113 @@
+from __future__ import unicode_literals
+
+import django.contrib.auth
+import django.core.cache
+import django.core.exceptions
+import django.db.models.signals
+
+import settings
+
+
+COMPANY_NAMES_CACHE_KEY = 'accountsplus:company_names'
+
+# the user model and the model of its company foreign key, resolved by configure(); None if it has none
+_user_model = None
+_company_model = None
+
+
+def get_company_model():
+    return _company_model
+
+
+def configure():
+    """
+    Resolves the company model from the user model's company foreign key and connects the receivers that invalidate
+    cached company names when a company is saved or deleted.
+    """
+    global _user_model, _company_model
+    if _company_model is not None:
+        django.db.models.signals.post_save.disconnect(company_changed_callback, sender=_company_model)
+        django.db.models.signals.post_delete.disconnect(company_changed_callback, sender=_company_model)
+    _user_model = None
+    _company_model = None
+    try:
+        user_model = django.contrib.auth.get_user_model()
+        field = user_model._meta.get_field('company')
+    except (django.core.exceptions.ImproperlyConfigured, django.core.exceptions.FieldDoesNotExist):
+        return
+    if field.is_relation and field.many_to_one:
+        _user_model = user_model
+        _company_model = field.related_model
+        django.db.models.signals.post_save.connect(company_changed_callback, sender=_company_model)
+        django.db.models.signals.post_delete.connect(company_changed_callback, sender=_company_model)
+
+
+def get_cache_key(company_id):
+    return 'accountsplus:company_name:{}:{}'.format(_company_model._meta.label_lower, company_id)
+
+
+def get_company_name(company_id):
+    """
+    Returns the name of a company through the cache, loading only the name on a miss.
+    """
+    key = get_cache_key(company_id)
+    name = django.core.cache.cache.get(key)
+    if name is None:
+        name = _company_model._default_manager.filter(pk=company_id).values_list('name', flat=True).first()
+        if name is None:
+            return ''
+        django.core.cache.cache.set(key, name, settings.get_audit_log_company_cache_timeout())
+    return name
+
+
+def get_user_company(user):
+    """
+    Returns the (company_id, company_name) of a user, or (None, None) if the user has no company. Unless the user's
+    company is already loaded, the name is read from the cache instead of loading the company.
+    """
+    if _user_model is not None and isinstance(user, _user_model):
+        company_id = user.company_id
+        if company_id is None:
+            return None, None
+        company = getattr(user, user._meta.get_field('company').get_cache_name(), None)
+        if company is not None:
+            return company.id, company.name
+        return company_id, get_company_name(company_id)
+    company = getattr(user, 'company', None)
+    if company:
+        return company.id, company.name
+    return None, None
+
+
+def get_company_names(event_model):
+    """
+    Returns the sorted company names that audit log events can be filtered by, through the cache. The names are
+    those of the company table, or the distinct company names of event_model if the user model has no company
+    foreign key.
+    """
+    if _company_model is not None:
+        source = _company_model
+        queryset = _company_model._default_manager.values_list('name', flat=True)
+    else:
+        source = event_model
+        queryset = event_model._default_manager.exclude(company_name='').values_list(
+            'company_name', flat=True).distinct()
+    label = source._meta.label_lower
+    cached = django.core.cache.cache.get(COMPANY_NAMES_CACHE_KEY)
+    if cached is not None and cached[0] == label:
+        return cached[1]
+    names = sorted(set(queryset.order_by()))
+    django.core.cache.cache.set(
+        COMPANY_NAMES_CACHE_KEY, (label, names), settings.get_audit_log_company_cache_timeout())
+    return names
+
+
+def invalidate_company(company_id):
+    if _company_model is not None:
+        django.core.cache.cache.delete_many([get_cache_key(company_id), COMPANY_NAMES_CACHE_KEY])
+    else:
+        django.core.cache.cache.delete(COMPANY_NAMES_CACHE_KEY)
+
+
+def company_changed_callback(sender, instance, **kwargs):
+    invalidate_company(instance.pk)
@@ -1,10 +1,12 @@
 from __future__ import unicode_literals
 
+import masquerading
+
 
 def masquerade_info(request):
     if request.user.is_authenticated():
         return {
-            'is_masquerading': request.session.get('is_masquerading', False),
+            'is_masquerading': masquerading.get_masquerade(request) is not None,
         }
     else:
         return {
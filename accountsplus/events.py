@@ -0,0 +1,73 @@
+from __future__ import unicode_literals
+
+import json
+
+
+# audit log event types; the values are stored in the database so they must never change
+SIGN_IN = 1
+SIGN_OUT = 2
+MASQUERADE_START = 3
+MASQUERADE_END = 4
+PASSWORD_RESET_REQUEST = 5
+PASSWORD_CHANGE = 6
+USER_CREATE = 7
+EMAIL_CHANGE = 8
+USER_DEACTIVATE = 9
+USER_ACTIVATE = 10
+COMPANY_NAME_CHANGE = 11
+
+EVENT_TYPE_CHOICES = (
+    (SIGN_IN, 'Sign in'),
+    (SIGN_OUT, 'Sign out'),
+    (MASQUERADE_START, 'Masquerade start'),
+    (MASQUERADE_END, 'Masquerade end'),
+    (PASSWORD_RESET_REQUEST, 'Request password reset'),
+    (PASSWORD_CHANGE, 'Change password'),
+    (USER_CREATE, 'Create user'),
+    (EMAIL_CHANGE, 'Email change'),
+    (USER_DEACTIVATE, 'Deactivate user'),
+    (USER_ACTIVATE, 'Activate user'),
+    (COMPANY_NAME_CHANGE, 'Company name change'),
+)
+
+MESSAGE_TEMPLATES = {
+    SIGN_IN: 'Sign in',
+    SIGN_OUT: 'Sign out',
+    MASQUERADE_START: 'Masquerade start as {masquerade_as_email} ({masquerade_as_id})',
+    MASQUERADE_END: 'Masquerade end as {masquerade_as_email} ({masquerade_as_id})',
+    PASSWORD_RESET_REQUEST: 'Request password reset',
+    PASSWORD_CHANGE: 'Change password',
+    USER_CREATE: 'Create by: {actor_email} ({actor_id})',
+    EMAIL_CHANGE: 'Email change from: {old_email} to: {new_email}',
+    USER_DEACTIVATE: 'Deactivate by: {actor_email} ({actor_id})',
+    USER_ACTIVATE: 'Activate by: {actor_email} ({actor_id})',
+    COMPANY_NAME_CHANGE: 'Company id: {company_id} name change from: {old_name} to: {new_name}',
+}
+
+
+def dumps_event_data(data):
+    """
+    Returns the compact JSON stored in an audit log event's event_data field.
+    """
+    if not data:
+        return ''
+    return json.dumps(data, sort_keys=True, separators=(',', ':'))
+
+
+def loads_event_data(event_data):
+    if not event_data:
+        return {}
+    return json.loads(event_data)
+
+
+def render_message(event_type, data):
+    """
+    Returns the human readable message of a structured audit log event.
+    """
+    template = MESSAGE_TEMPLATES.get(event_type)
+    if template is None:
+        return ''
+    try:
+        return template.format(**data)
+    except KeyError:
+        return dict(EVENT_TYPE_CHOICES)[event_type]
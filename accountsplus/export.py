@@ -0,0 +1,132 @@
+from __future__ import unicode_literals
+
+import csv
+import datetime
+import json
+
+import django.http
+import django.utils.six
+
+import events
+import search as audit_log_search
+
+
+EXPORT_FIELDS = (
+    'id', 'recorded_on', 'user_id', 'user_email', 'company_id', 'company_name', 'masquerading_user_id',
+    'masquerading_user_email', 'event_type', 'event_data', 'occurrences', 'last_recorded_on', 'message', )
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+}
+
+
+def filter_audit_events(queryset, user_id=None, company_id=None, masquerading_user_id=None, since=None, until=None,
+                        search=None, event_types=None):
+    """
+    Filters audit log events by user, company, masquerading user, a [since, until) recorded_on range, a search term
+    and event types. Filters that are None are not applied.
+    """
+    if user_id is not None:
+        queryset = queryset.filter(user_id=user_id)
+    if company_id is not None:
+        queryset = queryset.filter(company_id=company_id)
+    if masquerading_user_id is not None:
+        queryset = queryset.filter(masquerading_user_id=masquerading_user_id)
+    if since is not None:
+        queryset = queryset.filter(recorded_on__gte=since)
+    if until is not None:
+        queryset = queryset.filter(recorded_on__lt=until)
+    if event_types is not None:
+        queryset = queryset.filter(event_type__in=list(event_types))
+    if search:
+        queryset = audit_log_search.search_audit_events(queryset, search)
+    return queryset
+
+
+def iter_audit_events(queryset, fields=EXPORT_FIELDS, chunk_size=1000):
+    """
+    Yields tuples of the given fields for every event in the queryset in id order. Events are fetched chunk_size at a
+    time by id, so memory use doesn't grow with the number of events even on database backends that load the full
+    result of a query into memory.
+    """
+    fields = tuple(fields)
+    # the id is needed to fetch the next chunk even if it isn't exported
+    values_fields = fields if 'id' in fields else fields + ('id', )
+    pk_index = values_fields.index('id')
+    queryset = queryset.order_by('id').values_list(*values_fields)
+    last_pk = None
+    while True:
+        chunk = queryset if last_pk is None else queryset.filter(id__gt=last_pk)
+        rows = list(chunk[:chunk_size])
+        for row in rows:
+            yield row[:len(fields)]
+        if len(rows) < chunk_size:
+            return
+        last_pk = rows[-1][pk_index]
+
+
+def render_messages(rows, fields=EXPORT_FIELDS):
+    """
+    Fills in the message of structured events, which don't store one, from their event type and data.
+    """
+    fields = tuple(fields)
+    if not {'message', 'event_type', 'event_data'}.issubset(fields):
+        for row in rows:
+            yield row
+        return
+    message_index = fields.index('message')
+    event_type_index = fields.index('event_type')
+    event_data_index = fields.index('event_data')
+    for row in rows:
+        if not row[message_index] and row[event_type_index] is not None:
+            message = events.render_message(row[event_type_index], events.loads_event_data(row[event_data_index]))
+            row = row[:message_index] + (message, ) + row[message_index + 1:]
+        yield row
+
+
+def _format_value(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return value
+
+
+class Echo(object):
+    """
+    A file-like object that returns what is written to it, so that csv.writer can produce lines one at a time.
+    """
+    def write(self, value):
+        return value
+
+
+def csv_lines(rows, fields=EXPORT_FIELDS):
+    writer = csv.writer(Echo())
+
+    def encode(values):
+        values = ['' if v is None else _format_value(v) for v in values]
+        if django.utils.six.PY2:
+            values = [v.encode('utf-8') if isinstance(v, django.utils.six.text_type) else v for v in values]
+        return values
+
+    yield writer.writerow(encode(fields))
+    for row in rows:
+        yield writer.writerow(encode(row))
+
+
+def jsonl_lines(rows, fields=EXPORT_FIELDS):
+    for row in rows:
+        yield json.dumps(dict(zip(fields, [_format_value(v) for v in row])), sort_keys=True) + '\n'
+
+
+def export_response(queryset, export_format='csv', fields=EXPORT_FIELDS, filename='audit-log', chunk_size=1000):
+    """
+    Returns a StreamingHttpResponse that writes the audit log events of a queryset as CSV or JSON Lines.
+    """
+    rows = render_messages(iter_audit_events(queryset, fields, chunk_size), fields)
+    if export_format == 'jsonl':
+        lines = jsonl_lines(rows, fields)
+    else:
+        lines = csv_lines(rows, fields)
+    response = django.http.StreamingHttpResponse(lines, content_type=EXPORT_FORMATS[export_format])
+    response['Content-Disposition'] = 'attachment; filename="{}.{}"'.format(filename, export_format)
+    return response
@@ -1,6 +1,9 @@
 from __future__ import unicode_literals
 
 import django.forms
+import django.utils.dateparse
+import django.utils.six
+import django.utils.timezone
 from django.conf import settings
 from django.apps import apps
 from django.contrib.auth.forms import AuthenticationForm
@@ -8,6 +11,8 @@ from django.contrib.admin.forms import AdminAuthenticationForm
 
 from captcha.fields import ReCaptchaField
 
+import events
+
 
 class CaptchaForm(django.forms.Form):
     captcha = ReCaptchaField()
@@ -31,3 +36,68 @@ class EmailBasedAdminAuthenticationForm(AdminAuthenticationForm):
 
     def clean_username(self):
         return self.data['username'].lower()
+
+
+class AuditLogExportForm(django.forms.Form):
+    format = django.forms.ChoiceField(choices=(('csv', 'CSV'), ('jsonl', 'JSON Lines'), ), required=False)
+    user_id = django.forms.IntegerField(required=False)
+    company_id = django.forms.IntegerField(required=False)
+    masquerading_user_id = django.forms.IntegerField(required=False)
+    since = django.forms.DateTimeField(required=False)
+    until = django.forms.DateTimeField(required=False)
+    search = django.forms.CharField(required=False)
+
+    def clean_format(self):
+        return self.cleaned_data.get('format') or 'csv'
+
+
+class ISODateTimeField(django.forms.DateTimeField):
+    """
+    A DateTimeField that also accepts ISO 8601 datetimes with a T separator and a UTC offset.
+    """
+    def to_python(self, value):
+        if isinstance(value, django.utils.six.string_types):
+            try:
+                parsed = django.utils.dateparse.parse_datetime(value.strip())
+            except ValueError:
+                parsed = None
+            if parsed is not None:
+                if settings.USE_TZ and django.utils.timezone.is_naive(parsed):
+                    parsed = django.utils.timezone.make_aware(parsed)
+                return parsed
+        return super(ISODateTimeField, self).to_python(value)
+
+
+class JSONObjectField(django.forms.Field):
+    """
+    A field for a JSON object that has already been decoded into a dict.
+    """
+    def to_python(self, value):
+        if value in self.empty_values:
+            return None
+        if not isinstance(value, dict):
+            raise django.forms.ValidationError('Enter a JSON object.', code='invalid')
+        return value
+
+
+class AuditLogIngestForm(django.forms.Form):
+    """
+    Validates an audit log event recorded by another service. Events need either a known event type or a message.
+    """
+    user_id = django.forms.IntegerField()
+    user_email = django.forms.EmailField()
+    recorded_on = ISODateTimeField(required=False)
+    company_id = django.forms.IntegerField(required=False)
+    company_name = django.forms.CharField(max_length=100, required=False)
+    event_type = django.forms.TypedChoiceField(
+        choices=events.EVENT_TYPE_CHOICES, coerce=int, empty_value=None, required=False)
+    event_data = JSONObjectField(required=False)
+    message = django.forms.CharField(required=False)
+    masquerading_user_id = django.forms.IntegerField(required=False)
+    masquerading_user_email = django.forms.EmailField(required=False)
+
+    def clean(self):
+        cleaned_data = super(AuditLogIngestForm, self).clean()
+        if cleaned_data.get('event_type') is None and not cleaned_data.get('message') and not self.errors:
+            raise django.forms.ValidationError('An event needs an event_type or a message.', code='required')
+        return cleaned_data
@@ -0,0 +1,77 @@
+from __future__ import unicode_literals
+
+import json
+
+import django.utils.timezone
+
+import events
+import forms
+import writers
+
+
+class IngestResult(object):
+    """
+    Counts the events of an ingested batch and keeps the errors of the first max_errors rejected lines.
+    """
+    def __init__(self, max_errors=100):
+        self.accepted = 0
+        self.rejected = 0
+        self.errors = []
+        self.max_errors = max_errors
+
+    def reject(self, line_number, errors):
+        self.rejected += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append({'line': line_number, 'errors': errors})
+
+    def as_dict(self):
+        return {'accepted': self.accepted, 'rejected': self.rejected, 'errors': self.errors, }
+
+
+def parse_line(line):
+    """
+    Decodes and validates one line of NDJSON. Returns (event fields, None) or (None, errors by field).
+    """
+    if isinstance(line, bytes):
+        try:
+            line = line.decode('utf-8')
+        except UnicodeDecodeError:
+            return None, {'__all__': ['Line is not valid UTF-8.']}
+    try:
+        data = json.loads(line)
+    except ValueError:
+        return None, {'__all__': ['Line is not valid JSON.']}
+    if not isinstance(data, dict):
+        return None, {'__all__': ['Line is not a JSON object.']}
+    form = forms.AuditLogIngestForm(data)
+    if not form.is_valid():
+        return None, dict(
+            (field, [e['message'] for e in errors.get_json_data()]) for field, errors in form.errors.items())
+    fields = form.cleaned_data
+    fields['event_data'] = events.dumps_event_data(fields['event_data'])
+    fields['recorded_on'] = fields['recorded_on'] or django.utils.timezone.now()
+    return fields, None
+
+
+def ingest_events(lines, model, chunk_size=1000, max_errors=100):
+    """
+    Validates the NDJSON lines of a batch one at a time and inserts the valid events with one bulk insert per
+    chunk_size events. Lines that fail to validate are reported in the returned IngestResult and don't stop the rest
+    of the batch; blank lines are skipped.
+    """
+    result = IngestResult(max_errors)
+    chunk = []
+    for line_number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        fields, errors = parse_line(line)
+        if errors:
+            result.reject(line_number, errors)
+            continue
+        chunk.append(model(**fields))
+        if len(chunk) >= chunk_size:
+            result.accepted += writers.write_audit_events(chunk)
+            chunk = []
+    if chunk:
+        result.accepted += writers.write_audit_events(chunk)
+    return result
@@ -0,0 +1,80 @@
+from __future__ import unicode_literals
+
+import re
+
+import django.core.management.base
+import django.db
+import django.db.transaction
+import django.utils.timezone
+from django.apps import apps
+from django.conf import settings
+
+from accountsplus import archive, signals
+from accountsplus import settings as accountsplus_settings
+
+
+class Command(django.core.management.base.BaseCommand):
+    help = (
+        'Moves the audit log events of cold monthly partitions out of the audit log table into compressed, '
+        'append-only archive files.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--before', help='Archive partitions before this month (YYYY-MM). By default the last '
+                             'ACCOUNTS_AUDIT_LOG_HOT_MONTHS months are kept in the audit log table.')
+        parser.add_argument(
+            '--directory', help='Directory to write archive files to. Defaults to ACCOUNTS_AUDIT_LOG_ARCHIVE_DIR.')
+        parser.add_argument(
+            '--chunk-size', type=int, default=1000, help='Number of events archived and deleted per transaction.')
+
+    def handle(self, *args, **options):
+        if not signals.is_audit_log_configured():
+            raise django.core.management.base.CommandError('ACCOUNTS_AUDIT_LOG_EVENT_MODEL is not configured')
+        model = apps.get_model(settings.ACCOUNTS_AUDIT_LOG_EVENT_MODEL)
+
+        directory = options['directory'] or accountsplus_settings.get_audit_log_archive_dir()
+        if not directory:
+            raise django.core.management.base.CommandError(
+                'Specify --directory or configure ACCOUNTS_AUDIT_LOG_ARCHIVE_DIR')
+        audit_log_archive = archive.AuditLogArchive(directory)
+
+        before = options['before']
+        if before is None:
+            before = archive.partition_months_before(
+                archive.partition_for(django.utils.timezone.now()),
+                accountsplus_settings.get_audit_log_hot_months() - 1)
+        elif not re.match(r'^\d{4}-\d{2}$', before):
+            raise django.core.management.base.CommandError('--before must be formatted as YYYY-MM')
+        cutoff = archive.partition_bounds(before)[0]
+
+        oldest = model.objects.filter(recorded_on__lt=cutoff).order_by('recorded_on').values_list(
+            'recorded_on', flat=True).first()
+        if oldest is None:
+            self.stdout.write('No audit log events before {} to archive'.format(before))
+            return
+
+        for partition in archive.partitions_between(oldest, cutoff):
+            count = self.archive_partition(model, audit_log_archive, partition, options['chunk_size'])
+            self.stdout.write('Archived {} audit log events of {} to {}'.format(
+                count, partition, audit_log_archive.path(partition)))
+
+    def archive_partition(self, model, audit_log_archive, partition, chunk_size):
+        start, end = archive.partition_bounds(partition)
+        # events are read from the database they are deleted from rather than from a replica
+        queryset = model.objects.using(django.db.router.db_for_write(model)).filter(
+            recorded_on__gte=start, recorded_on__lt=end).order_by('id')
+        # events archived by an earlier run that was interrupted before deleting them
+        archived_ids = audit_log_archive.archived_ids(partition)
+        count = 0
+        last_id = 0
+        while True:
+            events = list(queryset.filter(id__gt=last_id)[:chunk_size])
+            if not events:
+                return count
+            last_id = events[-1].id
+            with django.db.transaction.atomic(using=queryset.db):
+                events_to_archive = [e for e in events if e.id not in archived_ids]
+                if events_to_archive:
+                    audit_log_archive.append(partition, events_to_archive)
+                queryset.filter(id__in=[e.id for e in events]).delete()
+            count += len(events)
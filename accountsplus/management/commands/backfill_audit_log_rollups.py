@@ -0,0 +1,66 @@
+from __future__ import unicode_literals
+
+import datetime
+
+import django.core.management.base
+import django.utils.dateparse
+import django.utils.timezone
+from django.apps import apps
+from django.conf import settings
+
+from accountsplus import rollups, signals
+from accountsplus import settings as accountsplus_settings
+
+
+class Command(django.core.management.base.BaseCommand):
+    help = (
+        'Recomputes the daily audit log rollups from the events in the audit log table, one day per transaction. '
+        'Days are in UTC.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--since', help='First day to recompute (YYYY-MM-DD). Defaults to the day of the oldest event.')
+        parser.add_argument(
+            '--until', help=(
+                'Day to stop before (YYYY-MM-DD). Defaults to today, which is still being counted as events are '
+                'written, so counts written while it is recomputed would be lost.'))
+
+    def parse_date(self, value, name):
+        try:
+            date = django.utils.dateparse.parse_date(value)
+        except ValueError:
+            date = None
+        if date is None:
+            raise django.core.management.base.CommandError('--{} must be formatted as YYYY-MM-DD'.format(name))
+        return date
+
+    def handle(self, *args, **options):
+        if not signals.is_audit_log_configured():
+            raise django.core.management.base.CommandError('ACCOUNTS_AUDIT_LOG_EVENT_MODEL is not configured')
+        rollup_model = accountsplus_settings.get_audit_log_rollup_model()
+        if not rollup_model:
+            raise django.core.management.base.CommandError('ACCOUNTS_AUDIT_LOG_ROLLUP_MODEL is not configured')
+        event_model = apps.get_model(settings.ACCOUNTS_AUDIT_LOG_EVENT_MODEL)
+        rollup_model = apps.get_model(rollup_model)
+
+        if options['since']:
+            since = self.parse_date(options['since'], 'since')
+        else:
+            oldest = event_model.objects.order_by('recorded_on').values_list('recorded_on', flat=True).first()
+            if oldest is None:
+                self.stdout.write('No audit log events to roll up')
+                return
+            since = rollups.rollup_date(oldest)
+        if options['until']:
+            until = self.parse_date(options['until'], 'until')
+        else:
+            until = rollups.rollup_date(django.utils.timezone.now())
+
+        days = 0
+        rows = 0
+        date = since
+        while date < until:
+            rows += rollups.rollup_day(event_model, date, rollup_model)
+            days += 1
+            date += datetime.timedelta(days=1)
+        self.stdout.write('Rolled up {} days of audit log events into {} rows'.format(days, rows))
@@ -0,0 +1,37 @@
+from __future__ import unicode_literals
+
+import django.core.management.base
+from django.apps import apps
+from django.conf import settings
+
+from accountsplus import signals, spool
+from accountsplus import settings as accountsplus_settings
+
+
+class Command(django.core.management.base.BaseCommand):
+    help = (
+        'Loads the audit log events of an on-disk spool into the database and removes the drained segments. Events '
+        'that were already loaded by an interrupted run are skipped.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--directory', help='Spool directory to drain. Defaults to ACCOUNTS_AUDIT_LOG_SPOOL_DIR.')
+        parser.add_argument(
+            '--chunk-size', type=int, default=1000, help='Number of events loaded per transaction.')
+
+    def handle(self, *args, **options):
+        directory = options['directory'] or accountsplus_settings.get_audit_log_spool_dir()
+        if not directory:
+            raise django.core.management.base.CommandError(
+                'Specify --directory or configure ACCOUNTS_AUDIT_LOG_SPOOL_DIR')
+        # events spooled without a model are loaded into the configured audit log model
+        default_model = None
+        if signals.is_audit_log_configured():
+            default_model = apps.get_model(settings.ACCOUNTS_AUDIT_LOG_EVENT_MODEL)
+
+        audit_log_spool = spool.AuditLogSpool(directory)
+        try:
+            count = spool.drain_spool(audit_log_spool, default_model, options['chunk_size'])
+        except LookupError as e:
+            raise django.core.management.base.CommandError(e)
+        self.stdout.write('Loaded {} audit log events from {}'.format(count, directory))
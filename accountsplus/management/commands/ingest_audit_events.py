@@ -0,0 +1,44 @@
+from __future__ import unicode_literals
+
+import io
+import sys
+
+import django.core.management.base
+from django.apps import apps
+from django.conf import settings
+
+from accountsplus import ingest, signals
+
+
+class Command(django.core.management.base.BaseCommand):
+    help = (
+        'Records the audit log events of a newline-delimited JSON file, one event per line, with a bulk insert per '
+        'chunk. Invalid lines are reported and skipped.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='NDJSON file to read, or - for standard input.')
+        parser.add_argument(
+            '--chunk-size', type=int, default=1000, help='Number of events inserted per bulk insert.')
+        parser.add_argument(
+            '--max-errors', type=int, default=100, help='Number of rejected lines to report.')
+
+    def handle(self, *args, **options):
+        if not signals.is_audit_log_configured():
+            raise django.core.management.base.CommandError('ACCOUNTS_AUDIT_LOG_EVENT_MODEL is not configured')
+        model = apps.get_model(settings.ACCOUNTS_AUDIT_LOG_EVENT_MODEL)
+
+        path = options['path']
+        try:
+            f = getattr(sys.stdin, 'buffer', sys.stdin) if path == '-' else io.open(path, 'rb')
+        except IOError as e:
+            raise django.core.management.base.CommandError('Cannot read {}: {}'.format(path, e))
+        try:
+            result = ingest.ingest_events(f, model, chunk_size=options['chunk_size'], max_errors=options['max_errors'])
+        finally:
+            if path != '-':
+                f.close()
+
+        for error in result.errors:
+            for field, messages in sorted(error['errors'].items()):
+                self.stderr.write('Line {}: {}: {}'.format(error['line'], field, ' '.join(messages)))
+        self.stdout.write('Ingested {} audit log events, rejected {}'.format(result.accepted, result.rejected))
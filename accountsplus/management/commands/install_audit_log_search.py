@@ -0,0 +1,28 @@
+from __future__ import unicode_literals
+
+import django.core.management.base
+import django.db
+from django.apps import apps
+from django.conf import settings
+
+from accountsplus import search, signals
+
+
+class Command(django.core.management.base.BaseCommand):
+    help = (
+        'Creates the full-text search index of the audit log model and indexes the existing events. The index is '
+        'also installed after migrate when the audit log is enabled.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--database', default=django.db.DEFAULT_DB_ALIAS, help='Database to install the search index on.')
+
+    def handle(self, *args, **options):
+        if not signals.is_audit_log_configured():
+            raise django.core.management.base.CommandError('ACCOUNTS_AUDIT_LOG_EVENT_MODEL is not configured')
+        model = apps.get_model(settings.ACCOUNTS_AUDIT_LOG_EVENT_MODEL)
+        backend = search.get_search_backend(model, options['database'])
+        if backend.install():
+            self.stdout.write('Installed the audit log search index of {}'.format(model._meta.db_table))
+        else:
+            self.stdout.write('No audit log search index to install for {}'.format(model._meta.db_table))
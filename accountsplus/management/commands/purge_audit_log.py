@@ -0,0 +1,75 @@
+from __future__ import unicode_literals
+
+import django.core.management.base
+import django.utils.timezone
+from django.apps import apps
+from django.conf import settings
+
+from accountsplus import archive, retention, signals
+from accountsplus import settings as accountsplus_settings
+
+
+class Command(django.core.management.base.BaseCommand):
+    help = (
+        'Deletes, or archives and deletes, the audit log events older than a given age in small batches by primary '
+        'key range, so that retention can run without locking the audit log table for long.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--older-than',
+            help='Purge events recorded before this age, in days (90 or 90d), weeks (12w) or hours (36h).')
+        parser.add_argument(
+            '--batch-size', type=int, default=1000, help='Number of events deleted per transaction.')
+        parser.add_argument(
+            '--sleep', type=float, default=0, help='Seconds to wait between batches.')
+        parser.add_argument(
+            '--archive', action='store_true', default=False,
+            help='Append the events to the monthly archive files before deleting them.')
+        parser.add_argument(
+            '--directory', help='Directory to write archive files to. Defaults to ACCOUNTS_AUDIT_LOG_ARCHIVE_DIR.')
+        parser.add_argument(
+            '--compact', action='store_true', default=False,
+            help='Reclaim the freed space afterwards (VACUUM on SQLite and PostgreSQL).')
+        parser.add_argument(
+            '--dry-run', action='store_true', default=False,
+            help='Report how many events would be purged without deleting anything.')
+
+    def handle(self, *args, **options):
+        if not signals.is_audit_log_configured():
+            raise django.core.management.base.CommandError('ACCOUNTS_AUDIT_LOG_EVENT_MODEL is not configured')
+        model = apps.get_model(settings.ACCOUNTS_AUDIT_LOG_EVENT_MODEL)
+
+        if not options['older_than']:
+            raise django.core.management.base.CommandError('Specify --older-than')
+        try:
+            cutoff = django.utils.timezone.now() - retention.parse_older_than(options['older_than'])
+        except ValueError:
+            raise django.core.management.base.CommandError(
+                '--older-than must be a number of days, or a number followed by h, d or w')
+        if options['batch_size'] < 1:
+            raise django.core.management.base.CommandError('--batch-size must be positive')
+
+        audit_log_archive = None
+        if options['archive']:
+            directory = options['directory'] or accountsplus_settings.get_audit_log_archive_dir()
+            if not directory:
+                raise django.core.management.base.CommandError(
+                    'Specify --directory or configure ACCOUNTS_AUDIT_LOG_ARCHIVE_DIR to archive events')
+            audit_log_archive = archive.AuditLogArchive(directory)
+
+        verb = 'Would purge' if options['dry_run'] else 'Purged'
+        total = 0
+        for first_id, last_id, count in retention.purge_batches(
+                model, cutoff, batch_size=options['batch_size'], sleep=options['sleep'], dry_run=options['dry_run'],
+                audit_log_archive=audit_log_archive):
+            total += count
+            if options['verbosity'] >= 2:
+                self.stdout.write('{} {} audit log events with ids {}-{} ({} in total)'.format(
+                    verb, count, first_id, last_id, total))
+        self.stdout.write('{} {} audit log events recorded before {}'.format(verb, total, cutoff.isoformat()))
+
+        if options['compact'] and not options['dry_run'] and total:
+            if retention.compact(model):
+                self.stdout.write('Compacted the audit log table')
+            else:
+                self.stdout.write('Compaction is not supported here, skipped')
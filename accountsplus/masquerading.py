@@ -0,0 +1,320 @@
+from __future__ import unicode_literals
+
+import contextlib
+import datetime
+import logging
+import time
+
+import django.contrib.auth
+import django.core.cache
+import django.core.signing
+import django.utils.crypto
+import django.utils.timezone
+from django.conf import settings as app_settings
+
+import settings
+
+
+logger = logging.getLogger(__name__)
+
+TOKEN_SALT = 'accountsplus.masquerading'
+SESSION_KEYS = (
+    'is_masquerading', 'masquerade_user_id', 'masquerade_user_email', 'return_page', 'masquerade_is_superuser',
+    'masquerade_id', )
+INDEX_CACHE_KEY = 'accountsplus:masquerades'
+INDEX_LOCK_CACHE_KEY = 'accountsplus:masquerades:lock'
+INDEX_LOCK_TIMEOUT = 5
+# how long a request waits for the lock of the index before leaving its update to the next one that gets it
+INDEX_LOCK_WAIT = 0.05
+PENDING_COUNTER_CACHE_KEY = 'accountsplus:masquerades:pending'
+PENDING_CACHE_KEY = 'accountsplus:masquerades:pending:{}'
+ENTRY_CACHE_KEY = 'accountsplus:masquerade:{}'
+ENDED_CACHE_KEY = 'accountsplus:masquerade_ended:{}'
+
+
+class Masquerade(object):
+    """
+    The state of a masquerade: the user masquerading, the page they started it from, its id in the registry of active
+    masquerades and, with masquerade tokens, the user they are masquerading as.
+    """
+    def __init__(self, user_id, user_email=None, is_superuser=False, return_page=None, masquerade_as_id=None,
+                 masquerade_id=None):
+        self.user_id = user_id
+        self.user_email = user_email
+        self.is_superuser = is_superuser
+        self.return_page = return_page
+        self.masquerade_as_id = masquerade_as_id
+        self.masquerade_id = masquerade_id
+
+
+def new_masquerade_id():
+    return django.utils.crypto.get_random_string(12)
+
+
+def get_masquerade(request):
+    """
+    Returns the Masquerade of a request, or None if the user isn't masquerading. With ACCOUNTS_MASQUERADE_TOKENS it
+    is the one MasqueradeMiddleware read from the masquerade token, otherwise it is read from the session.
+    """
+    if settings.get_masquerade_tokens():
+        return getattr(request, 'masquerade', None)
+    session = request.session
+    if not session.get('is_masquerading', False):
+        return None
+    return Masquerade(
+        session.get('masquerade_user_id'), session.get('masquerade_user_email'),
+        session.get('masquerade_is_superuser', False), session.get('return_page'),
+        masquerade_id=session.get('masquerade_id'))
+
+
+def start_session_masquerade(request, masquerade):
+    request.session['is_masquerading'] = True
+    request.session['masquerade_user_id'] = masquerade.user_id
+    request.session['masquerade_user_email'] = masquerade.user_email
+    request.session['return_page'] = masquerade.return_page
+    request.session['masquerade_is_superuser'] = masquerade.is_superuser
+    request.session['masquerade_id'] = masquerade.masquerade_id
+
+
+def end_session_masquerade(request):
+    for key in SESSION_KEYS:
+        request.session.pop(key, None)
+
+
+def dumps_token(masquerade, session_key):
+    """
+    Returns a compact signed token of a masquerade. The token is only valid with the session it was made for.
+    """
+    return django.core.signing.dumps({
+        'a': masquerade.user_id,
+        'e': masquerade.user_email,
+        's': int(masquerade.is_superuser),
+        'r': masquerade.return_page,
+        'u': masquerade.masquerade_as_id,
+        'i': masquerade.masquerade_id,
+    }, salt=TOKEN_SALT + session_key, compress=True)
+
+
+def loads_token(token, session_key):
+    """
+    Returns the Masquerade of a token, or None if the token is invalid, has expired or was made for another session.
+    Tokens expire after SESSION_COOKIE_AGE seconds.
+    """
+    try:
+        data = django.core.signing.loads(
+            token, salt=TOKEN_SALT + session_key, max_age=app_settings.SESSION_COOKIE_AGE)
+        return Masquerade(data['a'], data['e'], bool(data['s']), data['r'], data['u'], data['i'])
+    except (django.core.signing.BadSignature, KeyError, TypeError):
+        return None
+
+
+def get_token_masquerade(request):
+    """
+    Returns the Masquerade of the request's masquerade token if it is valid for the session and its user is the one
+    signed in, or None.
+    """
+    token = request.COOKIES.get(settings.get_masquerade_cookie_name())
+    session_key = request.session.session_key
+    if not token or not session_key:
+        return None
+    masquerade = loads_token(token, session_key)
+    if masquerade is None or '{}'.format(masquerade.user_id) != request.session.get(django.contrib.auth.SESSION_KEY):
+        return None
+    return masquerade
+
+
+def get_masquerade_as_user(request, masquerade):
+    """
+    Loads the user a masquerade token masquerades as through the session's authentication backend, or returns None
+    if the user no longer exists or is inactive.
+    """
+    try:
+        backend_path = request.session[django.contrib.auth.BACKEND_SESSION_KEY]
+    except KeyError:
+        return None
+    if backend_path not in app_settings.AUTHENTICATION_BACKENDS:
+        return None
+    user = django.contrib.auth.load_backend(backend_path).get_user(masquerade.masquerade_as_id)
+    if user is not None:
+        user.backend = backend_path
+    return user
+
+
+def set_token_cookie(request, response, masquerade):
+    response.set_cookie(
+        settings.get_masquerade_cookie_name(), dumps_token(masquerade, request.session.session_key),
+        max_age=app_settings.SESSION_COOKIE_AGE, path=app_settings.SESSION_COOKIE_PATH,
+        domain=app_settings.SESSION_COOKIE_DOMAIN, secure=app_settings.SESSION_COOKIE_SECURE or None,
+        httponly=True)
+
+
+def delete_token_cookie(response):
+    response.delete_cookie(
+        settings.get_masquerade_cookie_name(), path=app_settings.SESSION_COOKIE_PATH,
+        domain=app_settings.SESSION_COOKIE_DOMAIN)
+
+
+@contextlib.contextmanager
+def _locked_index():
+    """
+    Tries to take the lock of the index of active masquerades and yields whether it was taken. cache.add() is atomic,
+    so only one process at a time holds it; a lock left behind by a process that died expires after
+    INDEX_LOCK_TIMEOUT seconds. Requests don't wait for it for longer than INDEX_LOCK_WAIT seconds.
+    """
+    cache = django.core.cache.cache
+    token = django.utils.crypto.get_random_string(12)
+    deadline = time.time() + INDEX_LOCK_WAIT
+    locked = cache.add(INDEX_LOCK_CACHE_KEY, token, INDEX_LOCK_TIMEOUT)
+    while not locked and time.time() < deadline:
+        time.sleep(0.01)
+        locked = cache.add(INDEX_LOCK_CACHE_KEY, token, INDEX_LOCK_TIMEOUT)
+    try:
+        yield locked
+    finally:
+        if locked and cache.get(INDEX_LOCK_CACHE_KEY) == token:
+            cache.delete(INDEX_LOCK_CACHE_KEY)
+
+
+def _get_index():
+    """
+    Returns the ids in the index of active masquerades and the number of pending additions already merged into it.
+    """
+    index = django.core.cache.cache.get(INDEX_CACHE_KEY) or {}
+    return set(index.get('ids', ())), index.get('pending', 0)
+
+
+def _get_pending(merged):
+    """
+    Returns the masquerade ids of the pending additions that aren't merged into the index yet, the number of pending
+    additions that can be marked as merged (up to the first one that was counted but isn't recorded yet) and the
+    cache keys of those that can.
+    """
+    cache = django.core.cache.cache
+    count = cache.get(PENDING_COUNTER_CACHE_KEY) or 0
+    if count < merged:
+        # the counter expired, so every pending addition that is left is newer than the index
+        merged = 0
+    keys = [PENDING_CACHE_KEY.format(n) for n in range(merged + 1, count + 1)]
+    pending = cache.get_many(keys) if keys else {}
+    merged_keys = []
+    while merged < count and PENDING_CACHE_KEY.format(merged + 1) in pending:
+        merged += 1
+        merged_keys.append(PENDING_CACHE_KEY.format(merged))
+    return set(pending.values()), merged, merged_keys
+
+
+def _add_pending(masquerade_id):
+    """
+    Records a masquerade id that couldn't be added to the index because its lock was held. Reading the registry picks
+    it up, and the next update of the index merges it in.
+    """
+    cache = django.core.cache.cache
+    cache.add(PENDING_COUNTER_CACHE_KEY, 0, app_settings.SESSION_COOKIE_AGE)
+    try:
+        count = cache.incr(PENDING_COUNTER_CACHE_KEY)
+    except ValueError:
+        # the counter expired in between
+        cache.add(PENDING_COUNTER_CACHE_KEY, 0, app_settings.SESSION_COOKIE_AGE)
+        count = cache.incr(PENDING_COUNTER_CACHE_KEY)
+    cache.set(PENDING_CACHE_KEY.format(count), masquerade_id, app_settings.SESSION_COOKIE_AGE)
+
+
+def _update_index(add=(), remove=()):
+    """
+    Adds and removes masquerade ids from the index of active masquerades, merging the pending additions and dropping
+    the ids whose entries expired. Returns False if the lock of the index couldn't be taken, in which case the index
+    is left alone: ids whose entries are gone are filtered out when the registry is read anyway.
+    """
+    cache = django.core.cache.cache
+    with _locked_index() as locked:
+        if not locked:
+            return False
+        index, merged = _get_index()
+        pending, merged, merged_keys = _get_pending(merged)
+        index |= pending | set(add)
+        index.difference_update(remove)
+        if index:
+            existing = cache.get_many([get_entry_cache_key(masquerade_id) for masquerade_id in index])
+            index = set(masquerade_id for masquerade_id in index if get_entry_cache_key(masquerade_id) in existing)
+        # the index lives as long as a session, so it's gone by the time every masquerade in it has expired
+        cache.set(INDEX_CACHE_KEY, {'ids': index, 'pending': merged}, app_settings.SESSION_COOKIE_AGE)
+        if merged_keys:
+            cache.delete_many(merged_keys)
+        return True
+
+
+def get_entry_cache_key(masquerade_id):
+    return ENTRY_CACHE_KEY.format(masquerade_id)
+
+
+def get_registry():
+    """
+    Returns the registry of active masquerades, a dict of masquerade id to a dict with the masquerade's user_id,
+    user_email, masquerade_as_id, masquerade_as_email, started_on and expires_on. Every masquerade has a cache entry
+    of its own, listed by an index of their ids, so this reads the index, the ids that are waiting to be added to it
+    and the active masquerades' entries.
+    """
+    cache = django.core.cache.cache
+    index, merged = _get_index()
+    index |= _get_pending(merged)[0]
+    entries = cache.get_many([get_entry_cache_key(masquerade_id) for masquerade_id in index])
+    return dict((masquerade_id, entries[get_entry_cache_key(masquerade_id)]) for masquerade_id in index
+                if get_entry_cache_key(masquerade_id) in entries)
+
+
+def register(masquerade, masquerade_as):
+    """
+    Adds a masquerade that just started to the registry of active masquerades. It expires from the registry after
+    SESSION_COOKIE_AGE seconds, along with the session or token that carries it.
+    """
+    now = django.utils.timezone.now()
+    django.core.cache.cache.set(get_entry_cache_key(masquerade.masquerade_id), {
+        'user_id': masquerade.user_id,
+        'user_email': masquerade.user_email,
+        'masquerade_as_id': masquerade_as.pk,
+        'masquerade_as_email': masquerade_as.email,
+        'started_on': now,
+        'expires_on': now + datetime.timedelta(seconds=app_settings.SESSION_COOKIE_AGE),
+    }, app_settings.SESSION_COOKIE_AGE)
+    if not _update_index(add=[masquerade.masquerade_id]):
+        logger.warning('The masquerade registry is locked, masquerade {} is added to it later'.format(
+            masquerade.masquerade_id))
+        _add_pending(masquerade.masquerade_id)
+
+
+def unregister(masquerade_id):
+    django.core.cache.cache.delete(get_entry_cache_key(masquerade_id))
+    _update_index(remove=[masquerade_id])
+
+
+def active_masquerades():
+    """
+    Returns the active masquerades, oldest first, as dicts of the registry entry plus its id.
+    """
+    return sorted((dict(entry, id=masquerade_id) for masquerade_id, entry in get_registry().items()),
+                  key=lambda entry: entry['started_on'])
+
+
+def end_masquerades(masquerade_ids):
+    """
+    Ends active masquerades by id and returns how many this call ended. Their next request signs the masqueraded
+    user out of a session masquerade, or ignores the masquerade token.
+    """
+    cache = django.core.cache.cache
+    entries = cache.get_many([get_entry_cache_key(masquerade_id) for masquerade_id in masquerade_ids])
+    # adding the marker is atomic, so a masquerade ended by two admins at once is only counted once
+    ended = [masquerade_id for masquerade_id in masquerade_ids if get_entry_cache_key(masquerade_id) in entries and
+             cache.add(ENDED_CACHE_KEY.format(masquerade_id), True, app_settings.SESSION_COOKIE_AGE)]
+    if ended:
+        cache.delete_many([get_entry_cache_key(masquerade_id) for masquerade_id in ended])
+        _update_index(remove=ended)
+    return len(ended)
+
+
+def is_ended(masquerade):
+    """
+    Returns whether a masquerade was ended with end_masquerades().
+    """
+    if masquerade.masquerade_id is None:
+        return False
+    return django.core.cache.cache.get(ENDED_CACHE_KEY.format(masquerade.masquerade_id), False)
@@ -1,11 +1,128 @@
 from __future__ import unicode_literals
+import logging
+
+import django.contrib.auth
+import django.contrib.auth.models
+import django.contrib.auth.signals
+import django.utils.functional
 import django.utils.timezone
 from django.utils.deprecation import MiddlewareMixin
 
+import masquerading
+import settings
+import signals
+import timezones
+import writers
+
+
+logger = logging.getLogger(__name__)
+
 
 class TimezoneMiddleware(MiddlewareMixin):
+    """
+    Activates the timezone of the signed in user. With ACCOUNTS_SESSION_TIMEZONE, the timezone name is read from the
+    session instead of the user. With ACCOUNTS_LAZY_TIMEZONE, a LazyTimezone is activated instead, so the session
+    and the user are only loaded if the request converts a datetime.
+    """
     def process_request(self, request):
-        if request.user.is_authenticated() and request.user.timezone:
+        # a masquerade token doesn't change the session's user, so its timezone would be the wrong one
+        if settings.get_session_timezone() and getattr(request, 'masquerade', None) is None:
+            name = timezones.get_session_timezone_name(request)
+            if name:
+                django.utils.timezone.activate(timezones.get_timezone(name))
+            else:
+                django.utils.timezone.deactivate()
+        elif settings.get_lazy_timezone():
+            django.utils.timezone.activate(timezones.LazyTimezone(lambda: timezones.get_user_timezone(request.user)))
+        elif request.user.is_authenticated() and request.user.timezone:
             django.utils.timezone.activate(request.user.timezone)
         else:
             django.utils.timezone.deactivate()
+
+
+class MasqueradeMiddleware(MiddlewareMixin):
+    """
+    With ACCOUNTS_MASQUERADE_TOKENS, switches request.user to the user that a valid masquerade token masquerades as.
+    The session stays that of the user masquerading, so starting and ending a masquerade write nothing to it.
+
+    Masquerades ended with masquerading.end_masquerades() take effect here: the token is deleted, or the masqueraded
+    user is signed out of a session masquerade once the request's user is first used, and the end of the masquerade
+    is recorded for the user masquerading. Must come after AuthenticationMiddleware.
+    """
+    def process_request(self, request):
+        request.masquerade = None
+        if not settings.get_masquerade_tokens():
+            # an ended masquerade is only looked for once the user is needed, so requests that never touch the user
+            # don't load the session for it
+            session_user = request.user
+            request.user = django.utils.functional.SimpleLazyObject(
+                lambda: self.get_session_user(request, session_user))
+            return
+        masquerade = masquerading.get_token_masquerade(request)
+        if masquerade is None:
+            return
+        if masquerading.is_ended(masquerade):
+            # the session is the user masquerading's own, so only the token is dropped, in process_response
+            request.masquerade_ended = True
+            masquerade_as = masquerading.get_masquerade_as_user(request, masquerade)
+            if masquerade_as is not None:
+                signals.masquerade_end.send(
+                    sender=self.__class__, request=request, user=request.user, masquerade_as=masquerade_as)
+            return
+        request.masquerade = masquerade
+        session_user = request.user
+        request.user = django.utils.functional.SimpleLazyObject(
+            lambda: masquerading.get_masquerade_as_user(request, masquerade) or session_user)
+
+    def process_response(self, request, response):
+        if getattr(request, 'masquerade_ended', False):
+            masquerading.delete_token_cookie(response)
+        return response
+
+    def get_session_user(self, request, session_user):
+        request.user = session_user
+        masquerade = masquerading.get_masquerade(request)
+        if masquerade is not None and masquerading.is_ended(masquerade):
+            self.end_session_masquerade(request, masquerade)
+        return request.user
+
+    def end_session_masquerade(self, request, masquerade):
+        """
+        Signs the masqueraded user out of a session masquerade that was ended, the way the end_masquerade view does:
+        the sign out is recorded as part of the masquerade and the end of the masquerade for the user masquerading.
+        """
+        masquerade_as = request.user
+        if masquerade_as.is_authenticated():
+            django.contrib.auth.signals.user_logged_out.send(
+                sender=masquerade_as.__class__, request=request, user=masquerade_as)
+            masquerading.end_session_masquerade(request)
+            user = django.contrib.auth.get_user_model()._default_manager.filter(pk=masquerade.user_id).first()
+            if user is not None:
+                signals.masquerade_end.send(
+                    sender=self.__class__, request=request, user=user, masquerade_as=masquerade_as)
+        request.session.flush()
+        request.user = django.contrib.auth.models.AnonymousUser()
+
+
+class AuditLogMiddleware(MiddlewareMixin):
+    """
+    Collects the audit log events raised while handling a request and writes the ones whose transactions committed
+    with a single bulk insert once the response is ready. If that write fails, the events are handed to the buffered
+    writer to be written later rather than failing the response.
+    """
+    def process_request(self, request):
+        request.audit_log_collector = writers.AuditLogCollector()
+
+    def process_response(self, request, response):
+        collector = getattr(request, 'audit_log_collector', None)
+        if collector is not None:
+            try:
+                collector.flush()
+            except Exception:
+                logger.exception('Failed to write {} audit log events, queued them to be written later'.format(
+                    len(collector)))
+                writer = writers.get_buffered_writer()
+                for e in collector.events:
+                    writer.write(e)
+                collector.events = []
+        return response
@@ -16,6 +16,8 @@ from django.utils.encoding import python_2_unicode_compatible
 import timezone_field
 import localflavor.us.models
 
+import events
+
 logger = logging.getLogger(__name__)
 
 
@@ -148,32 +150,117 @@ class BaseUser(django.contrib.auth.base_user.AbstractBaseUser, django.contrib.au
 
 
 @python_2_unicode_compatible
-class BaseAuditLogEvent(django.db.models.Model):
+class AuditLogEventMixin(object):
+    """
+    Behavior shared by the audit log event base models.
+    """
+    def __str__(self):
+        if self.is_masquerading:
+            return '{} {} [{}] {}'.format(
+                self.recorded_on, self.user_email, self.masquerading_user_email, self.get_message())
+        else:
+            return '{} {} {}'.format(self.recorded_on, self.user_email, self.get_message())
+
+    def delete(self, using=None, keep_parents=False):
+        # events are never deleted one by one; the purge_audit_log command enforces retention
+        return
+
+    @property
+    def is_masquerading(self):
+        return self.masquerading_user_id > 0
+
+    @property
+    def data(self):
+        return events.loads_event_data(self.event_data)
+
+    def get_message(self):
+        """
+        Returns the free-text message of the event, or renders the message of a structured event from its type and
+        data.
+        """
+        if self.message or self.event_type is None:
+            return self.message
+        return events.render_message(self.event_type, self.data)
+
+
+class BaseAuditLogEvent(AuditLogEventMixin, django.db.models.Model):
     created_on = django.db.models.DateTimeField(auto_now_add=True)
     updated_on = django.db.models.DateTimeField(auto_now=True)
-    recorded_on = django.db.models.DateTimeField(auto_now_add=True)
+    # set when the event is raised rather than when it is inserted, so that buffered writes keep the event time
+    recorded_on = django.db.models.DateTimeField(
+        default=django.utils.timezone.now, editable=False, blank=True, db_index=True)
 
     user_id = django.db.models.IntegerField(_('User ID'), db_index=True)
     user_email = django.db.models.EmailField(_('User Email'), db_index=True)
     company_id = django.db.models.IntegerField(_('Company ID'), db_index=True, blank=True, null=True)
     company_name = django.db.models.CharField(_('Company Name'), max_length=100, db_index=True, blank=True)
 
-    message = django.db.models.TextField(_('Audit Message'))
+    event_type = django.db.models.PositiveSmallIntegerField(
+        _('Event Type'), choices=events.EVENT_TYPE_CHOICES, db_index=True, blank=True, null=True)
+    event_data = django.db.models.TextField(_('Event Data'), blank=True)
+    message = django.db.models.TextField(_('Audit Message'), blank=True)
+    occurrences = django.db.models.PositiveIntegerField(_('Occurrences'), default=1)
+    last_recorded_on = django.db.models.DateTimeField(_('Last Recorded On'), blank=True, null=True)
     masquerading_user_id = django.db.models.IntegerField(_('Masquerading User ID'), db_index=True, blank=True, null=True)
     masquerading_user_email = django.db.models.EmailField(_('Masquerading User Email'), db_index=True, blank=True)
 
     class Meta:
         abstract = True
 
-    def __str__(self):
-        if self.is_masquerading:
-            return '{} {} [{}] {}'.format(self.recorded_on, self.user_email, self.masquerading_user_email, self.message)
-        else:
-            return '{} {} {}'.format(self.recorded_on, self.user_email, self.message)
 
-    def delete(self, using=None, keep_parents=False):
-        return
+class BaseCompactAuditLogEvent(AuditLogEventMixin, django.db.models.Model):
+    """
+    A leaner alternative to BaseAuditLogEvent for large audit logs. Events are not edited, so only recorded_on is
+    kept (and last_recorded_on for coalesced events), and instead of an index on every column there are composite
+    indexes for reading a user's, a company's, a masquerading user's or an event type's events by time.
+    """
+    recorded_on = django.db.models.DateTimeField(
+        default=django.utils.timezone.now, editable=False, blank=True, db_index=True)
+
+    user_id = django.db.models.IntegerField(_('User ID'))
+    user_email = django.db.models.EmailField(_('User Email'))
+    company_id = django.db.models.IntegerField(_('Company ID'), blank=True, null=True)
+    company_name = django.db.models.CharField(_('Company Name'), max_length=100, blank=True)
+
+    event_type = django.db.models.PositiveSmallIntegerField(
+        _('Event Type'), choices=events.EVENT_TYPE_CHOICES, blank=True, null=True)
+    event_data = django.db.models.TextField(_('Event Data'), blank=True)
+    message = django.db.models.TextField(_('Audit Message'), blank=True)
+    occurrences = django.db.models.PositiveIntegerField(_('Occurrences'), default=1)
+    last_recorded_on = django.db.models.DateTimeField(_('Last Recorded On'), blank=True, null=True)
+    masquerading_user_id = django.db.models.IntegerField(_('Masquerading User ID'), blank=True, null=True)
+    masquerading_user_email = django.db.models.EmailField(_('Masquerading User Email'), blank=True)
 
-    @property
-    def is_masquerading(self):
-        return self.masquerading_user_id > 0
+    class Meta:
+        abstract = True
+        index_together = (
+            ('user_id', 'recorded_on', ),
+            ('company_id', 'recorded_on', ),
+            ('masquerading_user_id', 'recorded_on', ),
+            ('event_type', 'recorded_on', ),
+        )
+
+
+@python_2_unicode_compatible
+class BaseAuditLogRollup(django.db.models.Model):
+    """
+    Daily counts of structured audit log events per company and event type, kept current as events are written and
+    recomputed by the backfill_audit_log_rollups command. Days are in UTC, and events of users without a company are
+    counted with company_id 0.
+    """
+    date = django.db.models.DateField(_('Date'))
+    company_id = django.db.models.IntegerField(_('Company ID'), default=0)
+    event_type = django.db.models.PositiveSmallIntegerField(_('Event Type'), choices=events.EVENT_TYPE_CHOICES)
+    count = django.db.models.PositiveIntegerField(_('Count'), default=0)
+
+    class Meta:
+        abstract = True
+        unique_together = (
+            ('date', 'company_id', 'event_type', ),
+        )
+        index_together = (
+            ('company_id', 'date', ),
+        )
+
+    def __str__(self):
+        return '{} {} {} {}'.format(self.date, self.company_id, self.get_event_type_display(), self.count)
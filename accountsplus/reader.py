@@ -0,0 +1,66 @@
+from __future__ import unicode_literals
+
+import django.db.models
+from django.apps import apps
+from django.conf import settings
+
+import export
+
+
+def get_event_model():
+    """
+    Returns the model of ACCOUNTS_AUDIT_LOG_EVENT_MODEL, whether or not the audit log is enabled.
+    """
+    label = getattr(settings, 'ACCOUNTS_AUDIT_LOG_EVENT_MODEL', None)
+    if not label:
+        raise LookupError('ACCOUNTS_AUDIT_LOG_EVENT_MODEL is not configured')
+    return apps.get_model(label)
+
+
+def audit_events(user_id=None, company_id=None, masquerading_user_id=None, since=None, until=None,
+                 event_types=None, search=None, fields=None, newest_first=False, chunk_size=1000, model=None):
+    """
+    Yields the audit log events matching the filters (see export.filter_audit_events) in recorded_on order, oldest
+    first unless newest_first is set. With fields, events are dicts of only those fields; otherwise they are model
+    instances.
+
+    Events are read chunk_size at a time with a (recorded_on, id) keyset instead of an OFFSET, so memory use doesn't
+    grow with the number of events. Filtering by a single user, company, masquerading user or event type lets each
+    chunk be read from the matching (column, recorded_on) index of the compact event model.
+    """
+    model = model or get_event_model()
+    queryset = export.filter_audit_events(
+        model.objects.all(), user_id=user_id, company_id=company_id, masquerading_user_id=masquerading_user_id,
+        since=since, until=until, search=search, event_types=event_types)
+    if newest_first:
+        queryset = queryset.order_by('-recorded_on', '-id')
+    else:
+        queryset = queryset.order_by('recorded_on', 'id')
+    if fields is not None:
+        fields = tuple(fields)
+        # the keyset columns are fetched even if they aren't asked for
+        queryset = queryset.values(*(fields + tuple(f for f in ('recorded_on', 'id') if f not in fields)))
+
+    last = None
+    while True:
+        chunk = queryset if last is None else queryset.filter(_after(last, newest_first))
+        rows = list(chunk[:chunk_size])
+        for row in rows:
+            if fields is None:
+                yield row
+            else:
+                yield dict((f, row[f]) for f in fields)
+        if len(rows) < chunk_size:
+            return
+        last = rows[-1] if fields is not None else {'recorded_on': rows[-1].recorded_on, 'id': rows[-1].id}
+
+
+def _after(last, newest_first):
+    # the range condition on recorded_on alone lets the database seek in the index; the id breaks ties
+    if newest_first:
+        return django.db.models.Q(recorded_on__lte=last['recorded_on']) & (
+            django.db.models.Q(recorded_on__lt=last['recorded_on']) |
+            django.db.models.Q(id__lt=last['id']))
+    return django.db.models.Q(recorded_on__gte=last['recorded_on']) & (
+        django.db.models.Q(recorded_on__gt=last['recorded_on']) |
+        django.db.models.Q(id__gt=last['id']))
@@ -0,0 +1,93 @@
+from __future__ import unicode_literals
+
+import datetime
+import re
+import time
+
+import django.db
+import django.db.transaction
+
+import archive
+
+
+OLDER_THAN_RE = re.compile(r'^(\d+)([hdw]?)$')
+OLDER_THAN_UNITS = {'h': 'hours', 'd': 'days', 'w': 'weeks', '': 'days', }
+
+
+def parse_older_than(value):
+    """
+    Parses an age such as '90d', '12w' or '36h' into a timedelta. A bare number is a number of days.
+    """
+    match = OLDER_THAN_RE.match(value.strip())
+    if match is None:
+        raise ValueError('Invalid age {!r}'.format(value))
+    return datetime.timedelta(**{OLDER_THAN_UNITS[match.group(2)]: int(match.group(1))})
+
+
+def purge_batches(model, cutoff, batch_size=1000, sleep=0, dry_run=False, audit_log_archive=None):
+    """
+    Deletes the audit log events recorded before cutoff in batches of up to batch_size events, each bounded by a
+    primary key range and deleted in its own short transaction, sleeping for sleep seconds between batches. With an
+    AuditLogArchive the events of each batch are appended to their monthly partitions before they are deleted.
+
+    Yields (first_id, last_id, count) for every batch. With dry_run nothing is archived or deleted, and count is the
+    number of events that would have been.
+    """
+    using = django.db.router.db_for_write(model)
+    # the batches are selected on the database they are deleted from rather than on a replica
+    queryset = model.objects.using(using).filter(recorded_on__lt=cutoff)
+    # the ids of each partition archived by earlier runs that were interrupted before deleting them
+    archived_ids = {}
+    first_id = None
+    while True:
+        ids = queryset.order_by('id')
+        if first_id is not None:
+            ids = ids.filter(id__gt=first_id)
+        ids = list(ids.values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return
+        first_id, last_id = ids[0], ids[-1]
+        batch = queryset.filter(id__gte=first_id, id__lte=last_id)
+        if dry_run:
+            count = len(ids)
+        else:
+            with django.db.transaction.atomic(using=using):
+                if audit_log_archive is not None:
+                    archive_batch(audit_log_archive, batch.order_by('id'), archived_ids)
+                count = batch.delete()[0]
+        yield first_id, last_id, count
+        first_id = last_id
+        if sleep:
+            time.sleep(sleep)
+
+
+def archive_batch(audit_log_archive, events, archived_ids):
+    events_by_partition = {}
+    for e in events:
+        events_by_partition.setdefault(archive.partition_for(e.recorded_on), []).append(e)
+    for partition in sorted(events_by_partition):
+        if partition not in archived_ids:
+            archived_ids[partition] = audit_log_archive.archived_ids(partition)
+        events_to_archive = [e for e in events_by_partition[partition] if e.id not in archived_ids[partition]]
+        if events_to_archive:
+            audit_log_archive.append(partition, events_to_archive)
+            archived_ids[partition].add(e.id for e in events_to_archive)
+
+
+def compact(model):
+    """
+    Reclaims the space freed by purging on SQLite and PostgreSQL, and returns whether it did.
+    """
+    connection = django.db.connections[django.db.router.db_for_write(model)]
+    if connection.vendor == 'sqlite':
+        sql = 'VACUUM'
+    elif connection.vendor == 'postgresql':
+        sql = 'VACUUM ANALYZE {}'.format(connection.ops.quote_name(model._meta.db_table))
+    else:
+        return False
+    if connection.in_atomic_block:
+        # VACUUM can't run inside a transaction
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute(sql)
+    return True
@@ -0,0 +1,133 @@
+from __future__ import unicode_literals
+
+import collections
+import datetime
+
+import django.db
+import django.db.models
+import django.db.transaction
+import django.utils.timezone
+
+
+# the rollup model resolved by signals.configure_audit_log(); None while rollups are disabled
+_rollup_model = None
+
+
+def get_rollup_model():
+    return _rollup_model
+
+
+def set_rollup_model(model):
+    global _rollup_model
+    _rollup_model = model
+
+
+def rollup_date(recorded_on):
+    """
+    Returns the day an event is counted on. Days are in UTC, like the archive partitions, so that the counts don't
+    depend on the timezone that is active when the event is written.
+    """
+    if django.utils.timezone.is_aware(recorded_on):
+        recorded_on = recorded_on.astimezone(django.utils.timezone.utc)
+    return recorded_on.date()
+
+
+def count_events(events):
+    """
+    Returns the number of occurrences of structured events by (date, company_id, event_type). Events without an
+    event type are not counted.
+    """
+    counts = collections.Counter()
+    for e in events:
+        if e.event_type is not None:
+            counts[(rollup_date(e.recorded_on), e.company_id or 0, e.event_type)] += e.occurrences or 1
+    return counts
+
+
+def add_counts(counts, model=None):
+    """
+    Adds counts by (date, company_id, event_type) to the rollup rows, creating the rows that don't exist yet.
+    """
+    model = model or _rollup_model
+    if model is None or not counts:
+        return
+    using = django.db.router.db_for_write(model)
+    for (date, company_id, event_type), count in sorted(counts.items()):
+        if not count:
+            continue
+        rollup = model.objects.using(using).filter(date=date, company_id=company_id, event_type=event_type)
+        if rollup.update(count=django.db.models.F('count') + count):
+            continue
+        try:
+            with django.db.transaction.atomic(using=using):
+                model.objects.using(using).create(
+                    date=date, company_id=company_id, event_type=event_type, count=count)
+        except django.db.IntegrityError:
+            # another writer created the row first
+            rollup.update(count=django.db.models.F('count') + count)
+
+
+def record_events(events):
+    """
+    Counts events that were written to the database in the rollups.
+    """
+    if _rollup_model is not None:
+        add_counts(count_events(events))
+
+
+def rollup_day(event_model, date, model=None):
+    """
+    Recomputes the rollup rows of a day from the events in the event model's table, replacing any existing rows of
+    the day. Returns the number of rows written.
+    """
+    model = model or _rollup_model
+    start = datetime.datetime.combine(date, datetime.time()).replace(tzinfo=django.utils.timezone.utc)
+    totals = event_model.objects.using(django.db.router.db_for_write(event_model)).filter(
+        recorded_on__gte=start, recorded_on__lt=start + datetime.timedelta(days=1), event_type__isnull=False,
+    ).order_by().values_list('company_id', 'event_type').annotate(django.db.models.Sum('occurrences'))
+    counts = collections.Counter()
+    for company_id, event_type, count in totals:
+        counts[(company_id or 0, event_type)] += count
+    using = django.db.router.db_for_write(model)
+    with django.db.transaction.atomic(using=using):
+        model.objects.using(using).filter(date=date).delete()
+        model.objects.using(using).bulk_create([
+            model(date=date, company_id=company_id, event_type=event_type, count=count)
+            for (company_id, event_type), count in sorted(counts.items())])
+    return len(counts)
+
+
+def _filter_rollups(since, until, company_id=None, event_types=None, model=None):
+    model = model or _rollup_model
+    if model is None:
+        raise LookupError('ACCOUNTS_AUDIT_LOG_ROLLUP_MODEL is not configured')
+    queryset = model.objects.filter(date__gte=since, date__lt=until)
+    if company_id is not None:
+        queryset = queryset.filter(company_id=company_id)
+    if event_types is not None:
+        queryset = queryset.filter(event_type__in=event_types)
+    return queryset
+
+
+def daily_counts(since, until, company_id=None, event_types=None, model=None):
+    """
+    Returns an OrderedDict of {date: {event_type: count}} for the days in [since, until), optionally for one company
+    and some event types only. Days without events are included with no counts.
+    """
+    days = collections.OrderedDict()
+    for i in range((until - since).days):
+        days[since + datetime.timedelta(days=i)] = {}
+    totals = _filter_rollups(since, until, company_id, event_types, model).order_by().values_list(
+        'date', 'event_type').annotate(django.db.models.Sum('count'))
+    for date, event_type, count in totals:
+        days[date][event_type] = count
+    return days
+
+
+def total_counts(since, until, company_id=None, event_types=None, model=None):
+    """
+    Returns {event_type: count} summed over the days in [since, until).
+    """
+    totals = _filter_rollups(since, until, company_id, event_types, model).order_by().values_list(
+        'event_type').annotate(django.db.models.Sum('count'))
+    return dict(totals)
@@ -0,0 +1,54 @@
+from __future__ import unicode_literals
+
+import django.db
+from django.apps import apps
+
+import models
+import settings
+
+
+def is_audit_log_model(model):
+    return issubclass(model, (models.AuditLogEventMixin, models.BaseAuditLogRollup))
+
+
+class AuditLogRouter(object):
+    """
+    Sends the audit log event and rollup models to their own database. Writes and migrations go to
+    ACCOUNTS_AUDIT_LOG_DATABASE and reads (the admin, exports and the reader API) go to
+    ACCOUNTS_AUDIT_LOG_READ_DATABASE, a replica of it, if one is configured. Other models aren't migrated on either
+    database unless it is the default database.
+
+    Add it to DATABASE_ROUTERS ahead of any router that would otherwise claim the audit log models.
+    """
+    def db_for_read(self, model, **hints):
+        if is_audit_log_model(model):
+            return settings.get_audit_log_read_database() or settings.get_audit_log_database()
+        return None
+
+    def db_for_write(self, model, **hints):
+        if is_audit_log_model(model):
+            return settings.get_audit_log_database()
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        write_database = settings.get_audit_log_database()
+        read_database = settings.get_audit_log_read_database()
+        if read_database and db == read_database and read_database != write_database:
+            # the replica gets its tables from the database it replicates
+            return False
+        model = hints.get('model')
+        if model is None and model_name is not None:
+            try:
+                model = apps.get_model(app_label, model_name)
+            except LookupError:
+                return None
+        if model is None:
+            return None
+        if is_audit_log_model(model):
+            return db == write_database
+        if db == write_database and db != django.db.DEFAULT_DB_ALIAS:
+            return False
+        return None
@@ -0,0 +1,217 @@
+from __future__ import unicode_literals
+
+import logging
+
+import django.db
+import django.db.models
+import django.db.transaction
+import django.utils.module_loading
+
+import events
+import settings as accountsplus_settings
+import signals
+
+
+logger = logging.getLogger(__name__)
+
+# audit log event columns that are indexed for search
+SEARCH_COLUMNS = ('user_email', 'company_name', 'message', 'event_data', )
+
+# whether the index of a backend is installed, by backend class, database alias, database name and table
+_installed = {}
+
+
+class LikeSearchBackend(object):
+    """
+    Searches audit log events with LIKE '%term%' filters. It needs no index, so it works on every database, but every
+    search scans the audit log table.
+    """
+    def __init__(self, model, using):
+        self.model = model
+        self.using = using
+        self.connection = django.db.connections[using]
+        self.table = model._meta.db_table
+
+    def install(self):
+        return False
+
+    def is_installed(self):
+        """
+        Returns whether the index of the backend is installed. The answer is kept for the process once the
+        transaction it was read in commits, so searches don't look the index up again; an index installed by another
+        process is picked up when this one restarts.
+        """
+        key = self.get_installed_key()
+        try:
+            return _installed[key]
+        except KeyError:
+            installed = self.query_installed()
+            self.set_installed(installed)
+            return installed
+
+    def query_installed(self):
+        return True
+
+    def get_installed_key(self):
+        return (self.__class__, self.using, self.connection.settings_dict['NAME'], self.table)
+
+    def set_installed(self, installed):
+        key = self.get_installed_key()
+        django.db.transaction.on_commit(lambda: _installed.__setitem__(key, installed), using=self.using)
+
+    def match_sql(self, term):
+        """
+        Returns the SQL and params of a subquery that selects the ids of the events matching the search term, or None
+        if the backend filters with the ORM instead.
+        """
+        return None
+
+    def search(self, queryset, term):
+        term = term.strip()
+        if not term:
+            return queryset
+        # structured events don't store their message, so also match by the name of the event type
+        event_types = [t for t, label in events.EVENT_TYPE_CHOICES if term.lower() in label.lower()]
+        match_sql = self.match_sql(term) if self.is_installed() else None
+        if match_sql is None:
+            q = django.db.models.Q()
+            for column in SEARCH_COLUMNS:
+                q |= django.db.models.Q(**{'{}__icontains'.format(column): term})
+            if event_types:
+                q |= django.db.models.Q(event_type__in=event_types)
+            return queryset.filter(q)
+
+        qn = self.connection.ops.quote_name
+        sql, params = match_sql
+        where = '{}.{} IN ({})'.format(qn(self.table), qn('id'), sql)
+        if event_types:
+            where = '({} OR {}.{} IN ({}))'.format(
+                where, qn(self.table), qn('event_type'), ', '.join('%s' for t in event_types))
+            params = params + event_types
+        return queryset.extra(where=[where], params=params)
+
+
+class SQLiteSearchBackend(LikeSearchBackend):
+    """
+    Searches audit log events with an SQLite FTS5 index. The index is an external content table over the audit log
+    table that is kept in sync by triggers, so events written with save(), bulk_create() or raw SQL are all indexed.
+    """
+    @property
+    def index_table(self):
+        return '{}_search'.format(self.table)
+
+    def query_installed(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [self.index_table])
+            return cursor.fetchone() is not None
+
+    def install(self):
+        if self.is_installed():
+            return False
+        qn = self.connection.ops.quote_name
+        index_table = qn(self.index_table)
+        columns = ', '.join(qn(c) for c in SEARCH_COLUMNS)
+        new_values = ', '.join('new.{}'.format(qn(c)) for c in SEARCH_COLUMNS)
+        old_values = ', '.join('old.{}'.format(qn(c)) for c in SEARCH_COLUMNS)
+        delete = "INSERT INTO {}({}, rowid, {}) VALUES ('delete', old.id, {});".format(
+            index_table, index_table, columns, old_values)
+        insert = 'INSERT INTO {}(rowid, {}) VALUES (new.id, {});'.format(index_table, columns, new_values)
+        with self.connection.cursor() as cursor:
+            cursor.execute("CREATE VIRTUAL TABLE {} USING fts5({}, content={}, content_rowid='id')".format(
+                index_table, columns, qn(self.table)))
+            cursor.execute('CREATE TRIGGER {} AFTER INSERT ON {} BEGIN {} END'.format(
+                qn(self.index_table + '_insert'), qn(self.table), insert))
+            cursor.execute('CREATE TRIGGER {} AFTER DELETE ON {} BEGIN {} END'.format(
+                qn(self.index_table + '_delete'), qn(self.table), delete))
+            cursor.execute('CREATE TRIGGER {} AFTER UPDATE ON {} BEGIN {} {} END'.format(
+                qn(self.index_table + '_update'), qn(self.table), delete, insert))
+            # index the events written before the index existed
+            cursor.execute("INSERT INTO {}({}) VALUES ('rebuild')".format(index_table, index_table))
+        self.set_installed(True)
+        return True
+
+    def match_sql(self, term):
+        # every word of the term is matched as a quoted prefix phrase, so FTS5 query syntax in the term is ignored
+        query = ' '.join('"{}"*'.format(word.replace('"', '""')) for word in term.split())
+        index_table = self.connection.ops.quote_name(self.index_table)
+        return 'SELECT rowid FROM {} WHERE {} MATCH %s'.format(index_table, index_table), [query]
+
+
+class PostgreSQLSearchBackend(LikeSearchBackend):
+    """
+    Searches audit log events with a GIN full-text index on an expression over the searched columns, which
+    PostgreSQL keeps up to date on insert.
+    """
+    @property
+    def index_name(self):
+        return '{}_search'.format(self.table)
+
+    def document_sql(self):
+        qn = self.connection.ops.quote_name
+        columns = " || ' ' || ".join("coalesce({}, '')".format(qn(c)) for c in SEARCH_COLUMNS)
+        return "to_tsvector('simple', {})".format(columns)
+
+    def query_installed(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute('SELECT 1 FROM pg_indexes WHERE tablename = %s AND indexname = %s',
+                           [self.table, self.index_name])
+            return cursor.fetchone() is not None
+
+    def install(self):
+        if self.is_installed():
+            return False
+        qn = self.connection.ops.quote_name
+        with self.connection.cursor() as cursor:
+            cursor.execute('CREATE INDEX {} ON {} USING gin (({}))'.format(
+                qn(self.index_name), qn(self.table), self.document_sql()))
+        self.set_installed(True)
+        return True
+
+    def match_sql(self, term):
+        return "SELECT id FROM {} WHERE {} @@ plainto_tsquery('simple', %s)".format(
+            self.connection.ops.quote_name(self.table), self.document_sql()), [term]
+
+
+SEARCH_BACKENDS = {
+    'sqlite': SQLiteSearchBackend,
+    'postgresql': PostgreSQLSearchBackend,
+}
+
+
+def get_search_backend(model, using=None):
+    """
+    Returns the search backend for the audit log model on a database: ACCOUNTS_AUDIT_LOG_SEARCH_BACKEND if it is
+    configured, otherwise the native full-text backend of the database, falling back to LIKE filters.
+    """
+    using = using or django.db.router.db_for_read(model)
+    backend = accountsplus_settings.get_audit_log_search_backend()
+    if backend:
+        backend_class = django.utils.module_loading.import_string(backend)
+    else:
+        backend_class = SEARCH_BACKENDS.get(django.db.connections[using].vendor, LikeSearchBackend)
+    return backend_class(model, using)
+
+
+def search_audit_events(queryset, term):
+    return get_search_backend(queryset.model, queryset.db).search(queryset, term)
+
+
+def install_search_index(model, using=None):
+    """
+    Creates the search index of the audit log model and indexes the existing events. Returns False if the index
+    already existed or the backend doesn't use one.
+    """
+    return get_search_backend(model, using).install()
+
+
+def post_migrate_callback(sender, using=django.db.DEFAULT_DB_ALIAS, **kwargs):
+    """
+    Installs the search index of the configured audit log model once its table has been migrated. If the database
+    can't create the index, for example an SQLite built without FTS5, searches fall back to LIKE filters.
+    """
+    model = signals.get_audit_log_model()
+    if model is not None and django.db.router.allow_migrate_model(using, model):
+        try:
+            install_search_index(model, using)
+        except django.db.OperationalError:
+            logger.exception('Failed to install the audit log search index, searches will use LIKE filters')
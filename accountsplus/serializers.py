@@ -0,0 +1,46 @@
+from __future__ import unicode_literals
+
+import datetime
+import json
+
+import django.utils.dateparse
+
+
+def event_to_dict(event):
+    """
+    Returns the concrete field values of an audit log event as a JSON serializable dict. Datetimes are written in ISO
+    8601 format, keeping microseconds.
+    """
+    data = {}
+    for field in event._meta.concrete_fields:
+        value = getattr(event, field.attname)
+        if isinstance(value, (datetime.datetime, datetime.date)):
+            value = value.isoformat()
+        data[field.attname] = value
+    return data
+
+
+def event_from_dict(model, data):
+    """
+    Builds an unsaved audit log event of the given model from a dict created by event_to_dict(). Keys that are not
+    fields of the model are ignored.
+    """
+    values = {}
+    for field in model._meta.concrete_fields:
+        if field.attname not in data:
+            continue
+        value = data[field.attname]
+        if value is not None and field.get_internal_type() == 'DateTimeField':
+            value = django.utils.dateparse.parse_datetime(value)
+        values[field.attname] = value
+    return model(**values)
+
+
+def event_to_line(event):
+    """
+    Returns an audit log event as a line of JSON that records its model, so that it can be written back to the
+    database later.
+    """
+    data = event_to_dict(event)
+    data['model'] = event._meta.label
+    return json.dumps(data, sort_keys=True) + '\n'
@@ -44,6 +44,90 @@ def get_lockout_template():
     return get_setting('LOCKOUT_TEMPLATE_PATH', False, LOCKOUT_TEMPLATE)
 
 
+def get_audit_log_buffered():
+    return get_setting('ACCOUNTS_AUDIT_LOG_BUFFERED', False, False)
+
+
+def get_audit_log_batch_size():
+    return get_setting('ACCOUNTS_AUDIT_LOG_BATCH_SIZE', False, 100)
+
+
+def get_audit_log_flush_interval():
+    return get_setting('ACCOUNTS_AUDIT_LOG_FLUSH_INTERVAL', False, 5)
+
+
+def get_audit_log_queue_size():
+    return get_setting('ACCOUNTS_AUDIT_LOG_QUEUE_SIZE', False, 10000)
+
+
+def get_audit_log_archive_dir():
+    return get_setting('ACCOUNTS_AUDIT_LOG_ARCHIVE_DIR', False)
+
+
+def get_audit_log_hot_months():
+    return get_setting('ACCOUNTS_AUDIT_LOG_HOT_MONTHS', False, 3)
+
+
+def get_audit_log_coalesce_window():
+    return get_setting('ACCOUNTS_AUDIT_LOG_COALESCE_WINDOW', False, 0)
+
+
+def get_audit_log_coalesce_max_keys():
+    return get_setting('ACCOUNTS_AUDIT_LOG_COALESCE_MAX_KEYS', False, 10000)
+
+
+def get_audit_log_company_cache_timeout():
+    return get_setting('ACCOUNTS_AUDIT_LOG_COMPANY_CACHE_TIMEOUT', False, 300)
+
+
+def get_audit_log_database():
+    return get_setting('ACCOUNTS_AUDIT_LOG_DATABASE', False, 'default')
+
+
+def get_audit_log_read_database():
+    return get_setting('ACCOUNTS_AUDIT_LOG_READ_DATABASE', False)
+
+
+def get_audit_log_ingest_tokens():
+    return get_setting('ACCOUNTS_AUDIT_LOG_INGEST_TOKENS', False, ())
+
+
+def get_audit_log_rollup_model():
+    return get_setting('ACCOUNTS_AUDIT_LOG_ROLLUP_MODEL', False)
+
+
+def get_audit_log_search_backend():
+    return get_setting('ACCOUNTS_AUDIT_LOG_SEARCH_BACKEND', False)
+
+
+def get_audit_log_sinks():
+    return get_setting('ACCOUNTS_AUDIT_LOG_SINKS', False, {})
+
+
+def get_audit_log_spill_dir():
+    return get_setting('ACCOUNTS_AUDIT_LOG_SPILL_DIR', False)
+
+
+def get_audit_log_spool_dir():
+    return get_setting('ACCOUNTS_AUDIT_LOG_SPOOL_DIR', False)
+
+
+def get_lazy_timezone():
+    return get_setting('ACCOUNTS_LAZY_TIMEZONE', False, False)
+
+
+def get_session_timezone():
+    return get_setting('ACCOUNTS_SESSION_TIMEZONE', False, False)
+
+
+def get_masquerade_tokens():
+    return get_setting('ACCOUNTS_MASQUERADE_TOKENS', False, False)
+
+
+def get_masquerade_cookie_name():
+    return get_setting('ACCOUNTS_MASQUERADE_COOKIE_NAME', False, 'masquerade')
+
+
 ENABLE_LOCKOUT = bool(get_enable_lockout())
 if ENABLE_LOCKOUT:
     # Check if the required apps are installed
@@ -1,10 +1,22 @@
 from __future__ import unicode_literals
 
+import atexit
+
 import django.contrib.auth.signals
+import django.core.exceptions
+import django.core.signals
 from django.dispatch import receiver, Signal
 from django.conf import settings
 from django.apps import apps
 
+import companies
+import events
+import masquerading
+import rollups
+import settings as accountsplus_settings
+import sinks
+import writers
+
 
 def is_audit_log_enabled():
     return getattr(settings, 'ACCOUNTS_ENABLE_AUDIT_LOG', False)
@@ -14,37 +26,82 @@ def is_audit_log_configured():
     return hasattr(settings, 'ACCOUNTS_AUDIT_LOG_EVENT_MODEL')
 
 
-def log_audit_event(message, **kwargs):
-    if is_audit_log_enabled() and is_audit_log_configured():
+# audit log configuration resolved by configure_audit_log(); the model is None while the audit log is disabled
+_audit_log_model = None
+_audit_log_buffered = False
+_audit_log_sinks = None
+
+AUDIT_LOG_SETTINGS = (
+    'ACCOUNTS_ENABLE_AUDIT_LOG', 'ACCOUNTS_AUDIT_LOG_EVENT_MODEL', 'ACCOUNTS_AUDIT_LOG_BUFFERED',
+    'ACCOUNTS_AUDIT_LOG_COALESCE_WINDOW', 'ACCOUNTS_AUDIT_LOG_COALESCE_MAX_KEYS', 'ACCOUNTS_AUDIT_LOG_SINKS',
+    'ACCOUNTS_AUDIT_LOG_ROLLUP_MODEL', 'AUTH_USER_MODEL', )
+
+
+def get_audit_log_model():
+    return _audit_log_model
+
+
+def get_audit_log_sinks():
+    """
+    Returns the AuditLogFanout of the configured ACCOUNTS_AUDIT_LOG_SINKS, or None if events are written to the
+    database directly.
+    """
+    return _audit_log_sinks
+
+
+def log_audit_event(message='', event_type=None, event_data=None, **kwargs):
+    """
+    Records an audit log event for the user of a signal. Built-in events pass an event_type and a structured
+    event_data payload and leave the message to be rendered for display; custom events may pass a free-text message.
+    """
+    model = _audit_log_model
+    if model is not None:
         user = kwargs['user']
         request = kwargs['request']
-        is_masquerading = request.session.get('is_masquerading', False)
+        masquerade = masquerading.get_masquerade(request)
 
         if not user:
             return
 
-        model = apps.get_model(settings.ACCOUNTS_AUDIT_LOG_EVENT_MODEL)
-
         data = {
             'user_id': user.id,
             'user_email': user.email,
             'message': message,
+            'event_type': event_type,
+            'event_data': events.dumps_event_data(event_data),
         }
 
-        if hasattr(user, 'company'):
-            company = user.company
-            if company:
-                data['company_id'] = company.id
-                data['company_name'] = company.name
+        company_id, company_name = companies.get_user_company(user)
+        if company_id is not None:
+            data['company_id'] = company_id
+            data['company_name'] = company_name
 
         e = model(**data)
 
-        if is_masquerading:
-            masquerading_user = django.contrib.auth.get_user_model().objects.get(pk=request.session['masquerade_user_id'])
-            e.masquerading_user_id = masquerading_user.id
-            e.masquerading_user_email = masquerading_user.email
-
-        e.save()
+        if masquerade is not None:
+            e.masquerading_user_id = masquerade.user_id
+            masquerading_user_email = masquerade.user_email
+            if masquerading_user_email is None:
+                # masquerades started before the email was kept in the session need to look it up
+                masquerading_user = django.contrib.auth.get_user_model().objects.only('email').get(
+                    pk=e.masquerading_user_id)
+                masquerading_user_email = masquerading_user.email
+            e.masquerading_user_email = masquerading_user_email
+
+        # events written to the database, by a DatabaseSink too, are coalesced as they are written; other sinks get
+        # every event
+        if _audit_log_sinks is not None:
+            _audit_log_sinks.write(e)
+            return e
+
+        collector = getattr(request, 'audit_log_collector', None)
+        if isinstance(collector, writers.AuditLogCollector):
+            collector.add(e)
+        elif _audit_log_buffered:
+            writers.get_buffered_writer().write(e)
+        elif writers.coalesce_audit_events([e]):
+            e.save()
+            rollups.record_events([e])
         return e
 
 
@@ -61,73 +118,143 @@ user_activate = Signal(providing_args=['request', 'user'])
 company_name_change = Signal(providing_args=['request', 'company', 'old_name', 'new_name'])
 
 
-@receiver(django.contrib.auth.signals.user_logged_in)
 def login_callback(sender, **kwargs):
-    log_audit_event('Sign in', **kwargs)
+    log_audit_event(event_type=events.SIGN_IN, **kwargs)
 
 
-@receiver(django.contrib.auth.signals.user_logged_out)
 def logout_callback(sender, **kwargs):
-    log_audit_event('Sign out', **kwargs)
+    log_audit_event(event_type=events.SIGN_OUT, **kwargs)
 
 
-@receiver(masquerade_start)
 def masquerade_start_callback(sender, **kwargs):
     masquerade_as = kwargs['masquerade_as']
-    message = 'Masquerade start as {} ({})'.format(masquerade_as.email, masquerade_as.id)
-    log_audit_event(message, **kwargs)
+    event_data = {'masquerade_as_id': masquerade_as.id, 'masquerade_as_email': masquerade_as.email, }
+    log_audit_event(event_type=events.MASQUERADE_START, event_data=event_data, **kwargs)
 
 
-@receiver(masquerade_end)
 def masquerade_end_callback(sender, **kwargs):
     masquerade_as = kwargs['masquerade_as']
-    message = 'Masquerade end as {} ({})'.format(masquerade_as.email, masquerade_as.id)
-    log_audit_event(message, **kwargs)
+    event_data = {'masquerade_as_id': masquerade_as.id, 'masquerade_as_email': masquerade_as.email, }
+    log_audit_event(event_type=events.MASQUERADE_END, event_data=event_data, **kwargs)
 
 
-@receiver(user_password_reset_request)
 def password_reset_request_callback(sender, **kwargs):
-    log_audit_event('Request password reset', **kwargs)
+    log_audit_event(event_type=events.PASSWORD_RESET_REQUEST, **kwargs)
 
 
-@receiver(user_password_change)
 def password_change_callback(sender, **kwargs):
-    log_audit_event('Change password', **kwargs)
+    log_audit_event(event_type=events.PASSWORD_CHANGE, **kwargs)
 
 
-@receiver(user_create)
 def create_callback(sender, **kwargs):
     request = kwargs['request']
-    message = 'Create by: {} ({})'.format(request.user.email, request.user.id)
-    log_audit_event(message, **kwargs)
+    event_data = {'actor_id': request.user.id, 'actor_email': request.user.email, }
+    log_audit_event(event_type=events.USER_CREATE, event_data=event_data, **kwargs)
 
 
-@receiver(user_email_change)
 def email_change_callback(sender, **kwargs):
-    old_email = kwargs['old_email']
-    new_email = kwargs['new_email']
-    message = 'Email change from: {} to: {}'.format(old_email, new_email)
-    log_audit_event(message, **kwargs)
+    event_data = {'old_email': kwargs['old_email'], 'new_email': kwargs['new_email'], }
+    log_audit_event(event_type=events.EMAIL_CHANGE, event_data=event_data, **kwargs)
 
 
-@receiver(user_deactivate)
 def deactivate_callback(sender, **kwargs):
     request = kwargs['request']
-    message = 'Deactivate by: {} ({})'.format(request.user.email, request.user.id)
-    log_audit_event(message, **kwargs)
+    event_data = {'actor_id': request.user.id, 'actor_email': request.user.email, }
+    log_audit_event(event_type=events.USER_DEACTIVATE, event_data=event_data, **kwargs)
 
 
-@receiver(user_activate)
 def activate_callback(sender, **kwargs):
     request = kwargs['request']
-    message = 'Activate by: {} ({})'.format(request.user.email, request.user.id)
-    log_audit_event(message, **kwargs)
+    event_data = {'actor_id': request.user.id, 'actor_email': request.user.email, }
+    log_audit_event(event_type=events.USER_ACTIVATE, event_data=event_data, **kwargs)
 
 
-@receiver(company_name_change)
 def company_name_change_callback(sender, **kwargs):
     company = kwargs['company']
-    old_name = kwargs['old_name']
-    new_name = kwargs['new_name']
-    message = 'Company id: {} name change from: {} to: {}'.format(company.id, old_name, new_name)
-    log_audit_event(message, **kwargs)
+    companies.invalidate_company(company.id)
+    event_data = {'company_id': company.id, 'old_name': kwargs['old_name'], 'new_name': kwargs['new_name'], }
+    log_audit_event(event_type=events.COMPANY_NAME_CHANGE, event_data=event_data, **kwargs)
+
+
+AUDIT_LOG_RECEIVERS = (
+    (django.contrib.auth.signals.user_logged_in, login_callback),
+    (django.contrib.auth.signals.user_logged_out, logout_callback),
+    (masquerade_start, masquerade_start_callback),
+    (masquerade_end, masquerade_end_callback),
+    (user_password_reset_request, password_reset_request_callback),
+    (user_password_change, password_change_callback),
+    (user_create, create_callback),
+    (user_email_change, email_change_callback),
+    (user_deactivate, deactivate_callback),
+    (user_activate, activate_callback),
+    (company_name_change, company_name_change_callback),
+)
+
+
+def configure_audit_log():
+    """
+    Resolves the audit log model once and connects the audit log receivers if the audit log is enabled and
+    configured. Otherwise the receivers are disconnected so that the signals cost nothing to send.
+    """
+    global _audit_log_model, _audit_log_buffered, _audit_log_sinks
+    flush_audit_log()
+    companies.configure()
+    writers.set_coalescer(None)
+    _audit_log_sinks = None
+    rollups.set_rollup_model(None)
+    if is_audit_log_enabled() and is_audit_log_configured():
+        try:
+            _audit_log_model = apps.get_model(settings.ACCOUNTS_AUDIT_LOG_EVENT_MODEL)
+        except (LookupError, ValueError):
+            raise django.core.exceptions.ImproperlyConfigured(
+                'ACCOUNTS_AUDIT_LOG_EVENT_MODEL refers to model {} that is not installed'.format(
+                    settings.ACCOUNTS_AUDIT_LOG_EVENT_MODEL))
+        _audit_log_buffered = bool(accountsplus_settings.get_audit_log_buffered())
+        rollup_model = accountsplus_settings.get_audit_log_rollup_model()
+        if rollup_model:
+            try:
+                rollups.set_rollup_model(apps.get_model(rollup_model))
+            except (LookupError, ValueError):
+                raise django.core.exceptions.ImproperlyConfigured(
+                    'ACCOUNTS_AUDIT_LOG_ROLLUP_MODEL refers to model {} that is not installed'.format(rollup_model))
+        coalesce_window = accountsplus_settings.get_audit_log_coalesce_window()
+        if coalesce_window:
+            writers.set_coalescer(writers.AuditLogCoalescer(
+                window=coalesce_window, max_keys=accountsplus_settings.get_audit_log_coalesce_max_keys()))
+        sinks_config = accountsplus_settings.get_audit_log_sinks()
+        if sinks_config:
+            _audit_log_sinks = sinks.create_fanout(sinks_config)
+        for signal, callback in AUDIT_LOG_RECEIVERS:
+            signal.connect(callback)
+    else:
+        _audit_log_model = None
+        _audit_log_buffered = False
+        for signal, callback in AUDIT_LOG_RECEIVERS:
+            signal.disconnect(callback)
+
+
+def flush_audit_log_coalescer():
+    """
+    Writes the occurrences of the coalesced audit log events that are still counted in memory.
+    """
+    coalescer = writers.get_coalescer()
+    if coalescer is not None:
+        coalescer.flush()
+
+
+def flush_audit_log():
+    """
+    Sends the events queued in the audit log sinks, then writes the coalesced occurrences.
+    """
+    if _audit_log_sinks is not None:
+        _audit_log_sinks.flush()
+    flush_audit_log_coalescer()
+
+
+atexit.register(flush_audit_log)
+
+
+@receiver(django.core.signals.setting_changed)
+def audit_log_setting_changed_callback(sender, setting, **kwargs):
+    if setting in AUDIT_LOG_SETTINGS:
+        configure_audit_log()
@@ -0,0 +1,285 @@
+from __future__ import unicode_literals
+
+import fcntl
+import io
+import logging
+import os
+import socket
+import time
+
+import django.core.exceptions
+import django.utils.module_loading
+
+import serializers
+import settings
+import spool
+import writers
+
+
+logger = logging.getLogger(__name__)
+
+# what a sink does when an event is written while its queue is full
+DROP = 'drop'
+BLOCK = 'block'
+SPILL = 'spill'
+BACKPRESSURE_MODES = (DROP, BLOCK, SPILL, )
+
+
+class AuditLogSink(writers.BufferedAuditLogWriter):
+    """
+    Base class of audit log sinks. A sink queues events and sends them in batches like BufferedAuditLogWriter, and
+    keeps counters of what it sent, dropped and spilled and how long sending took. Subclasses implement send().
+
+    When the queue is full, the backpressure mode decides what happens to the new event: 'drop' drops the oldest
+    queued event, 'block' sends in the caller's thread for up to block_timeout seconds before dropping, and 'spill'
+    appends the queued events to an AuditLogSpool in spill_dir/<name>, which drain_audit_spool loads into the
+    database. With 'spill', batches that fail to send are spilled as well instead of being queued again.
+    """
+    # the batch size used when the sink's configuration has no BATCH_SIZE, None for ACCOUNTS_AUDIT_LOG_BATCH_SIZE
+    default_batch_size = None
+
+    def __init__(self, name, event_types=None, backpressure=DROP, block_timeout=1, spill_dir=None, **kwargs):
+        super(AuditLogSink, self).__init__(**kwargs)
+        if backpressure not in BACKPRESSURE_MODES:
+            raise django.core.exceptions.ImproperlyConfigured(
+                'Audit log sink {} has unknown backpressure mode {}'.format(name, backpressure))
+        if backpressure == SPILL and not spill_dir:
+            raise django.core.exceptions.ImproperlyConfigured(
+                'Audit log sink {} spills to disk but has no SPILL_DIR'.format(name))
+        self.name = name
+        self.event_types = frozenset(event_types) if event_types is not None else None
+        self.backpressure = backpressure
+        self.block_timeout = block_timeout
+        self.spill_dir = spill_dir
+        self.spill_spool = spool.AuditLogSpool(os.path.join(spill_dir, name)) if spill_dir else None
+        self.written = 0
+        self.spilled = 0
+        self.errors = 0
+        self.batches = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def __repr__(self):
+        return '<{} {}>'.format(self.__class__.__name__, self.name)
+
+    def accepts(self, event):
+        return self.event_types is None or event.event_type in self.event_types
+
+    def send(self, events):
+        raise NotImplementedError('subclasses of AuditLogSink must provide a send() method')
+
+    def write_batch(self, events):
+        start = time.time()
+        try:
+            self.send(events)
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            latency = time.time() - start
+            self.batches += 1
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+        self.written += len(events)
+        return len(events)
+
+    def handle_full_queue(self):
+        if self.backpressure == SPILL and self.spill(list(self.queue)):
+            self.queue.clear()
+            return
+        if self.backpressure == BLOCK:
+            deadline = time.time() + self.block_timeout
+            while len(self.queue) >= self.max_queue_size:
+                self.flush()
+                if len(self.queue) < self.max_queue_size or time.time() >= deadline:
+                    break
+                time.sleep(0.05)
+            if len(self.queue) < self.max_queue_size:
+                return
+        super(AuditLogSink, self).handle_full_queue()
+
+    def handle_failed_batch(self, events):
+        if self.backpressure == SPILL and self.spill(events):
+            return
+        super(AuditLogSink, self).handle_failed_batch(events)
+
+    def spill(self, events):
+        coalescer = writers.get_coalescer()
+        if self.coalesce and coalescer is not None:
+            # the spooled events are drained into the database later, with the occurrences counted so far
+            coalescer.release(events)
+        try:
+            self.spill_spool.append(events)
+        except (IOError, OSError):
+            logger.exception('Failed to spill {} audit log events of sink {}'.format(len(events), self.name))
+            return False
+        self.spilled += len(events)
+        return True
+
+    def stats(self):
+        return {
+            'queued': len(self.queue),
+            'written': self.written,
+            'dropped': self.dropped,
+            'spilled': self.spilled,
+            'errors': self.errors,
+            'batches': self.batches,
+            'average_latency': self.total_latency / self.batches if self.batches else 0.0,
+            'max_latency': self.max_latency,
+        }
+
+
+class DatabaseSink(AuditLogSink):
+    """
+    Writes audit log events to their model's table with one bulk_create per model. With
+    ACCOUNTS_AUDIT_LOG_COALESCE_WINDOW the events are coalesced as they are flushed, like those of the buffered writer.
+    """
+    def __init__(self, name, coalesce=True, **kwargs):
+        super(DatabaseSink, self).__init__(name, coalesce=coalesce, **kwargs)
+
+    def send(self, events):
+        writers.write_audit_events(events)
+
+
+class SpoolSink(AuditLogSink):
+    """
+    Appends every audit log event to an AuditLogSpool as it is raised, so that the request only pays for a local
+    append. The drain_audit_spool command loads the spooled events into the database.
+    """
+    default_batch_size = 1
+
+    def __init__(self, name, directory, segment_bytes=64 * 1024 * 1024, fsync_interval=1.0, **kwargs):
+        super(SpoolSink, self).__init__(name, **kwargs)
+        self.spool = spool.AuditLogSpool(directory, segment_bytes=segment_bytes, fsync_interval=fsync_interval)
+
+    def send(self, events):
+        self.spool.append(events)
+
+
+class RotatingFileSink(AuditLogSink):
+    """
+    Appends audit log events to a JSON Lines file. Once the file would grow past max_bytes it is renamed to
+    <path>.1 (shifting older files up to <path>.<backup_count>) and a new file is started.
+
+    Any number of processes can write to the same path: every append, and the rotation before it, is done holding an
+    exclusive lock on <path>.lock.
+    """
+    def __init__(self, name, path, max_bytes=10 * 1024 * 1024, backup_count=5, **kwargs):
+        super(RotatingFileSink, self).__init__(name, **kwargs)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+
+    @property
+    def lock_path(self):
+        return '{}.lock'.format(self.path)
+
+    def send(self, events):
+        data = ''.join(serializers.event_to_line(e) for e in events).encode('utf-8')
+        # the lock is taken on a file of its own since the log file is renamed when it rotates
+        with io.open(self.lock_path, 'ab') as lock:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            try:
+                if self.should_rotate(len(data)):
+                    self.rotate()
+                with io.open(self.path, 'ab') as f:
+                    f.write(data)
+            finally:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+    def should_rotate(self, size):
+        if not self.max_bytes or not self.backup_count or not os.path.exists(self.path):
+            return False
+        current_size = os.path.getsize(self.path)
+        return current_size > 0 and current_size + size > self.max_bytes
+
+    def rotate(self):
+        for i in range(self.backup_count - 1, 0, -1):
+            source = '{}.{}'.format(self.path, i)
+            if os.path.exists(source):
+                os.rename(source, '{}.{}'.format(self.path, i + 1))
+        os.rename(self.path, '{}.1'.format(self.path))
+
+
+class UnixSocketSink(AuditLogSink):
+    """
+    Sends audit log events as JSON Lines to a collector listening on a local UNIX stream socket. The connection is
+    opened on first use and again after an error.
+    """
+    def __init__(self, name, path, timeout=1.0, **kwargs):
+        super(UnixSocketSink, self).__init__(name, **kwargs)
+        self.path = path
+        self.timeout = timeout
+        self.socket = None
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.path)
+        except socket.error:
+            sock.close()
+            raise
+        return sock
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+    def send(self, events):
+        if self.socket is None:
+            self.socket = self.connect()
+        try:
+            self.socket.sendall(''.join(serializers.event_to_line(e) for e in events).encode('utf-8'))
+        except socket.error:
+            self.close()
+            raise
+
+
+class AuditLogFanout(object):
+    """
+    Writes each audit log event to every sink that accepts it.
+    """
+    def __init__(self, sinks):
+        self.sinks = list(sinks)
+
+    def __iter__(self):
+        return iter(self.sinks)
+
+    def write(self, event):
+        for sink in self.sinks:
+            if sink.accepts(event):
+                sink.write(event)
+
+    def flush(self):
+        return sum(sink.flush() for sink in self.sinks)
+
+    def stats(self):
+        return dict((sink.name, sink.stats()) for sink in self.sinks)
+
+
+def create_sink(name, config):
+    """
+    Creates a sink from an ACCOUNTS_AUDIT_LOG_SINKS entry. BACKEND is the dotted path of the sink class, OPTIONS are
+    passed to it, and the batching and backpressure keys default to the ACCOUNTS_AUDIT_LOG_* settings.
+    """
+    try:
+        sink_class = django.utils.module_loading.import_string(config['BACKEND'])
+    except (KeyError, ImportError) as e:
+        raise django.core.exceptions.ImproperlyConfigured(
+            'Audit log sink {} has an invalid BACKEND: {}'.format(name, e))
+    return sink_class(
+        name,
+        event_types=config.get('EVENT_TYPES'),
+        batch_size=config.get('BATCH_SIZE', sink_class.default_batch_size or settings.get_audit_log_batch_size()),
+        flush_interval=config.get('FLUSH_INTERVAL', settings.get_audit_log_flush_interval()),
+        max_queue_size=config.get('QUEUE_SIZE', settings.get_audit_log_queue_size()),
+        backpressure=config.get('BACKPRESSURE', DROP),
+        block_timeout=config.get('BLOCK_TIMEOUT', 1),
+        spill_dir=config.get('SPILL_DIR', settings.get_audit_log_spill_dir()),
+        **config.get('OPTIONS', {}))
+
+
+def create_fanout(sinks_config):
+    return AuditLogFanout(create_sink(name, sinks_config[name]) for name in sorted(sinks_config))
@@ -0,0 +1,225 @@
+from __future__ import unicode_literals
+
+import datetime
+import errno
+import fcntl
+import io
+import json
+import logging
+import mmap
+import os
+import threading
+import time
+
+import django.db
+import django.db.transaction
+from django.apps import apps
+
+import rollups
+import serializers
+
+
+logger = logging.getLogger(__name__)
+
+# fields that identify a spooled event, used to skip events that an interrupted drain already loaded
+NATURAL_KEY = ('recorded_on', 'user_id', 'event_type', 'event_data', 'message', 'masquerading_user_id', )
+# events whose natural keys are looked up per query, keeping the user ids and times under SQLite's 999 parameters
+LOOKUP_BATCH_SIZE = 400
+
+
+class AuditLogSpool(object):
+    """
+    A crash-safe, append-only spool of audit log events on local disk. Events are appended as JSON Lines to an
+    active segment that any number of processes can append to: every append takes an exclusive lock on the segment
+    and writes its events with a single write. Once the active segment reaches segment_bytes it is sealed by renaming
+    it to an immutable segment, and the next append starts a new active segment.
+
+    Appends are fsynced at most once every fsync_interval seconds (0 fsyncs every append). Events written before
+    the process dies are kept either way; the interval only bounds what an operating system crash can lose.
+    """
+    ACTIVE_SEGMENT = 'active.jsonl'
+
+    def __init__(self, directory, segment_bytes=64 * 1024 * 1024, fsync_interval=1.0):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync_interval = fsync_interval
+        self.lock = threading.Lock()
+        self.fd = None
+        self.last_fsync = 0
+
+    @property
+    def active_path(self):
+        return os.path.join(self.directory, self.ACTIVE_SEGMENT)
+
+    def append(self, events):
+        data = ''.join(serializers.event_to_line(e) for e in events).encode('utf-8')
+        if data:
+            self.append_data(data)
+        return len(events)
+
+    def append_data(self, data):
+        with self.lock:
+            while True:
+                fd = self._open()
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                if not self._is_active(fd):
+                    # another process sealed the segment after it was opened
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+                    self._close()
+                    continue
+                try:
+                    while data:
+                        data = data[os.write(fd, data):]
+                    if time.time() - self.last_fsync >= self.fsync_interval:
+                        os.fsync(fd)
+                        self.last_fsync = time.time()
+                    if self.segment_bytes and os.fstat(fd).st_size >= self.segment_bytes:
+                        self._seal(fd)
+                    return
+                finally:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def seal(self):
+        """
+        Seals the active segment if it has any events, so that they can be drained. Returns the sealed segment's
+        path, or None.
+        """
+        with self.lock:
+            try:
+                fd = os.open(self.active_path, os.O_WRONLY | os.O_APPEND)
+            except OSError as e:
+                if e.errno == errno.ENOENT:
+                    return None
+                raise
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                if not self._is_active(fd) or not os.fstat(fd).st_size:
+                    return None
+                return self._seal(fd)
+            finally:
+                os.close(fd)
+
+    def segments(self):
+        """
+        Returns the paths of the sealed segments, oldest first.
+        """
+        if not os.path.isdir(self.directory):
+            return []
+        return [os.path.join(self.directory, name) for name in sorted(os.listdir(self.directory))
+                if name.startswith('segment-') and name.endswith('.jsonl')]
+
+    def read_segment(self, path):
+        """
+        Yields the events of a sealed segment as dicts. A line torn by a crash in the middle of an append is skipped.
+        """
+        with io.open(path, 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                return
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for line in iter(data.readline, b''):
+                    try:
+                        if not line.endswith(b'\n'):
+                            raise ValueError('incomplete line')
+                        yield json.loads(line.decode('utf-8'))
+                    except ValueError:
+                        logger.error('Skipped an unreadable audit log event in spool segment {}'.format(path))
+            finally:
+                data.close()
+
+    def remove_segment(self, path):
+        os.remove(path)
+
+    def close(self):
+        with self.lock:
+            self._close()
+
+    def _open(self):
+        if self.fd is None:
+            if not os.path.isdir(self.directory):
+                try:
+                    os.makedirs(self.directory)
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+            self.fd = os.open(self.active_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o640)
+        return self.fd
+
+    def _close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def _is_active(self, fd):
+        try:
+            return os.stat(self.active_path).st_ino == os.fstat(fd).st_ino
+        except OSError:
+            return False
+
+    def _seal(self, fd):
+        # called with the segment locked
+        os.fsync(fd)
+        path = os.path.join(self.directory, 'segment-{}-{}.jsonl'.format(
+            datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S%f'), os.getpid()))
+        os.rename(self.active_path, path)
+        return path
+
+
+def load_events(model, rows):
+    """
+    Bulk inserts spooled events of a model, skipping those already in the table, and returns how many were inserted.
+    Only the rows of the events' users recorded at the events' times are read to find the ones already there.
+    """
+    events = [serializers.event_from_dict(model, dict(row, id=None)) for row in rows]
+    queryset = model.objects.using(django.db.router.db_for_write(model))
+    existing = set()
+    for i in range(0, len(events), LOOKUP_BATCH_SIZE):
+        batch = events[i:i + LOOKUP_BATCH_SIZE]
+        existing.update(queryset.filter(
+            user_id__in=set(e.user_id for e in batch), recorded_on__in=set(e.recorded_on for e in batch),
+        ).values_list(*NATURAL_KEY))
+    new_events = []
+    for e in events:
+        key = tuple(getattr(e, field) for field in NATURAL_KEY)
+        if key not in existing:
+            existing.add(key)
+            new_events.append(e)
+    model.objects.bulk_create(new_events)
+    rollups.record_events(new_events)
+    return len(new_events)
+
+
+def drain_spool(spool, default_model=None, chunk_size=1000):
+    """
+    Seals the active segment and loads the events of every sealed segment into the database, chunk_size events per
+    transaction. A segment is removed once all of its events are loaded; if draining is interrupted, events that
+    were already loaded are skipped when the segment is drained again. Returns the number of events inserted.
+    """
+    spool.seal()
+    count = 0
+    for path in spool.segments():
+        chunk = []
+        for row in spool.read_segment(path):
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                count += _load_chunk(chunk, default_model)
+                chunk = []
+        if chunk:
+            count += _load_chunk(chunk, default_model)
+        spool.remove_segment(path)
+    return count
+
+
+def _load_chunk(rows, default_model):
+    rows_by_model = {}
+    for row in rows:
+        label = row.pop('model', None)
+        model = apps.get_model(label) if label else default_model
+        if model is None:
+            raise LookupError('Spooled audit log event has no model')
+        rows_by_model.setdefault(model, []).append(row)
+    count = 0
+    for model, model_rows in rows_by_model.items():
+        with django.db.transaction.atomic(using=django.db.router.db_for_write(model)):
+            count += load_events(model, model_rows)
+    return count
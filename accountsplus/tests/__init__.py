@@ -0,0 +1,4 @@
+from __future__ import unicode_literals
+
+# registers the unit test models with the admin site for every test module that requests admin urls
+import test_admin  # noqa: F401
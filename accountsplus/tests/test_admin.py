@@ -1,12 +1,18 @@
 from __future__ import unicode_literals
 
+import django.core.cache
+import django.db
 import django.test
+import django.test.utils
 import django.contrib.admin
+import django.utils.timezone
 
+import datetime
 import logging
+import mock
 
-from .. import admin
-from test_models import (UnitTestCompany, UnitTestUser, UnitTestAuditLogEvent, )
+from .. import admin, companies
+from test_models import (UnitTestCompany, UnitTestUser, UnitTestAuditLogEvent, UnitTestCompactAuditLogEvent, )
 
 
 logging.disable(logging.CRITICAL)
@@ -25,3 +31,128 @@ class UnitTestUserAdmin(admin.BaseUserAdmin):
 @django.contrib.admin.register(UnitTestAuditLogEvent)
 class UnitTestAuditLogEventAdmin(admin.BaseAuditLogEventAdmin):
     pass
+
+
+@django.contrib.admin.register(UnitTestCompactAuditLogEvent)
+class UnitTestCompactAuditLogEventAdmin(admin.BaseCompactAuditLogEventAdmin):
+    pass
+
+
+@django.test.utils.override_settings(
+    AUTH_USER_MODEL='accountsplus.UnitTestUser',
+    ACCOUNTS_AUDIT_LOG_EVENT_MODEL='accountsplus.UnitTestAuditLogEvent',
+)
+class AuditLogEventAdminTestCase(django.test.TestCase):
+    url = '/admin/accountsplus/unittestauditlogevent/'
+
+    @classmethod
+    def setUpTestData(cls):
+        UnitTestUser.objects.create_superuser(
+            email='superuser@example.com', password='password', first_name='Super', last_name='User')
+        recorded_on = django.utils.timezone.now()
+        UnitTestAuditLogEvent.objects.bulk_create([
+            UnitTestAuditLogEvent(
+                user_id=i, user_email='user{}@example.com'.format(i), message='Sign in',
+                company_name='Example' if i % 2 else 'Other Company',
+                # pairs of events share a timestamp so that the cursor needs the id to break ties
+                recorded_on=recorded_on - datetime.timedelta(seconds=i // 2))
+            for i in range(120)])
+
+    def setUp(self):
+        # company names are cached, and ids are reused between tests
+        django.core.cache.cache.clear()
+        self.client.login(email='superuser@example.com', password='password')
+
+    def get_company_name_choices(self):
+        response = self.client.get(self.url)
+        spec = [f for f in response.context['cl'].filter_specs if isinstance(f, admin.CompanyNameListFilter)][0]
+        return [name for name, label in spec.lookup_choices]
+
+    def get_pages(self, url):
+        pages = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            cl = response.context['cl']
+            pages.append([e.user_id for e in cl.result_list])
+            url = self.url + cl.next_page_query_string if cl.next_cursor else None
+        return pages
+
+    def test_cursor_pagination(self):
+        pages = self.get_pages(self.url)
+        self.assertListEqual([len(page) for page in pages], [50, 50, 20])
+        # events are listed newest first without gaps or repeats
+        events = UnitTestAuditLogEvent.objects.order_by('-recorded_on', '-id').values_list('user_id', flat=True)
+        self.assertListEqual(sum(pages, []), list(events))
+
+    def test_cursor_pagination_with_filter_and_search(self):
+        pages = self.get_pages(self.url + '?company_name=Example&q=example.com')
+        self.assertListEqual([len(page) for page in pages], [50, 10])
+        self.assertTrue(all(user_id % 2 for user_id in sum(pages, [])))
+
+    def test_company_name_filter(self):
+        company = UnitTestCompany.objects.create(name='Example')
+        UnitTestCompany.objects.create(name='Another Company')
+        self.assertListEqual(self.get_company_name_choices(), ['Another Company', 'Example'])
+        # the names are cached, so the sidebar doesn't query the companies or the audit log table again
+        with django.test.utils.CaptureQueriesContext(django.db.connection) as queries:
+            self.get_company_name_choices()
+        self.assertFalse(any('DISTINCT' in q['sql'] or 'unittestcompany' in q['sql'] for q in queries))
+        company.name = 'Renamed'
+        company.save()
+        self.assertListEqual(self.get_company_name_choices(), ['Another Company', 'Renamed'])
+
+    def test_company_name_filter_without_company_model(self):
+        with self.settings(AUTH_USER_MODEL='auth.User'):
+            self.assertListEqual(
+                companies.get_company_names(UnitTestAuditLogEvent), ['Example', 'Other Company'])
+
+    def test_cursor_not_kept_by_filter_links(self):
+        response = self.client.get(self.url)
+        cl = response.context['cl']
+        response = self.client.get(self.url + cl.next_page_query_string)
+        cl = response.context['cl']
+        self.assertIsNotNone(cl.cursor)
+        self.assertNotIn(cl.CURSOR_VAR, cl.get_query_string({'company_name': 'Example'}))
+
+    def test_invalid_cursor(self):
+        response = self.client.get(self.url + '?cursor=invalid')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['cl'].result_list), 50)
+
+    def test_no_offset_queries(self):
+        response = self.client.get(self.url)
+        cl = response.context['cl']
+        with django.test.utils.CaptureQueriesContext(django.db.connection) as queries:
+            self.client.get(self.url + cl.next_page_query_string)
+        self.assertFalse(any('OFFSET' in q['sql'] for q in queries))
+
+    def test_estimated_count(self):
+        with mock.patch.object(admin.EstimatedCountPaginator, 'max_count', 100):
+            response = self.client.get(self.url)
+        cl = response.context['cl']
+        self.assertEqual(cl.result_count, 100)
+        self.assertTrue(cl.result_count_is_estimate)
+        self.assertContains(response, '100+')
+
+    def test_custom_ordering_uses_page_numbers(self):
+        response = self.client.get(self.url + '?o=2')
+        cl = response.context['cl']
+        self.assertFalse(cl.uses_cursor)
+        self.assertEqual(len(cl.result_list), 50)
+        self.assertEqual(cl.result_count, 120)
+
+
+@django.test.utils.override_settings(
+    AUTH_USER_MODEL='accountsplus.UnitTestUser',
+)
+class CompactAuditLogEventAdminTestCase(django.test.TestCase):
+    def test_changelist_and_change_view(self):
+        UnitTestUser.objects.create_superuser(
+            email='superuser@example.com', password='password', first_name='Super', last_name='User')
+        e = UnitTestCompactAuditLogEvent.objects.create(user_id=1, user_email='a@example.com', message='Sign in')
+        self.client.login(email='superuser@example.com', password='password')
+        response = self.client.get('/admin/accountsplus/unittestcompactauditlogevent/')
+        self.assertContains(response, 'a@example.com')
+        response = self.client.get('/admin/accountsplus/unittestcompactauditlogevent/{}/change/'.format(e.pk))
+        self.assertContains(response, 'Sign in')
@@ -0,0 +1,141 @@
+from __future__ import unicode_literals
+
+import datetime
+import logging
+import os
+import shutil
+import tempfile
+
+import django.core.management
+import django.test
+import django.test.utils
+import django.utils.six
+import django.utils.timezone
+import mock
+
+from .. import archive
+from test_models import (UnitTestAuditLogEvent, )
+
+
+logging.disable(logging.CRITICAL)
+
+
+def utc(*args):
+    return datetime.datetime(*args, tzinfo=django.utils.timezone.utc)
+
+
+class PartitionTestCase(django.test.SimpleTestCase):
+    def test_partition_for(self):
+        self.assertEqual(archive.partition_for(utc(2016, 1, 31, 23, 59)), '2016-01')
+        self.assertEqual(archive.partition_for(utc(2016, 12, 1)), '2016-12')
+
+    def test_partition_bounds(self):
+        self.assertEqual(archive.partition_bounds('2016-01'), (utc(2016, 1, 1), utc(2016, 2, 1)))
+        self.assertEqual(archive.partition_bounds('2016-12'), (utc(2016, 12, 1), utc(2017, 1, 1)))
+
+    def test_partitions_between(self):
+        self.assertListEqual(
+            archive.partitions_between(utc(2015, 11, 15), utc(2016, 2, 1)), ['2015-11', '2015-12', '2016-01'])
+        self.assertListEqual(archive.partitions_between(utc(2016, 1, 15), utc(2016, 1, 16)), ['2016-01'])
+
+    def test_partition_months_before(self):
+        self.assertEqual(archive.partition_months_before('2016-03', 2), '2016-01')
+        self.assertEqual(archive.partition_months_before('2016-03', 3), '2015-12')
+        self.assertEqual(archive.partition_months_before('2016-03', 15), '2014-12')
+
+
+@django.test.utils.override_settings(
+    ACCOUNTS_AUDIT_LOG_EVENT_MODEL='accountsplus.UnitTestAuditLogEvent',
+)
+class ArchiveTestCase(django.test.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.archive = archive.AuditLogArchive(self.directory)
+        for i, recorded_on in enumerate((utc(2016, 1, 5), utc(2016, 1, 20), utc(2016, 2, 10), utc(2016, 3, 1))):
+            UnitTestAuditLogEvent.objects.create(
+                user_id=i, user_email='user{}@example.com'.format(i), message='Sign in', recorded_on=recorded_on)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def archive_audit_log(self, **options):
+        out = django.utils.six.StringIO()
+        django.core.management.call_command('archive_audit_log', directory=self.directory, stdout=out, **options)
+        return out.getvalue()
+
+    def test_append_and_read(self):
+        self.archive.append('2016-01', UnitTestAuditLogEvent.objects.filter(user_id=0))
+        self.archive.append('2016-01', UnitTestAuditLogEvent.objects.filter(user_id=1))
+        self.assertListEqual(self.archive.partitions(), ['2016-01'])
+        events = list(self.archive.read('2016-01'))
+        self.assertListEqual([e['user_id'] for e in events], [0, 1])
+        self.assertEqual(events[0]['recorded_on'], '2016-01-05T00:00:00+00:00')
+        self.assertEqual(self.archive.last_id('2016-01'), events[1]['id'])
+
+    def test_archived_ids(self):
+        self.archive.append('2016-01', UnitTestAuditLogEvent.objects.filter(user_id=2))
+        self.archive.append('2016-01', UnitTestAuditLogEvent.objects.filter(user_id=0))
+        ids = dict(UnitTestAuditLogEvent.objects.values_list('user_id', 'id'))
+        # the ids are read without decompressing the partition, and only the ids written count as archived
+        with mock.patch.object(archive.gzip, 'GzipFile', side_effect=AssertionError):
+            archived_ids = self.archive.archived_ids('2016-01')
+        self.assertListEqual([i in archived_ids for i in (ids[0], ids[1], ids[2])], [True, False, True])
+        self.assertEqual(len(archived_ids), 2)
+        self.assertEqual(self.archive.last_id('2016-01'), ids[2])
+        # partitions archived before the ids were kept are read
+        os.remove(self.archive.ids_path('2016-01'))
+        self.assertListEqual(self.archive.archived_ids('2016-01').ranges, [[ids[0], ids[0]], [ids[2], ids[2]]])
+        self.assertIsNone(self.archive.last_id('2016-02'))
+
+    def test_archived_ids_interrupted_append(self):
+        self.archive.append('2016-01', UnitTestAuditLogEvent.objects.filter(user_id=0))
+        # the events of an append interrupted before its ids were written are read from the partition
+        with mock.patch.object(self.archive, 'write_archived_ids'):
+            self.archive.append('2016-01', UnitTestAuditLogEvent.objects.filter(user_id=1))
+        self.assertEqual(len(self.archive.archived_ids('2016-01')), 2)
+        self.assertEqual(self.archive.last_id('2016-01'), UnitTestAuditLogEvent.objects.get(user_id=1).id)
+
+    def test_archived_id_ranges(self):
+        archived_ids = archive.ArchivedIds([[5, 6]])
+        archived_ids.add([1, 2, 3, 7, 10])
+        self.assertListEqual(archived_ids.ranges, [[1, 3], [5, 7], [10, 10]])
+        self.assertListEqual([i for i in range(12) if i in archived_ids], [1, 2, 3, 5, 6, 7, 10])
+
+    def test_archive_command(self):
+        self.archive_audit_log(before='2016-03')
+        self.assertListEqual(self.archive.partitions(), ['2016-01', '2016-02'])
+        self.assertListEqual(list(UnitTestAuditLogEvent.objects.values_list('user_id', flat=True)), [3])
+        self.assertListEqual([e['user_id'] for e in self.archive.events()], [0, 1, 2])
+        self.assertListEqual([e['user_id'] for e in self.archive.events(since=utc(2016, 1, 10))], [1, 2])
+
+        # running again is a no-op
+        self.assertIn('No audit log events', self.archive_audit_log(before='2016-03'))
+        self.assertListEqual([e['user_id'] for e in self.archive.events()], [0, 1, 2])
+
+    def test_archive_command_resumes_interrupted_run(self):
+        # events that were archived but not deleted are not archived twice
+        self.archive.append('2016-01', UnitTestAuditLogEvent.objects.filter(user_id=0))
+        self.archive_audit_log(before='2016-02', chunk_size=1)
+        self.assertListEqual([e['user_id'] for e in self.archive.events()], [0, 1])
+        self.assertEqual(UnitTestAuditLogEvent.objects.count(), 2)
+
+    def test_archive_command_after_partial_archive(self):
+        # an event with a lower id than one already archived, by a purge with a cutoff in the month, is archived
+        self.archive.append('2016-01', UnitTestAuditLogEvent.objects.filter(user_id=1))
+        UnitTestAuditLogEvent.objects.filter(user_id=1).delete()
+        self.archive_audit_log(before='2016-02')
+        self.assertListEqual(sorted(e['user_id'] for e in self.archive.read('2016-01')), [0, 1])
+
+    def test_archive_command_invalid_before(self):
+        self.assertRaises(django.core.management.CommandError, self.archive_audit_log, before='2016')
+
+    def test_router(self):
+        self.archive_audit_log(before='2016-02')
+        router = archive.AuditLogPartitionRouter(UnitTestAuditLogEvent, self.archive)
+        self.assertListEqual(
+            [e['user_id'] for e in router.events(utc(2016, 1, 10), utc(2016, 3, 2))], [1, 2, 3])
+        self.assertListEqual([e['user_id'] for e in router.events(utc(2016, 2, 1), utc(2016, 3, 1))], [2])
+
+        # only the hot table is queried for a range that has no archived partitions
+        with self.assertNumQueries(1):
+            self.assertListEqual([e['user_id'] for e in router.events(utc(2016, 3, 1), utc(2016, 4, 1))], [3])
@@ -0,0 +1,95 @@
+from __future__ import unicode_literals
+
+import csv
+import datetime
+import json
+import logging
+
+import django.test
+import django.test.utils
+import django.utils.six
+import django.utils.timezone
+
+from .. import export
+from test_models import (UnitTestUser, UnitTestAuditLogEvent, )
+
+
+logging.disable(logging.CRITICAL)
+
+
+@django.test.utils.override_settings(
+    AUTH_USER_MODEL='accountsplus.UnitTestUser',
+    ACCOUNTS_AUDIT_LOG_EVENT_MODEL='accountsplus.UnitTestAuditLogEvent',
+)
+class ExportTestCase(django.test.TestCase):
+    url = '/admin/accountsplus/unittestauditlogevent/export/'
+
+    @classmethod
+    def setUpTestData(cls):
+        UnitTestUser.objects.create_superuser(
+            email='superuser@example.com', password='password', first_name='Super', last_name='User')
+        UnitTestUser.objects.create_user(
+            email='staffuser@example.com', password='password', first_name='Staff', last_name='User', is_staff=True)
+        cls.now = django.utils.timezone.now()
+        for i in range(10):
+            UnitTestAuditLogEvent.objects.create(
+                user_id=i % 3, user_email='user{}@example.com'.format(i % 3), message='Event {}'.format(i),
+                company_id=1 if i < 5 else 2, company_name='Example' if i < 5 else 'Other Company',
+                masquerading_user_id=1 if i == 9 else None, recorded_on=cls.now - datetime.timedelta(days=10 - i))
+
+    def read_response(self, response):
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return b''.join(response.streaming_content).decode('utf-8')
+
+    def test_iter_audit_events(self):
+        with self.assertNumQueries(4):
+            rows = list(export.iter_audit_events(UnitTestAuditLogEvent.objects.all(), ('message', ), chunk_size=3))
+        self.assertListEqual(rows, [('Event {}'.format(i), ) for i in range(10)])
+
+    def test_filter_audit_events(self):
+        queryset = UnitTestAuditLogEvent.objects.all()
+        self.assertEqual(export.filter_audit_events(queryset, user_id=0).count(), 4)
+        self.assertEqual(export.filter_audit_events(queryset, user_id=0, company_id=2).count(), 2)
+        self.assertEqual(export.filter_audit_events(queryset, masquerading_user_id=1).count(), 1)
+        since = self.now - datetime.timedelta(days=5)
+        until = self.now - datetime.timedelta(days=2)
+        self.assertEqual(export.filter_audit_events(queryset, since=since, until=until).count(), 3)
+        self.assertEqual(export.filter_audit_events(queryset, event_types=[]).count(), 0)
+
+    def test_export_csv(self):
+        self.client.login(email='superuser@example.com', password='password')
+        response = self.client.get(self.url, {'company_id': 1})
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="audit-log.csv"')
+        content = self.read_response(response)
+        rows = list(csv.reader(django.utils.six.StringIO(str(content))))
+        self.assertListEqual(rows[0], list(export.EXPORT_FIELDS))
+        self.assertListEqual([r[-1] for r in rows[1:]], ['Event {}'.format(i) for i in range(5)])
+
+    def test_export_jsonl(self):
+        self.client.login(email='superuser@example.com', password='password')
+        since = (self.now - datetime.timedelta(days=3, hours=12)).strftime('%Y-%m-%d %H:%M:%S')
+        response = self.client.get(self.url, {'format': 'jsonl', 'user_id': 1, 'since': since})
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        events = [json.loads(line) for line in self.read_response(response).splitlines()]
+        self.assertListEqual([e['message'] for e in events], ['Event 7'])
+        self.assertEqual(events[0]['company_name'], 'Other Company')
+
+    def test_export_invalid_filter(self):
+        self.client.login(email='superuser@example.com', password='password')
+        response = self.client.get(self.url, {'user_id': 'x'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_export_permission(self):
+        self.client.login(email='staffuser@example.com', password='password')
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 403)
+
+    def test_export_action(self):
+        self.client.login(email='superuser@example.com', password='password')
+        ids = UnitTestAuditLogEvent.objects.filter(user_id=2).values_list('id', flat=True)
+        response = self.client.post('/admin/accountsplus/unittestauditlogevent/', {
+            'action': 'export_as_jsonl', '_selected_action': [str(pk) for pk in ids], })
+        events = [json.loads(line) for line in self.read_response(response).splitlines()]
+        self.assertListEqual([e['message'] for e in events], ['Event 2', 'Event 5', 'Event 8'])
@@ -0,0 +1,108 @@
+from __future__ import unicode_literals
+
+import datetime
+import json
+import logging
+import os
+import tempfile
+
+import django.core.management
+import django.test
+import django.test.utils
+import django.utils.six
+import django.utils.timezone
+
+from .. import events, ingest
+from test_models import (UnitTestAuditLogEvent, )
+
+
+logging.disable(logging.CRITICAL)
+
+
+def ndjson(*rows):
+    return ''.join((row if isinstance(row, django.utils.six.string_types) else json.dumps(row)) + '\n'
+                   for row in rows).encode('utf-8')
+
+
+EVENTS = ndjson(
+    {'user_id': 1, 'user_email': 'a@example.com', 'event_type': events.SIGN_IN, 'company_id': 3,
+     'recorded_on': '2016-01-01T10:00:00+00:00'},
+    {'user_id': 2, 'user_email': 'not an email', 'event_type': events.SIGN_IN},
+    '{"user_id": 3',
+    '',
+    {'user_id': 3, 'user_email': 'c@example.com', 'message': 'Exported the billing report',
+     'event_data': {'report': 'billing'}},
+    {'user_id': 4, 'user_email': 'd@example.com'},
+    {'user_id': 5, 'user_email': 'e@example.com', 'event_type': 999},
+    ['not', 'an', 'object'],
+)
+
+
+@django.test.utils.override_settings(
+    AUTH_USER_MODEL='accountsplus.UnitTestUser',
+    ACCOUNTS_AUDIT_LOG_EVENT_MODEL='accountsplus.UnitTestAuditLogEvent',
+    ACCOUNTS_ENABLE_AUDIT_LOG=True,
+    ACCOUNTS_AUDIT_LOG_INGEST_TOKENS=['secret'],
+)
+class IngestTestCase(django.test.TestCase):
+    url = '/audit-log/ingest/'
+
+    def post(self, body, token='secret'):
+        headers = {'HTTP_AUTHORIZATION': 'Bearer {}'.format(token)} if token else {}
+        return self.client.post(self.url, body, content_type='application/x-ndjson', **headers)
+
+    def test_ingest_events(self):
+        result = ingest.ingest_events(EVENTS.splitlines(True), UnitTestAuditLogEvent, chunk_size=1)
+        self.assertEqual(result.accepted, 2)
+        self.assertEqual(result.rejected, 5)
+        self.assertListEqual([e['line'] for e in result.errors], [2, 3, 6, 7, 8])
+        self.assertIn('user_email', result.errors[0]['errors'])
+        self.assertIn('event_type', result.errors[3]['errors'])
+        e = UnitTestAuditLogEvent.objects.get(user_id=1)
+        self.assertEqual(e.recorded_on, datetime.datetime(2016, 1, 1, 10, tzinfo=django.utils.timezone.utc))
+        self.assertEqual(e.company_id, 3)
+        e = UnitTestAuditLogEvent.objects.get(user_id=3)
+        self.assertEqual(e.get_message(), 'Exported the billing report')
+        self.assertDictEqual(e.data, {'report': 'billing'})
+
+    def test_max_errors(self):
+        result = ingest.ingest_events(EVENTS.splitlines(True), UnitTestAuditLogEvent, max_errors=2)
+        self.assertEqual(result.rejected, 5)
+        self.assertEqual(len(result.errors), 2)
+
+    def test_endpoint(self):
+        # the batch is inserted with one bulk insert
+        with self.assertNumQueries(1):
+            response = self.post(EVENTS)
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(data['accepted'], 2)
+        self.assertEqual(data['rejected'], 5)
+        self.assertEqual(data['errors'][0]['line'], 2)
+        self.assertEqual(UnitTestAuditLogEvent.objects.count(), 2)
+
+    def test_endpoint_authentication(self):
+        self.assertEqual(self.post(EVENTS, token=None).status_code, 401)
+        response = self.post(EVENTS, token='wrong')
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response['WWW-Authenticate'], 'Bearer')
+        self.assertEqual(self.client.get(self.url, HTTP_AUTHORIZATION='Bearer secret').status_code, 405)
+        self.assertEqual(UnitTestAuditLogEvent.objects.count(), 0)
+
+    @django.test.utils.override_settings(ACCOUNTS_ENABLE_AUDIT_LOG=False)
+    def test_endpoint_audit_log_disabled(self):
+        self.assertEqual(self.post(EVENTS).status_code, 404)
+
+    def test_command(self):
+        fd, path = tempfile.mkstemp(suffix='.jsonl')
+        self.addCleanup(os.remove, path)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(EVENTS)
+        out = django.utils.six.StringIO()
+        err = django.utils.six.StringIO()
+        django.core.management.call_command('ingest_audit_events', path, stdout=out, stderr=err)
+        self.assertIn('Ingested 2 audit log events, rejected 5', out.getvalue())
+        self.assertIn('Line 2: user_email:', err.getvalue())
+        self.assertEqual(UnitTestAuditLogEvent.objects.count(), 2)
+        self.assertRaises(django.core.management.CommandError, django.core.management.call_command,
+                          'ingest_audit_events', path + '.missing')
@@ -1,13 +1,24 @@
+import datetime
 import logging
 
+import django.contrib.auth.middleware
+import django.contrib.auth.models
+import django.contrib.sessions.middleware
+import django.core.cache
+import django.db
+import django.db.transaction
+import django.http
 import django.test
 import django.test.client
+import django.utils.functional
 import django.utils.timezone
+from django.conf import settings
 
+import mock
 import pytz
 
-from .. import middleware
-from test_models import (UnitTestCompany, UnitTestUser, )
+from .. import middleware, signals, timezones, writers
+from test_models import (UnitTestCompany, UnitTestUser, UnitTestAuditLogEvent, )
 
 
 logging.disable(logging.CRITICAL)
@@ -42,3 +53,163 @@ class TimezoneMiddlewareTestCase(django.test.TestCase):
 
         tz_middleware.process_request(request)
         self.assertEqual(django.utils.timezone.get_current_timezone(), user.timezone)
+
+    @django.test.utils.override_settings(ACCOUNTS_LAZY_TIMEZONE=True)
+    def test_process_request_lazy(self):
+        self.addCleanup(django.utils.timezone.deactivate)
+        factory = django.test.client.RequestFactory()
+        user = UnitTestUser.objects.get(pk=1)
+        user.timezone = pytz.timezone('Asia/Singapore')
+        user.save()
+
+        request = factory.get('/admin/')
+        request.user = django.utils.functional.SimpleLazyObject(lambda: UnitTestUser.objects.get(pk=1))
+        tz_middleware = middleware.TimezoneMiddleware()
+        # the user is only loaded once a datetime is converted
+        with self.assertNumQueries(0):
+            tz_middleware.process_request(request)
+        value = datetime.datetime(2016, 1, 1, 12, 0, tzinfo=pytz.utc)
+        with self.assertNumQueries(1):
+            local_value = django.utils.timezone.localtime(value)
+        self.assertEqual(local_value.replace(tzinfo=None), datetime.datetime(2016, 1, 1, 20, 0))
+        self.assertEqual(local_value.utcoffset(), datetime.timedelta(hours=8))
+        self.assertEqual(django.utils.timezone.get_current_timezone_name(), 'Asia/Singapore')
+        aware = django.utils.timezone.make_aware(datetime.datetime(2016, 7, 1, 8, 0))
+        self.assertEqual(aware, datetime.datetime(2016, 7, 1, 0, 0, tzinfo=pytz.utc))
+
+        # anonymous users get the default timezone
+        request.user = django.contrib.auth.models.AnonymousUser()
+        tz_middleware.process_request(request)
+        self.assertEqual(django.utils.timezone.get_current_timezone_name(),
+                         django.utils.timezone.get_default_timezone_name())
+
+    @django.test.utils.override_settings(ACCOUNTS_SESSION_TIMEZONE=True)
+    def test_process_request_session(self):
+        self.addCleanup(django.utils.timezone.deactivate)
+        django.core.cache.cache.clear()
+        client = django.test.client.Client()
+        self.assertTrue(client.login(email='test@example.com', password='t'))
+        self.assertEqual(client.session[timezones.SESSION_KEY], 'America/New_York')
+
+        def make_request():
+            request = django.test.client.RequestFactory().get('/admin/')
+            request.COOKIES[settings.SESSION_COOKIE_NAME] = client.session.session_key
+            django.contrib.sessions.middleware.SessionMiddleware().process_request(request)
+            django.contrib.auth.middleware.AuthenticationMiddleware().process_request(request)
+            return request
+
+        tz_middleware = middleware.TimezoneMiddleware()
+        request = make_request()
+        # the timezone comes from the session without loading the user
+        with self.assertNumQueries(0):
+            tz_middleware.process_request(request)
+        self.assertEqual(django.utils.timezone.get_current_timezone_name(), 'America/New_York')
+        self.assertIs(django.utils.timezone.get_current_timezone(), timezones.get_timezone('America/New_York'))
+
+        # a changed timezone is picked up by the sessions of the user
+        user = UnitTestUser.objects.get(pk=1)
+        user.timezone = pytz.timezone('Asia/Singapore')
+        user.save()
+        request = make_request()
+        with self.assertNumQueries(0):
+            tz_middleware.process_request(request)
+        self.assertEqual(django.utils.timezone.get_current_timezone_name(), 'Asia/Singapore')
+        self.assertEqual(request.session[timezones.SESSION_KEY], 'Asia/Singapore')
+
+        # sessions that started before the timezone was kept in them load the user once
+        request.session.pop(timezones.SESSION_KEY)
+        django.core.cache.cache.delete(timezones.get_cache_key(user.pk))
+        with self.assertNumQueries(1):
+            tz_middleware.process_request(request)
+        self.assertEqual(request.session[timezones.SESSION_KEY], 'Asia/Singapore')
+
+        # anonymous requests get the default timezone
+        request = django.test.client.RequestFactory().get('/admin/')
+        django.contrib.sessions.middleware.SessionMiddleware().process_request(request)
+        django.contrib.auth.middleware.AuthenticationMiddleware().process_request(request)
+        tz_middleware.process_request(request)
+        self.assertEqual(django.utils.timezone.get_current_timezone_name(),
+                         django.utils.timezone.get_default_timezone_name())
+
+
+@django.test.utils.override_settings(
+    AUTH_USER_MODEL='accountsplus.UnitTestUser',
+    ACCOUNTS_AUDIT_LOG_EVENT_MODEL='accountsplus.UnitTestAuditLogEvent',
+    ACCOUNTS_ENABLE_AUDIT_LOG=True,
+)
+class AuditLogMiddlewareTestCase(django.test.TransactionTestCase):
+    def setUp(self):
+        company = UnitTestCompany.objects.create(name='Example')
+        self.user = UnitTestUser.objects.create_user(
+            email='test@example.com', password='t', first_name='f', last_name='l', company=company)
+        self.user = UnitTestUser.objects.select_related('company').get(pk=self.user.pk)
+
+        factory = django.test.client.RequestFactory()
+        self.request = factory.post('/admin/')
+        self.request.session = {}
+        self.request.user = self.user
+        self.audit_log_middleware = middleware.AuditLogMiddleware()
+        self.audit_log_middleware.process_request(self.request)
+
+    def test_events_written_in_one_insert(self):
+        signals.log_audit_event('Email change', request=self.request, user=self.user)
+        signals.log_audit_event('Deactivate', request=self.request, user=self.user)
+        self.assertEqual(UnitTestAuditLogEvent.objects.count(), 0)
+
+        with django.test.utils.CaptureQueriesContext(django.db.connection) as queries:
+            self.audit_log_middleware.process_response(self.request, django.http.HttpResponse())
+        self.assertEqual(len([q for q in queries if q['sql'].startswith('INSERT')]), 1)
+        self.assertListEqual(
+            list(UnitTestAuditLogEvent.objects.order_by('id').values_list('message', flat=True)),
+            ['Email change', 'Deactivate'])
+
+    def test_rolled_back_events_not_written(self):
+        signals.log_audit_event('Committed', request=self.request, user=self.user)
+        try:
+            with django.db.transaction.atomic():
+                signals.log_audit_event('Rolled back', request=self.request, user=self.user)
+                raise ValueError
+        except ValueError:
+            pass
+        with django.db.transaction.atomic():
+            signals.log_audit_event('Committed later', request=self.request, user=self.user)
+
+        self.audit_log_middleware.process_response(self.request, django.http.HttpResponse())
+        self.assertListEqual(
+            list(UnitTestAuditLogEvent.objects.order_by('id').values_list('message', flat=True)),
+            ['Committed', 'Committed later'])
+
+    @django.test.utils.override_settings(ACCOUNTS_AUDIT_LOG_COALESCE_WINDOW=60)
+    def test_coalesced_events(self):
+        # the rolled back event doesn't open the window, so the occurrences land on the row that is written
+        try:
+            with django.db.transaction.atomic():
+                signals.log_audit_event('Storm', request=self.request, user=self.user)
+                raise ValueError
+        except ValueError:
+            pass
+        for i in range(3):
+            signals.log_audit_event('Storm', request=self.request, user=self.user)
+        self.audit_log_middleware.process_response(self.request, django.http.HttpResponse())
+        signals.flush_audit_log_coalescer()
+        self.assertListEqual(list(UnitTestAuditLogEvent.objects.values_list('occurrences', flat=True)), [3])
+
+    def test_failed_write(self):
+        # a failed write doesn't fail the response, the events are written later by the buffered writer
+        signals.log_audit_event('Email change', request=self.request, user=self.user)
+        signals.log_audit_event('Deactivate', request=self.request, user=self.user)
+        writer = writers.BufferedAuditLogWriter(flush_interval=0)
+        with mock.patch.object(writers, 'get_buffered_writer', return_value=writer):
+            with mock.patch.object(writers, 'write_audit_events', side_effect=django.db.DatabaseError):
+                response = self.audit_log_middleware.process_response(self.request, django.http.HttpResponse())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(writer), 2)
+        self.assertEqual(len(self.request.audit_log_collector), 0)
+        writer.flush()
+        self.assertListEqual(
+            list(UnitTestAuditLogEvent.objects.order_by('id').values_list('message', flat=True)),
+            ['Email change', 'Deactivate'])
+
+    def test_no_events(self):
+        with self.assertNumQueries(0):
+            self.audit_log_middleware.process_response(self.request, django.http.HttpResponse())
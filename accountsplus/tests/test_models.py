@@ -1,13 +1,15 @@
 from __future__ import unicode_literals
 
 import django.test
+import django.test.client
+import django.test.utils
 import django.core.mail
 import django.db.models
 import django.conf
 
 import logging
 
-from .. import models
+from .. import events, models, signals
 
 
 logging.disable(logging.CRITICAL)
@@ -26,6 +28,14 @@ class UnitTestAuditLogEvent(models.BaseAuditLogEvent):
     baz = django.db.models.CharField(max_length=100)
 
 
+class UnitTestCompactAuditLogEvent(models.BaseCompactAuditLogEvent):
+    pass
+
+
+class UnitTestAuditLogRollup(models.BaseAuditLogRollup):
+    pass
+
+
 @django.test.utils.override_settings(
     AUTH_USER_MODEL='accountsplus.UnitTestUser',
 )
@@ -124,3 +134,61 @@ class UserTestCase(django.test.TestCase):
         self.assertEqual(sent_email.from_email, 'from@example.net')
         self.assertEqual(sent_email.subject, 'Subject')
         self.assertEqual(sent_email.body, 'Body')
+
+
+@django.test.utils.override_settings(
+    AUTH_USER_MODEL='accountsplus.UnitTestUser',
+    ACCOUNTS_AUDIT_LOG_EVENT_MODEL='accountsplus.UnitTestCompactAuditLogEvent',
+)
+class CompactAuditLogEventTestCase(django.test.TestCase):
+    def test_schema(self):
+        field_names = [f.name for f in UnitTestCompactAuditLogEvent._meta.fields]
+        self.assertNotIn('created_on', field_names)
+        self.assertNotIn('updated_on', field_names)
+        self.assertFalse(UnitTestCompactAuditLogEvent._meta.get_field('user_email').db_index)
+        self.assertIn(('company_id', 'recorded_on'), UnitTestCompactAuditLogEvent._meta.index_together)
+        self.assertIn(('user_id', 'recorded_on'), UnitTestCompactAuditLogEvent._meta.index_together)
+
+    def test_str(self):
+        e = UnitTestCompactAuditLogEvent(user_id=1, user_email='a@example.com', message='Sign in')
+        self.assertTrue(str(e).endswith('a@example.com Sign in'))
+        self.assertFalse(e.is_masquerading)
+        e.masquerading_user_id = 2
+        e.masquerading_user_email = 'b@example.com'
+        self.assertTrue(str(e).endswith('a@example.com [b@example.com] Sign in'))
+        self.assertTrue(e.is_masquerading)
+
+    @django.test.utils.override_settings(ACCOUNTS_ENABLE_AUDIT_LOG=True)
+    def test_log_audit_event(self):
+        user = UnitTestUser.objects.create_user('a@example.com', 'a', first_name='Joe', last_name='User')
+        request = django.test.client.RequestFactory().get('/')
+        request.session = {}
+        signals.log_audit_event('Sign in', request=request, user=user)
+        e = UnitTestCompactAuditLogEvent.objects.get()
+        self.assertEqual(e.user_id, user.id)
+        self.assertEqual(e.message, 'Sign in')
+
+    def test_event_type(self):
+        e = UnitTestCompactAuditLogEvent.objects.create(
+            user_id=1, user_email='a@example.com', event_type=events.EMAIL_CHANGE,
+            event_data=events.dumps_event_data({'old_email': 'a@example.com', 'new_email': 'b@example.com', }))
+        e = UnitTestCompactAuditLogEvent.objects.get(event_type=events.EMAIL_CHANGE)
+        self.assertEqual(e.message, '')
+        self.assertEqual(e.get_message(), 'Email change from: a@example.com to: b@example.com')
+        self.assertTrue(str(e).endswith('a@example.com Email change from: a@example.com to: b@example.com'))
+        self.assertEqual(e.get_event_type_display(), 'Email change')
+
+    def test_render_message(self):
+        self.assertEqual(events.render_message(events.SIGN_IN, {}), 'Sign in')
+        self.assertEqual(
+            events.render_message(events.USER_ACTIVATE, {'actor_id': 1, 'actor_email': 'a@example.com', }),
+            'Activate by: a@example.com (1)')
+        # a payload missing a key falls back to the name of the event type
+        self.assertEqual(events.render_message(events.USER_ACTIVATE, {}), 'Activate user')
+        self.assertEqual(events.dumps_event_data({}), '')
+        self.assertDictEqual(events.loads_event_data(events.dumps_event_data({'b': 1, 'a': 2, })), {'a': 2, 'b': 1, })
+
+    def test_delete(self):
+        e = UnitTestCompactAuditLogEvent.objects.create(user_id=1, user_email='a@example.com', message='Sign in')
+        e.delete()
+        self.assertEqual(UnitTestCompactAuditLogEvent.objects.count(), 1)
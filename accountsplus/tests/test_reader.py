@@ -0,0 +1,69 @@
+from __future__ import unicode_literals
+
+import datetime
+import logging
+
+import django.db
+import django.test
+import django.test.utils
+import django.utils.timezone
+
+from .. import events, reader
+from test_models import (UnitTestAuditLogEvent, UnitTestCompactAuditLogEvent, )
+
+
+logging.disable(logging.CRITICAL)
+
+
+@django.test.utils.override_settings(
+    ACCOUNTS_AUDIT_LOG_EVENT_MODEL='accountsplus.UnitTestAuditLogEvent',
+)
+class AuditEventsTestCase(django.test.TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.now = django.utils.timezone.now()
+        UnitTestAuditLogEvent.objects.bulk_create([
+            UnitTestAuditLogEvent(
+                user_id=i % 3, user_email='user{}@example.com'.format(i % 3), company_id=1 if i < 6 else 2,
+                event_type=events.SIGN_OUT if i % 4 == 0 else events.SIGN_IN,
+                # groups of three events share a timestamp so that the keyset needs the id to break ties
+                recorded_on=cls.now - datetime.timedelta(hours=12 - i // 3))
+            for i in range(12)])
+        cls.ids = list(UnitTestAuditLogEvent.objects.order_by('recorded_on', 'id').values_list('id', flat=True))
+
+    def test_audit_events(self):
+        self.assertListEqual([e.id for e in reader.audit_events(chunk_size=5)], self.ids)
+        self.assertListEqual([e.id for e in reader.audit_events(chunk_size=2, newest_first=True)], self.ids[::-1])
+        self.assertListEqual([e.id for e in reader.audit_events(chunk_size=3)], self.ids)
+
+    def test_chunks_use_keyset(self):
+        with django.test.utils.CaptureQueriesContext(django.db.connection) as queries:
+            self.assertEqual(len(list(reader.audit_events(chunk_size=5))), 12)
+        self.assertEqual(len(queries), 3)
+        self.assertFalse(any('OFFSET' in q['sql'] for q in queries))
+
+    def test_filters(self):
+        self.assertListEqual(
+            [e.user_id for e in reader.audit_events(user_id=1, chunk_size=2)], [1, 1, 1, 1])
+        self.assertEqual(len(list(reader.audit_events(company_id=2, event_types=[events.SIGN_OUT]))), 1)
+        since = self.now - datetime.timedelta(hours=10)
+        until = self.now - datetime.timedelta(hours=9)
+        self.assertListEqual([e.id for e in reader.audit_events(since=since, until=until)], self.ids[6:9])
+
+    def test_fields(self):
+        rows = list(reader.audit_events(fields=('user_email', 'event_type'), user_id=0, chunk_size=2))
+        self.assertEqual(len(rows), 4)
+        self.assertDictEqual(rows[0], {'user_email': 'user0@example.com', 'event_type': events.SIGN_OUT})
+        with django.test.utils.CaptureQueriesContext(django.db.connection) as queries:
+            list(reader.audit_events(fields=('user_id', )))
+        self.assertNotIn('user_email', queries[0]['sql'])
+
+    def test_model(self):
+        UnitTestCompactAuditLogEvent.objects.create(user_id=1, user_email='a@example.com', event_type=events.SIGN_IN)
+        self.assertListEqual(
+            [e['user_email'] for e in reader.audit_events(model=UnitTestCompactAuditLogEvent, fields=('user_email', ))],
+            ['a@example.com'])
+
+    @django.test.utils.override_settings(ACCOUNTS_AUDIT_LOG_EVENT_MODEL=None)
+    def test_not_configured(self):
+        self.assertRaises(LookupError, list, reader.audit_events())
@@ -0,0 +1,105 @@
+from __future__ import unicode_literals
+
+import datetime
+import logging
+import shutil
+import tempfile
+
+import django.core.management
+import django.test
+import django.test.utils
+import django.utils.six
+import django.utils.timezone
+
+from .. import archive, retention
+from test_models import (UnitTestAuditLogEvent, )
+
+
+logging.disable(logging.CRITICAL)
+
+
+def utc(*args):
+    return datetime.datetime(*args, tzinfo=django.utils.timezone.utc)
+
+
+class ParseOlderThanTestCase(django.test.SimpleTestCase):
+    def test_parse_older_than(self):
+        self.assertEqual(retention.parse_older_than('90'), datetime.timedelta(days=90))
+        self.assertEqual(retention.parse_older_than('90d'), datetime.timedelta(days=90))
+        self.assertEqual(retention.parse_older_than('12w'), datetime.timedelta(weeks=12))
+        self.assertEqual(retention.parse_older_than('36h'), datetime.timedelta(hours=36))
+        self.assertRaises(ValueError, retention.parse_older_than, '3 months')
+        self.assertRaises(ValueError, retention.parse_older_than, '-1d')
+
+
+@django.test.utils.override_settings(
+    ACCOUNTS_AUDIT_LOG_EVENT_MODEL='accountsplus.UnitTestAuditLogEvent',
+)
+class PurgeAuditLogTestCase(django.test.TestCase):
+    def setUp(self):
+        now = django.utils.timezone.now()
+        # ten events 100 days old, interleaved with three recent ones
+        for i in range(13):
+            age = datetime.timedelta(days=1 if i % 4 == 3 else 100)
+            UnitTestAuditLogEvent.objects.create(
+                user_id=i, user_email='user{}@example.com'.format(i), message='Sign in', recorded_on=now - age)
+
+    def purge(self, **options):
+        out = django.utils.six.StringIO()
+        django.core.management.call_command('purge_audit_log', stdout=out, **options)
+        return out.getvalue()
+
+    def test_purge(self):
+        out = self.purge(older_than='90d', batch_size=3, verbosity=2)
+        self.assertIn('Purged 10 audit log events recorded before', out)
+        self.assertEqual(out.count('audit log events with ids'), 4)
+        self.assertListEqual(list(UnitTestAuditLogEvent.objects.order_by('user_id').values_list(
+            'user_id', flat=True)), [3, 7, 11])
+        self.assertIn('Purged 0 audit log events', self.purge(older_than='90'))
+
+    def test_purge_batch_queries(self):
+        # each batch selects its id range and deletes it with a single DELETE, without loading the events; inside
+        # the test's transaction the batch's transaction is a savepoint
+        with self.assertNumQueries(5):
+            list(retention.purge_batches(UnitTestAuditLogEvent, django.utils.timezone.now() - datetime.timedelta(
+                days=90), batch_size=10))
+        self.assertEqual(UnitTestAuditLogEvent.objects.count(), 3)
+
+    def test_dry_run(self):
+        self.assertIn('Would purge 10 audit log events', self.purge(older_than='90d', batch_size=4, dry_run=True))
+        self.assertEqual(UnitTestAuditLogEvent.objects.count(), 13)
+
+    def test_archive(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.purge(older_than='90d', batch_size=3, archive=True, directory=directory)
+        audit_log_archive = archive.AuditLogArchive(directory)
+        self.assertListEqual(sorted(e['user_id'] for e in audit_log_archive.events()), [0, 1, 2, 4, 5, 6, 8, 9, 10, 12])
+        self.assertEqual(UnitTestAuditLogEvent.objects.count(), 3)
+
+    def test_archive_out_of_order_ids(self):
+        # ids don't follow recorded_on, so an event with a lower id than one archived by an earlier run with an
+        # earlier cutoff is still archived
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        audit_log_archive = archive.AuditLogArchive(directory)
+        UnitTestAuditLogEvent.objects.all().delete()
+        later = UnitTestAuditLogEvent.objects.create(
+            user_id=1, user_email='user1@example.com', message='Sign in', recorded_on=utc(2016, 2, 20))
+        earlier = UnitTestAuditLogEvent.objects.create(
+            user_id=2, user_email='user2@example.com', message='Sign in', recorded_on=utc(2016, 2, 10))
+        self.assertLess(later.id, earlier.id)
+        list(retention.purge_batches(UnitTestAuditLogEvent, utc(2016, 2, 15), audit_log_archive=audit_log_archive))
+        list(retention.purge_batches(UnitTestAuditLogEvent, utc(2016, 3, 1), audit_log_archive=audit_log_archive))
+        self.assertListEqual(sorted(e['user_id'] for e in audit_log_archive.read('2016-02')), [1, 2])
+        self.assertEqual(UnitTestAuditLogEvent.objects.count(), 0)
+
+    def test_compact(self):
+        # tests run inside a transaction, where VACUUM isn't possible
+        self.assertIn('Compaction is not supported here', self.purge(older_than='90d', compact=True))
+
+    def test_invalid_options(self):
+        self.assertRaises(django.core.management.CommandError, self.purge)
+        self.assertRaises(django.core.management.CommandError, self.purge, older_than='3 months')
+        self.assertRaises(django.core.management.CommandError, self.purge, older_than='90d', batch_size=0)
+        self.assertRaises(django.core.management.CommandError, self.purge, older_than='90d', archive=True)
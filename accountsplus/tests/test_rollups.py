@@ -0,0 +1,153 @@
+from __future__ import unicode_literals
+
+import datetime
+import logging
+
+import django.core.management
+import django.test
+import django.test.utils
+import django.utils.six
+import django.utils.timezone
+
+from .. import events, rollups, signals, writers
+from test_models import (UnitTestAuditLogEvent, UnitTestAuditLogRollup, )
+from test_signals import SignalTestCase
+
+
+logging.disable(logging.CRITICAL)
+
+
+def utc(*args):
+    return datetime.datetime(*args, tzinfo=django.utils.timezone.utc)
+
+
+def make_event(event_type, recorded_on, company_id=1, occurrences=1):
+    return UnitTestAuditLogEvent(
+        user_id=1, user_email='user@example.com', company_id=company_id, event_type=event_type,
+        recorded_on=recorded_on, occurrences=occurrences)
+
+
+def rollup_counts():
+    return dict(((r.date, r.company_id, r.event_type), r.count) for r in UnitTestAuditLogRollup.objects.all())
+
+
+@django.test.utils.override_settings(
+    AUTH_USER_MODEL='accountsplus.UnitTestUser',
+    ACCOUNTS_AUDIT_LOG_EVENT_MODEL='accountsplus.UnitTestAuditLogEvent',
+    ACCOUNTS_AUDIT_LOG_ROLLUP_MODEL='accountsplus.UnitTestAuditLogRollup',
+    ACCOUNTS_ENABLE_AUDIT_LOG=True,
+)
+class RollupTestCase(SignalTestCase):
+    def test_rollup_date(self):
+        self.assertEqual(rollups.rollup_date(utc(2016, 1, 1, 23, 30)), datetime.date(2016, 1, 1))
+        # days are in UTC whatever the current timezone is
+        with django.utils.timezone.override('America/New_York'):
+            self.assertEqual(rollups.rollup_date(utc(2016, 1, 2, 1, 0)), datetime.date(2016, 1, 2))
+
+    def test_log_audit_event(self):
+        today = rollups.rollup_date(django.utils.timezone.now())
+        signals.login_callback(sender=self, request=self.request, user=self.user_1)
+        signals.login_callback(sender=self, request=self.request, user=self.user_1)
+        signals.password_reset_request_callback(sender=self, request=self.request, user=self.user_1)
+        # free-text events aren't counted
+        signals.log_audit_event(message='Test', request=self.request, user=self.user_1)
+        self.assertDictEqual(rollup_counts(), {
+            (today, 1, events.SIGN_IN): 2,
+            (today, 1, events.PASSWORD_RESET_REQUEST): 1,
+        })
+
+    def test_write_audit_events(self):
+        writers.write_audit_events([
+            make_event(events.SIGN_IN, utc(2016, 1, 1, 10)),
+            make_event(events.SIGN_IN, utc(2016, 1, 1, 11)),
+            make_event(events.SIGN_IN, utc(2016, 1, 2, 10)),
+            make_event(events.SIGN_IN, utc(2016, 1, 2, 10), company_id=None),
+            make_event(events.MASQUERADE_START, utc(2016, 1, 2, 10)),
+        ])
+        self.assertDictEqual(rollup_counts(), {
+            (datetime.date(2016, 1, 1), 1, events.SIGN_IN): 2,
+            (datetime.date(2016, 1, 2), 1, events.SIGN_IN): 1,
+            (datetime.date(2016, 1, 2), 0, events.SIGN_IN): 1,
+            (datetime.date(2016, 1, 2), 1, events.MASQUERADE_START): 1,
+        })
+        # events counted on the same row are added with a single update
+        with self.assertNumQueries(2):
+            writers.write_audit_events([
+                make_event(events.SIGN_IN, utc(2016, 1, 1, 12)), make_event(events.SIGN_IN, utc(2016, 1, 1, 13))])
+        self.assertEqual(rollup_counts()[(datetime.date(2016, 1, 1), 1, events.SIGN_IN)], 4)
+
+    def test_coalesced_events(self):
+        with self.settings(ACCOUNTS_AUDIT_LOG_COALESCE_WINDOW=60):
+            for i in range(5):
+                signals.login_callback(sender=self, request=self.request, user=self.user_1)
+            signals.flush_audit_log_coalescer()
+        today = rollups.rollup_date(django.utils.timezone.now())
+        self.assertDictEqual(rollup_counts(), {(today, 1, events.SIGN_IN): 5})
+
+    def test_daily_counts(self):
+        writers.write_audit_events([
+            make_event(events.SIGN_IN, utc(2016, 1, 1, 10), occurrences=3),
+            make_event(events.SIGN_IN, utc(2016, 1, 3, 10), company_id=2),
+            make_event(events.PASSWORD_CHANGE, utc(2016, 1, 3, 10)),
+        ])
+        with self.assertNumQueries(1):
+            days = rollups.daily_counts(datetime.date(2016, 1, 1), datetime.date(2016, 1, 4))
+        self.assertListEqual(list(days.items()), [
+            (datetime.date(2016, 1, 1), {events.SIGN_IN: 3}),
+            (datetime.date(2016, 1, 2), {}),
+            (datetime.date(2016, 1, 3), {events.SIGN_IN: 1, events.PASSWORD_CHANGE: 1}),
+        ])
+        days = rollups.daily_counts(datetime.date(2016, 1, 1), datetime.date(2016, 1, 4), company_id=1,
+                                    event_types=[events.SIGN_IN])
+        self.assertDictEqual(days[datetime.date(2016, 1, 3)], {})
+        with self.assertNumQueries(1):
+            totals = rollups.total_counts(datetime.date(2016, 1, 1), datetime.date(2016, 1, 4))
+        self.assertDictEqual(totals, {events.SIGN_IN: 4, events.PASSWORD_CHANGE: 1})
+        self.assertDictEqual(rollups.total_counts(datetime.date(2016, 1, 2), datetime.date(2016, 1, 3)), {})
+
+    def test_backfill(self):
+        UnitTestAuditLogEvent.objects.bulk_create([
+            make_event(events.SIGN_IN, utc(2016, 1, 1, 10), occurrences=2),
+            make_event(events.SIGN_IN, utc(2016, 1, 1, 23, 59)),
+            make_event(events.SIGN_OUT, utc(2016, 1, 3, 0, 0), company_id=None),
+            make_event(None, utc(2016, 1, 3, 0, 0)),
+        ])
+        # a row that drifted from the events is replaced
+        UnitTestAuditLogRollup.objects.create(
+            date=datetime.date(2016, 1, 1), company_id=1, event_type=events.SIGN_IN, count=100)
+        out = django.utils.six.StringIO()
+        django.core.management.call_command(
+            'backfill_audit_log_rollups', since='2016-01-01', until='2016-01-04', stdout=out)
+        self.assertIn('Rolled up 3 days of audit log events into 2 rows', out.getvalue())
+        expected = {
+            (datetime.date(2016, 1, 1), 1, events.SIGN_IN): 3,
+            (datetime.date(2016, 1, 3), 0, events.SIGN_OUT): 1,
+        }
+        self.assertDictEqual(rollup_counts(), expected)
+        django.core.management.call_command('backfill_audit_log_rollups', stdout=out)
+        self.assertDictEqual(rollup_counts(), expected)
+
+    def test_backfill_excludes_today(self):
+        # today's counts are still being added to as events are written, so they are left alone
+        now = django.utils.timezone.now()
+        UnitTestAuditLogEvent.objects.bulk_create([
+            make_event(events.SIGN_IN, utc(2016, 1, 1, 10)),
+            make_event(events.SIGN_IN, now),
+        ])
+        UnitTestAuditLogRollup.objects.create(
+            date=rollups.rollup_date(now), company_id=1, event_type=events.SIGN_IN, count=2)
+        django.core.management.call_command('backfill_audit_log_rollups', stdout=django.utils.six.StringIO())
+        self.assertDictEqual(rollup_counts(), {
+            (datetime.date(2016, 1, 1), 1, events.SIGN_IN): 1,
+            (rollups.rollup_date(now), 1, events.SIGN_IN): 2,
+        })
+
+    def test_backfill_invalid_date(self):
+        self.assertRaises(django.core.management.CommandError, django.core.management.call_command,
+                          'backfill_audit_log_rollups', since='2016-1')
+
+    @django.test.utils.override_settings(ACCOUNTS_AUDIT_LOG_ROLLUP_MODEL=None)
+    def test_rollups_disabled(self):
+        signals.login_callback(sender=self, request=self.request, user=self.user_1)
+        self.assertEqual(UnitTestAuditLogRollup.objects.count(), 0)
+        self.assertRaises(LookupError, rollups.total_counts, datetime.date(2016, 1, 1), datetime.date(2016, 1, 2))
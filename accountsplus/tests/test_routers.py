@@ -0,0 +1,79 @@
+from __future__ import unicode_literals
+
+import datetime
+import logging
+
+import django.test
+import django.test.utils
+import django.utils.timezone
+
+from .. import events, reader, routers, signals, writers
+from test_models import (UnitTestAuditLogEvent, UnitTestAuditLogRollup, UnitTestCompactAuditLogEvent,
+                         UnitTestCompany, UnitTestUser, )
+from test_signals import SignalTestCase
+
+
+logging.disable(logging.CRITICAL)
+
+
+@django.test.utils.override_settings(
+    ACCOUNTS_AUDIT_LOG_DATABASE='audit',
+    ACCOUNTS_AUDIT_LOG_READ_DATABASE='audit_replica',
+)
+class AuditLogRouterTestCase(django.test.SimpleTestCase):
+    def setUp(self):
+        self.router = routers.AuditLogRouter()
+
+    def test_db_for_read_and_write(self):
+        for model in (UnitTestAuditLogEvent, UnitTestCompactAuditLogEvent, UnitTestAuditLogRollup):
+            self.assertEqual(self.router.db_for_write(model), 'audit')
+            self.assertEqual(self.router.db_for_read(model), 'audit_replica')
+        self.assertIsNone(self.router.db_for_write(UnitTestUser))
+        self.assertIsNone(self.router.db_for_read(UnitTestCompany))
+        with self.settings(ACCOUNTS_AUDIT_LOG_READ_DATABASE=None):
+            self.assertEqual(self.router.db_for_read(UnitTestAuditLogEvent), 'audit')
+
+    def test_allow_migrate(self):
+        self.assertTrue(self.router.allow_migrate('audit', 'accountsplus', 'unittestauditlogevent'))
+        self.assertFalse(self.router.allow_migrate('default', 'accountsplus', 'unittestauditlogevent'))
+        self.assertFalse(self.router.allow_migrate('audit', 'accountsplus', model=UnitTestUser))
+        self.assertIsNone(self.router.allow_migrate('default', 'accountsplus', 'unittestuser'))
+        # nothing is migrated on the replica
+        self.assertFalse(self.router.allow_migrate('audit_replica', 'accountsplus', 'unittestauditlogevent'))
+        self.assertFalse(self.router.allow_migrate('audit_replica', 'accountsplus', 'unittestuser'))
+        # operations that aren't about a model are left to other routers
+        self.assertIsNone(self.router.allow_migrate('audit', 'accountsplus'))
+
+    def test_allow_migrate_default_database(self):
+        with self.settings(ACCOUNTS_AUDIT_LOG_DATABASE='default', ACCOUNTS_AUDIT_LOG_READ_DATABASE=None):
+            self.assertTrue(self.router.allow_migrate('default', 'accountsplus', 'unittestauditlogevent'))
+            self.assertIsNone(self.router.allow_migrate('default', 'accountsplus', 'unittestuser'))
+            self.assertFalse(self.router.allow_migrate('audit', 'accountsplus', 'unittestauditlogevent'))
+
+
+@django.test.utils.override_settings(
+    AUTH_USER_MODEL='accountsplus.UnitTestUser',
+    ACCOUNTS_AUDIT_LOG_EVENT_MODEL='accountsplus.UnitTestAuditLogEvent',
+    ACCOUNTS_AUDIT_LOG_ROLLUP_MODEL='accountsplus.UnitTestAuditLogRollup',
+    ACCOUNTS_ENABLE_AUDIT_LOG=True,
+    ACCOUNTS_AUDIT_LOG_DATABASE='audit',
+    DATABASE_ROUTERS=['accountsplus.routers.AuditLogRouter'],
+)
+class AuditLogDatabaseTestCase(SignalTestCase):
+    multi_db = True
+
+    def test_log_audit_event(self):
+        signals.login_callback(sender=self, request=self.request, user=self.user_1)
+        self.assertEqual(UnitTestAuditLogEvent.objects.using('audit').get().event_type, events.SIGN_IN)
+        self.assertFalse(UnitTestAuditLogEvent.objects.using('default').exists())
+        self.assertEqual(UnitTestAuditLogRollup.objects.using('audit').get().count, 1)
+        self.assertFalse(UnitTestAuditLogRollup.objects.using('default').exists())
+
+    def test_write_and_read(self):
+        now = django.utils.timezone.now()
+        writers.write_audit_events([
+            UnitTestAuditLogEvent(user_id=i, user_email='user{}@example.com'.format(i), event_type=events.SIGN_IN,
+                                  recorded_on=now - datetime.timedelta(minutes=i))
+            for i in range(3)])
+        self.assertEqual(UnitTestAuditLogEvent.objects.using('audit').count(), 3)
+        self.assertListEqual([e['user_id'] for e in reader.audit_events(fields=('user_id', ))], [2, 1, 0])
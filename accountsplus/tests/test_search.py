@@ -0,0 +1,138 @@
+from __future__ import unicode_literals
+
+import json
+import logging
+
+import django.core.management
+import django.db
+import django.test
+import django.test.utils
+import django.utils.six
+import mock
+
+from .. import events, search
+from test_models import (UnitTestUser, UnitTestAuditLogEvent, )
+
+
+logging.disable(logging.CRITICAL)
+
+
+@django.test.utils.override_settings(
+    AUTH_USER_MODEL='accountsplus.UnitTestUser',
+    ACCOUNTS_AUDIT_LOG_EVENT_MODEL='accountsplus.UnitTestAuditLogEvent',
+)
+class SearchTestCase(django.test.TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        UnitTestUser.objects.create_superuser(
+            email='superuser@example.com', password='password', first_name='Super', last_name='User')
+        # events written before the index is installed are indexed by the install
+        UnitTestAuditLogEvent.objects.create(
+            user_id=1, user_email='alice@example.com', company_id=1, company_name='Acme', message='Imported contacts')
+        search.install_search_index(UnitTestAuditLogEvent)
+        UnitTestAuditLogEvent.objects.create(
+            user_id=2, user_email='bob@other.org', company_id=2, company_name='Globex', event_type=events.EMAIL_CHANGE,
+            event_data=events.dumps_event_data({'old_email': 'bob@other.org', 'new_email': 'robert@other.org', }))
+        UnitTestAuditLogEvent.objects.bulk_create([
+            UnitTestAuditLogEvent(user_id=3, user_email='carol@example.com', company_id=1, company_name='Acme',
+                                  event_type=events.SIGN_IN),
+        ])
+
+    def search(self, term):
+        queryset = search.search_audit_events(UnitTestAuditLogEvent.objects.order_by('id'), term)
+        return list(queryset.values_list('user_id', flat=True))
+
+    def test_backend(self):
+        backend = search.get_search_backend(UnitTestAuditLogEvent)
+        self.assertIsInstance(backend, search.SQLiteSearchBackend)
+        self.assertTrue(backend.is_installed())
+        self.assertFalse(backend.install())
+
+    def test_search(self):
+        self.assertListEqual(self.search('alice'), [1])
+        self.assertListEqual(self.search('example.com'), [1, 3])
+        self.assertListEqual(self.search('acme'), [1, 3])
+        self.assertListEqual(self.search('import cont'), [1])
+        self.assertListEqual(self.search('robert@other.org'), [2])
+        self.assertListEqual(self.search('nobody'), [])
+        self.assertListEqual(self.search('  '), [1, 2, 3])
+
+    def test_search_event_type(self):
+        self.assertListEqual(self.search('sign in'), [3])
+        self.assertListEqual(self.search('Email change'), [2])
+
+    def test_search_query_syntax_is_ignored(self):
+        self.assertListEqual(self.search('"alice'), [1])
+        self.assertListEqual(self.search('alice OR bob'), [])
+        self.assertListEqual(self.search('user_email:alice'), [])
+
+    def test_index_stays_in_sync(self):
+        UnitTestAuditLogEvent.objects.filter(user_id=1).update(user_email='alicia@example.com')
+        self.assertListEqual(self.search('alice'), [])
+        self.assertListEqual(self.search('alicia'), [1])
+        UnitTestAuditLogEvent.objects.filter(user_id=3).delete()
+        self.assertListEqual(self.search('carol'), [])
+
+    def test_search_uses_index(self):
+        with django.test.utils.CaptureQueriesContext(django.db.connection) as queries:
+            self.search('alice')
+        self.assertTrue(any('MATCH' in q['sql'] for q in queries))
+        self.assertFalse(any('LIKE' in q['sql'] for q in queries))
+
+    def test_is_installed_cached(self):
+        self.addCleanup(search._installed.clear)
+        backend = search.get_search_backend(UnitTestAuditLogEvent)
+        # the test's transaction never commits, so commit hooks are run right away
+        with mock.patch('django.db.transaction.on_commit', side_effect=lambda func, using=None: func()):
+            self.assertTrue(backend.is_installed())
+        with self.assertNumQueries(1):
+            self.assertListEqual(self.search('alice'), [1])
+
+    @django.test.utils.override_settings(ACCOUNTS_AUDIT_LOG_SEARCH_BACKEND='accountsplus.search.LikeSearchBackend')
+    def test_like_backend(self):
+        self.assertListEqual(self.search('example.com'), [1, 3])
+        self.assertListEqual(self.search('sign in'), [3])
+
+    def test_admin_search(self):
+        self.client.login(email='superuser@example.com', password='password')
+        response = self.client.get('/admin/accountsplus/unittestauditlogevent/', {'q': 'acme'})
+        self.assertListEqual(sorted(e.user_id for e in response.context['cl'].result_list), [1, 3])
+
+    def test_export_search(self):
+        self.client.login(email='superuser@example.com', password='password')
+        response = self.client.get(
+            '/admin/accountsplus/unittestauditlogevent/export/', {'format': 'jsonl', 'search': 'other.org'})
+        content = b''.join(response.streaming_content).decode('utf-8')
+        self.assertListEqual([json.loads(line)['user_id'] for line in content.splitlines()], [2])
+
+
+@django.test.utils.override_settings(
+    ACCOUNTS_AUDIT_LOG_EVENT_MODEL='accountsplus.UnitTestAuditLogEvent',
+)
+class InstallSearchCommandTestCase(django.test.TestCase):
+    def install(self):
+        out = django.utils.six.StringIO()
+        django.core.management.call_command('install_audit_log_search', stdout=out)
+        return out.getvalue()
+
+    def test_install(self):
+        UnitTestAuditLogEvent.objects.create(user_id=1, user_email='alice@example.com', message='Sign in')
+        self.assertIn('Installed', self.install())
+        self.assertIn('No audit log search index', self.install())
+        self.assertEqual(search.search_audit_events(UnitTestAuditLogEvent.objects.all(), 'alice').count(), 1)
+
+
+@django.test.utils.override_settings(
+    ACCOUNTS_AUDIT_LOG_EVENT_MODEL='accountsplus.UnitTestAuditLogEvent',
+    ACCOUNTS_ENABLE_AUDIT_LOG=True,
+)
+class PostMigrateSearchTestCase(django.test.TestCase):
+    def test_post_migrate_install_fails(self):
+        UnitTestAuditLogEvent.objects.create(user_id=1, user_email='alice@example.com', message='Sign in')
+        with mock.patch.object(search.SQLiteSearchBackend, 'install',
+                               side_effect=django.db.OperationalError('no such module: fts5')):
+            search.post_migrate_callback(sender=None, using=django.db.DEFAULT_DB_ALIAS)
+        # searches fall back to LIKE filters
+        with django.test.utils.CaptureQueriesContext(django.db.connection) as queries:
+            self.assertEqual(search.search_audit_events(UnitTestAuditLogEvent.objects.all(), 'alice').count(), 1)
+        self.assertTrue(any('LIKE' in q['sql'] for q in queries))
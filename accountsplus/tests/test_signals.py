@@ -1,5 +1,7 @@
 from __future__ import unicode_literals
 
+import django.core.cache
+import django.core.exceptions
 import django.test
 import django.test.utils
 
@@ -9,7 +11,7 @@ import mock
 import accountsplus.models
 import accountsplus.signals
 
-from .. import signals, models
+from .. import events, masquerading, signals, models
 from test_models import (UnitTestCompany, UnitTestUser, UnitTestAuditLogEvent)
 
 logging.disable(logging.CRITICAL)
@@ -42,6 +44,9 @@ class SignalTestCase(django.test.TestCase):
         regular_user.save()
 
     def setUp(self):
+        # company names are cached by id, and ids are reused between tests
+        django.core.cache.cache.clear()
+
         self.session_dict = {
             'is_masquerading': False,
         }
@@ -52,6 +57,9 @@ class SignalTestCase(django.test.TestCase):
             'masquerade_is_superuser': True,
         }
 
+        self.session_dict_masquerade_with_email = dict(self.session_dict_masquerade)
+        self.session_dict_masquerade_with_email['masquerade_user_email'] = 'superuser@example.com'
+
         def get_item_generator(session_dict):
             def get_item(k, default=None):
                 if k in session_dict:
@@ -81,6 +89,15 @@ class SignalTestCase(django.test.TestCase):
         self.request_masquerade.session.get.side_effect = get_item_generator(self.session_dict_masquerade)
         self.request_masquerade.user = self.user_2
 
+        # create a mock request for a masquerade that stored the masquerading user's email in the session
+        self.request_masquerade_with_email = mock.MagicMock()
+        self.request_masquerade_with_email.session = mock.MagicMock(spec_set=dict)
+        self.request_masquerade_with_email.session.__getitem__.side_effect = get_item_generator(
+            self.session_dict_masquerade_with_email)
+        self.request_masquerade_with_email.session.get.side_effect = get_item_generator(
+            self.session_dict_masquerade_with_email)
+        self.request_masquerade_with_email.user = self.user_2
+
 
 @django.test.utils.override_settings(
     AUTH_USER_MODEL='accountsplus.UnitTestUser',
@@ -95,6 +112,24 @@ class AuditLogEventHelperCase(SignalTestCase):
     def test_is_audit_log_enabled_false(self):
         self.assertFalse(signals.is_audit_log_enabled())
 
+    @django.test.utils.override_settings(ACCOUNTS_ENABLE_AUDIT_LOG=True)
+    def test_configure_audit_log_enabled(self):
+        self.assertIs(signals.get_audit_log_model(), UnitTestAuditLogEvent)
+        for signal, callback in signals.AUDIT_LOG_RECEIVERS:
+            self.assertIn(callback, signal._live_receivers(self))
+
+    @django.test.utils.override_settings(ACCOUNTS_ENABLE_AUDIT_LOG=False)
+    def test_configure_audit_log_disabled(self):
+        self.assertIsNone(signals.get_audit_log_model())
+        for signal, callback in signals.AUDIT_LOG_RECEIVERS:
+            self.assertNotIn(callback, signal._live_receivers(self))
+
+    @django.test.utils.override_settings(
+        ACCOUNTS_ENABLE_AUDIT_LOG=False, ACCOUNTS_AUDIT_LOG_EVENT_MODEL='accountsplus.Unknown')
+    def test_configure_audit_log_unknown_model(self):
+        with mock.patch.object(signals, 'is_audit_log_enabled', return_value=True):
+            self.assertRaises(django.core.exceptions.ImproperlyConfigured, signals.configure_audit_log)
+
     @django.test.utils.override_settings(ACCOUNTS_ENABLE_AUDIT_LOG=True)
     def test_log_audit_event(self):
         signals.log_audit_event(message='Test', request=self.request, user=self.user_1)
@@ -105,6 +140,8 @@ class AuditLogEventHelperCase(SignalTestCase):
         self.assertEqual(audit_log_event.masquerading_user_id, None)
         self.assertEqual(audit_log_event.masquerading_user_email, '')
         self.assertEqual(audit_log_event.message, 'Test')
+        self.assertIsNone(audit_log_event.event_type)
+        self.assertEqual(audit_log_event.get_message(), 'Test')
 
     @django.test.utils.override_settings(ACCOUNTS_ENABLE_AUDIT_LOG=True)
     def test_log_audit_event_masquerade(self):
@@ -117,6 +154,29 @@ class AuditLogEventHelperCase(SignalTestCase):
         self.assertEqual(audit_log_event.masquerading_user_email, 'superuser@example.com')
         self.assertEqual(audit_log_event.message, 'Test')
 
+    @django.test.utils.override_settings(ACCOUNTS_ENABLE_AUDIT_LOG=True)
+    def test_log_audit_event_masquerade_no_user_query(self):
+        # the company name is cached by the first event, so only the audit log insert is left
+        signals.log_audit_event(message='Test', request=self.request, user=self.user_1)
+        UnitTestAuditLogEvent.objects.all().delete()
+        with self.assertNumQueries(1):
+            signals.log_audit_event(message='Test', request=self.request_masquerade_with_email, user=self.user_2)
+        audit_log_event = UnitTestAuditLogEvent.objects.get()
+        self.assertEqual(audit_log_event.masquerading_user_id, 1)
+        self.assertEqual(audit_log_event.masquerading_user_email, 'superuser@example.com')
+
+    @django.test.utils.override_settings(ACCOUNTS_ENABLE_AUDIT_LOG=True, ACCOUNTS_MASQUERADE_TOKENS=True)
+    def test_log_audit_event_masquerade_token(self):
+        # with masquerade tokens the masquerade is the one MasqueradeMiddleware read from the token, not the session's
+        self.request.masquerade = masquerading.Masquerade(1, 'superuser@example.com', True, masquerade_as_id=2)
+        self.request_masquerade.masquerade = None
+        signals.log_audit_event(message='Test', request=self.request, user=self.user_2)
+        signals.log_audit_event(message='Test', request=self.request_masquerade, user=self.user_2)
+        masquerade_event, event = UnitTestAuditLogEvent.objects.order_by('id')
+        self.assertEqual(masquerade_event.masquerading_user_id, 1)
+        self.assertEqual(masquerade_event.masquerading_user_email, 'superuser@example.com')
+        self.assertIsNone(event.masquerading_user_id)
+
     @django.test.utils.override_settings(ACCOUNTS_ENABLE_AUDIT_LOG=False)
     def test_log_audit_event_no_audit_log(self):
         signals.log_audit_event(message='Test', request=self.request, user=self.user_1)
@@ -127,6 +187,39 @@ class AuditLogEventHelperCase(SignalTestCase):
         signals.log_audit_event(message='Test', request=self.request_masquerade, user=self.user_2)
         self.assertEqual(0, UnitTestAuditLogEvent.objects.count())
 
+    @django.test.utils.override_settings(ACCOUNTS_ENABLE_AUDIT_LOG=True)
+    def test_log_audit_event_company_cache(self):
+        # the first event loads the company name only, the others read it from the cache
+        with self.assertNumQueries(2):
+            signals.log_audit_event(message='Test', request=self.request, user=self.user_1)
+        for user in (UnitTestUser.objects.get(pk=2), UnitTestUser.objects.get(pk=3)):
+            with self.assertNumQueries(1):
+                signals.log_audit_event(message='Test', request=self.request, user=user)
+        self.assertListEqual(
+            list(UnitTestAuditLogEvent.objects.values_list('company_id', 'company_name').distinct()), [(1, 'Example')])
+
+    @django.test.utils.override_settings(ACCOUNTS_ENABLE_AUDIT_LOG=True)
+    def test_log_audit_event_company_cache_invalidation(self):
+        signals.log_audit_event(message='Test', request=self.request, user=self.user_1)
+        self.company_1.name = 'Renamed'
+        self.company_1.save()
+        e = signals.log_audit_event(message='Test', request=self.request, user=self.user_2)
+        self.assertEqual(e.company_name, 'Renamed')
+        UnitTestCompany.objects.filter(pk=1).update(name='Renamed Again')
+        signals.company_name_change_callback(
+            sender=self, request=self.request, user=self.user_3, company=self.company_1, old_name='Renamed',
+            new_name='Renamed Again')
+        e = signals.log_audit_event(message='Test', request=self.request, user=self.user_2)
+        self.assertEqual(e.company_name, 'Renamed Again')
+
+    @django.test.utils.override_settings(ACCOUNTS_ENABLE_AUDIT_LOG=True)
+    def test_log_audit_event_no_company(self):
+        user = UnitTestUser.objects.create_user(email='nocompany@example.com', password='password')
+        with self.assertNumQueries(1):
+            e = signals.log_audit_event(message='Test', request=self.request, user=user)
+        self.assertIsNone(e.company_id)
+        self.assertEqual(e.company_name, '')
+
 
 @django.test.utils.override_settings(
     AUTH_USER_MODEL='accountsplus.UnitTestUser',
@@ -142,7 +235,7 @@ class LoginCallbackTestCase(SignalTestCase):
         self.assertEqual(audit_log_event.company_id, 1)
         self.assertEqual(audit_log_event.masquerading_user_id, None)
         self.assertEqual(audit_log_event.masquerading_user_email, '')
-        self.assertEqual(audit_log_event.message, 'Sign in')
+        self.assertEqual(audit_log_event.get_message(), 'Sign in')
 
     @django.test.utils.override_settings(ACCOUNTS_ENABLE_AUDIT_LOG=True)
     def test_login_callback_masquerade(self):
@@ -153,7 +246,7 @@ class LoginCallbackTestCase(SignalTestCase):
         self.assertEqual(audit_log_event.company_id, 1)
         self.assertEqual(audit_log_event.masquerading_user_id, 1)
         self.assertEqual(audit_log_event.masquerading_user_email, 'superuser@example.com')
-        self.assertEqual(audit_log_event.message, 'Sign in')
+        self.assertEqual(audit_log_event.get_message(), 'Sign in')
 
     @django.test.utils.override_settings(ACCOUNTS_ENABLE_AUDIT_LOG=False)
     def test_login_callback_no_audit_log(self):
@@ -165,6 +258,7 @@ class LoginCallbackTestCase(SignalTestCase):
         signals.login_callback(sender=self, request=self.request_masquerade, user=self.user_2)
         self.assertEqual(0, UnitTestAuditLogEvent.objects.count())
 
+    @django.test.utils.override_settings(ACCOUNTS_ENABLE_AUDIT_LOG=True)
     def test_signal_registration(self):
         import django.contrib.auth.signals
         receivers = django.contrib.auth.signals.user_logged_in._live_receivers(self)
@@ -185,7 +279,7 @@ class LogoutCallbackTestCase(SignalTestCase):
         self.assertEqual(audit_log_event.company_id, 1)
         self.assertEqual(audit_log_event.masquerading_user_id, None)
         self.assertEqual(audit_log_event.masquerading_user_email, '')
-        self.assertEqual(audit_log_event.message, 'Sign out')
+        self.assertEqual(audit_log_event.get_message(), 'Sign out')
 
     @django.test.utils.override_settings(ACCOUNTS_ENABLE_AUDIT_LOG=True)
     def test_logout_callback_masquerade(self):
@@ -196,7 +290,7 @@ class LogoutCallbackTestCase(SignalTestCase):
         self.assertEqual(audit_log_event.company_id, 1)
         self.assertEqual(audit_log_event.masquerading_user_id, 1)
         self.assertEqual(audit_log_event.masquerading_user_email, 'superuser@example.com')
-        self.assertEqual(audit_log_event.message, 'Sign out')
+        self.assertEqual(audit_log_event.get_message(), 'Sign out')
 
     @django.test.utils.override_settings(ACCOUNTS_ENABLE_AUDIT_LOG=False)
     def test_logout_callback_no_audit_log(self):
@@ -208,6 +302,7 @@ class LogoutCallbackTestCase(SignalTestCase):
         signals.logout_callback(sender=self, request=self.request_masquerade, user=self.user_2)
         self.assertEqual(0, UnitTestAuditLogEvent.objects.count())
 
+    @django.test.utils.override_settings(ACCOUNTS_ENABLE_AUDIT_LOG=True)
     def test_signal_registration(self):
         import django.contrib.auth.signals
         receivers = django.contrib.auth.signals.user_logged_out._live_receivers(self)
@@ -221,20 +316,26 @@ class LogoutCallbackTestCase(SignalTestCase):
 class MasqueradeStartCallbackTestCase(SignalTestCase):
     @django.test.utils.override_settings(ACCOUNTS_ENABLE_AUDIT_LOG=True)
     def test_masquerade_start_callback(self):
-        signals.masquerade_start_callback(sender=self, request=self.request, user=self.user_1, masquerade_as=self.user_2)
+        signals.masquerade_start_callback(
+            sender=self, request=self.request, user=self.user_1, masquerade_as=self.user_2)
         audit_log_event = UnitTestAuditLogEvent.objects.get()
         self.assertEqual(audit_log_event.user_id, 1)
         self.assertEqual(audit_log_event.user_email, 'superuser@example.com')
         self.assertEqual(audit_log_event.company_id, 1)
         self.assertIsNone(audit_log_event.masquerading_user_id)
         self.assertEqual(audit_log_event.masquerading_user_email, '')
-        self.assertEqual(audit_log_event.message, 'Masquerade start as staffuser@example.com (2)')
+        self.assertEqual(audit_log_event.get_message(), 'Masquerade start as staffuser@example.com (2)')
+        self.assertEqual(audit_log_event.event_type, events.MASQUERADE_START)
+        self.assertDictEqual(
+            audit_log_event.data, {'masquerade_as_id': 2, 'masquerade_as_email': 'staffuser@example.com', })
 
     @django.test.utils.override_settings(ACCOUNTS_ENABLE_AUDIT_LOG=False)
     def test_masquerade_start_callback_no_audit_log(self):
-        signals.masquerade_start_callback(sender=self, request=self.request, user=self.user_1, masquerade_as=self.user_2)
+        signals.masquerade_start_callback(
+            sender=self, request=self.request, user=self.user_1, masquerade_as=self.user_2)
         self.assertEqual(0, UnitTestAuditLogEvent.objects.count())
 
+    @django.test.utils.override_settings(ACCOUNTS_ENABLE_AUDIT_LOG=True)
     def test_signal_registration(self):
         receivers = accountsplus.signals.masquerade_start._live_receivers(self)
         self.assertIn(signals.masquerade_start_callback, receivers)
@@ -254,13 +355,14 @@ class MasqueradeEndCallbackTestCase(SignalTestCase):
         self.assertEqual(audit_log_event.company_id, 1)
         self.assertIsNone(audit_log_event.masquerading_user_id)
         self.assertEqual(audit_log_event.masquerading_user_email, '')
-        self.assertEqual(audit_log_event.message, 'Masquerade end as staffuser@example.com (2)')
+        self.assertEqual(audit_log_event.get_message(), 'Masquerade end as staffuser@example.com (2)')
 
     @django.test.utils.override_settings(ACCOUNTS_ENABLE_AUDIT_LOG=False)
     def test_masquerade_end_callback_no_audit_log(self):
         signals.masquerade_end_callback(sender=self, request=self.request, user=self.user_1, masquerade_as=self.user_2)
         self.assertEqual(0, UnitTestAuditLogEvent.objects.count())
 
+    @django.test.utils.override_settings(ACCOUNTS_ENABLE_AUDIT_LOG=True)
     def test_signal_registration(self):
         receivers = accountsplus.signals.masquerade_end._live_receivers(self)
         self.assertIn(signals.masquerade_end_callback, receivers)
@@ -280,7 +382,7 @@ class PasswordResetCallbackTestCase(SignalTestCase):
         self.assertEqual(audit_log_event.company_id, 1)
         self.assertEqual(audit_log_event.masquerading_user_id, None)
         self.assertEqual(audit_log_event.masquerading_user_email, '')
-        self.assertEqual(audit_log_event.message, 'Request password reset')
+        self.assertEqual(audit_log_event.get_message(), 'Request password reset')
 
     @django.test.utils.override_settings(ACCOUNTS_ENABLE_AUDIT_LOG=True)
     def test_password_reset_callback_masquerade(self):
@@ -291,7 +393,7 @@ class PasswordResetCallbackTestCase(SignalTestCase):
         self.assertEqual(audit_log_event.company_id, 1)
         self.assertEqual(audit_log_event.masquerading_user_id, 1)
         self.assertEqual(audit_log_event.masquerading_user_email, 'superuser@example.com')
-        self.assertEqual(audit_log_event.message, 'Request password reset')
+        self.assertEqual(audit_log_event.get_message(), 'Request password reset')
 
     @django.test.utils.override_settings(ACCOUNTS_ENABLE_AUDIT_LOG=False)
     def test_password_reset_callback_no_audit_log(self):
@@ -303,6 +405,7 @@ class PasswordResetCallbackTestCase(SignalTestCase):
         signals.password_reset_request_callback(sender=self, request=self.request_masquerade, user=self.user_2)
         self.assertEqual(0, UnitTestAuditLogEvent.objects.count())
 
+    @django.test.utils.override_settings(ACCOUNTS_ENABLE_AUDIT_LOG=True)
     def test_signal_registration(self):
         receivers = accountsplus.signals.user_password_reset_request._live_receivers(self)
         self.assertIn(signals.password_reset_request_callback, receivers)
@@ -322,7 +425,7 @@ class PasswordChangeCallbackTestCase(SignalTestCase):
         self.assertEqual(audit_log_event.company_id, 1)
         self.assertEqual(audit_log_event.masquerading_user_id, None)
         self.assertEqual(audit_log_event.masquerading_user_email, '')
-        self.assertEqual(audit_log_event.message, 'Change password')
+        self.assertEqual(audit_log_event.get_message(), 'Change password')
 
     @django.test.utils.override_settings(ACCOUNTS_ENABLE_AUDIT_LOG=True)
     def test_password_change_callback_masquerade(self):
@@ -333,7 +436,7 @@ class PasswordChangeCallbackTestCase(SignalTestCase):
         self.assertEqual(audit_log_event.company_id, 1)
         self.assertEqual(audit_log_event.masquerading_user_id, 1)
         self.assertEqual(audit_log_event.masquerading_user_email, 'superuser@example.com')
-        self.assertEqual(audit_log_event.message, 'Change password')
+        self.assertEqual(audit_log_event.get_message(), 'Change password')
 
     @django.test.utils.override_settings(ACCOUNTS_ENABLE_AUDIT_LOG=False)
     def test_password_change_callback_no_audit_log(self):
@@ -345,6 +448,7 @@ class PasswordChangeCallbackTestCase(SignalTestCase):
         signals.password_change_callback(sender=self, request=self.request_masquerade, user=self.user_2)
         self.assertEqual(0, UnitTestAuditLogEvent.objects.count())
 
+    @django.test.utils.override_settings(ACCOUNTS_ENABLE_AUDIT_LOG=True)
     def test_signal_registration(self):
         receivers = accountsplus.signals.user_password_change._live_receivers(self)
         self.assertIn(signals.password_change_callback, receivers)
@@ -364,7 +468,7 @@ class CreateCallbackTestCase(SignalTestCase):
         self.assertEqual(audit_log_event.company_id, 1)
         self.assertEqual(audit_log_event.masquerading_user_id, None)
         self.assertEqual(audit_log_event.masquerading_user_email, '')
-        self.assertEqual(audit_log_event.message, 'Create by: superuser@example.com (1)')
+        self.assertEqual(audit_log_event.get_message(), 'Create by: superuser@example.com (1)')
 
     @django.test.utils.override_settings(ACCOUNTS_ENABLE_AUDIT_LOG=True)
     def test_create_callback_masquerade(self):
@@ -375,7 +479,7 @@ class CreateCallbackTestCase(SignalTestCase):
         self.assertEqual(audit_log_event.company_id, 1)
         self.assertEqual(audit_log_event.masquerading_user_id, 1)
         self.assertEqual(audit_log_event.masquerading_user_email, 'superuser@example.com')
-        self.assertEqual(audit_log_event.message, 'Create by: staffuser@example.com (2)')
+        self.assertEqual(audit_log_event.get_message(), 'Create by: staffuser@example.com (2)')
 
     @django.test.utils.override_settings(ACCOUNTS_ENABLE_AUDIT_LOG=False)
     def test_create_callback_no_audit_log(self):
@@ -387,6 +491,7 @@ class CreateCallbackTestCase(SignalTestCase):
         signals.create_callback(sender=self, request=self.request_masquerade, user=self.user_3)
         self.assertEqual(0, UnitTestAuditLogEvent.objects.count())
 
+    @django.test.utils.override_settings(ACCOUNTS_ENABLE_AUDIT_LOG=True)
     def test_signal_registration(self):
         receivers = accountsplus.signals.user_create._live_receivers(self)
         self.assertIn(signals.create_callback, receivers)
@@ -408,7 +513,12 @@ class EmailChangeCallbackTestCase(SignalTestCase):
         self.assertEqual(audit_log_event.company_id, 1)
         self.assertEqual(audit_log_event.masquerading_user_id, None)
         self.assertEqual(audit_log_event.masquerading_user_email, '')
-        self.assertEqual(audit_log_event.message, 'Email change from: regularuser@example.com to: change@example.com')
+        self.assertEqual(
+            audit_log_event.get_message(), 'Email change from: regularuser@example.com to: change@example.com')
+        self.assertEqual(audit_log_event.event_type, events.EMAIL_CHANGE)
+        self.assertEqual(audit_log_event.message, '')
+        self.assertDictEqual(
+            audit_log_event.data, {'old_email': 'regularuser@example.com', 'new_email': 'change@example.com', })
 
     @django.test.utils.override_settings(ACCOUNTS_ENABLE_AUDIT_LOG=True)
     def test_email_change_callback_masquerade(self):
@@ -421,7 +531,8 @@ class EmailChangeCallbackTestCase(SignalTestCase):
         self.assertEqual(audit_log_event.company_id, 1)
         self.assertEqual(audit_log_event.masquerading_user_id, 1)
         self.assertEqual(audit_log_event.masquerading_user_email, 'superuser@example.com')
-        self.assertEqual(audit_log_event.message, 'Email change from: regularuser@example.com to: change@example.com')
+        self.assertEqual(
+            audit_log_event.get_message(), 'Email change from: regularuser@example.com to: change@example.com')
 
     @django.test.utils.override_settings(ACCOUNTS_ENABLE_AUDIT_LOG=False)
     def test_email_change_callback_no_audit_log(self):
@@ -437,6 +548,7 @@ class EmailChangeCallbackTestCase(SignalTestCase):
             new_email='change@example.com')
         self.assertEqual(0, UnitTestAuditLogEvent.objects.count())
 
+    @django.test.utils.override_settings(ACCOUNTS_ENABLE_AUDIT_LOG=True)
     def test_signal_registration(self):
         receivers = accountsplus.signals.user_email_change._live_receivers(self)
         self.assertIn(signals.email_change_callback, receivers)
@@ -456,7 +568,7 @@ class DeactivateCallbackTestCase(SignalTestCase):
         self.assertEqual(audit_log_event.company_id, 1)
         self.assertEqual(audit_log_event.masquerading_user_id, None)
         self.assertEqual(audit_log_event.masquerading_user_email, '')
-        self.assertEqual(audit_log_event.message, 'Deactivate by: superuser@example.com (1)')
+        self.assertEqual(audit_log_event.get_message(), 'Deactivate by: superuser@example.com (1)')
 
     @django.test.utils.override_settings(ACCOUNTS_ENABLE_AUDIT_LOG=True)
     def test_deactivate_callback_masquerade(self):
@@ -467,7 +579,7 @@ class DeactivateCallbackTestCase(SignalTestCase):
         self.assertEqual(audit_log_event.company_id, 1)
         self.assertEqual(audit_log_event.masquerading_user_id, 1)
         self.assertEqual(audit_log_event.masquerading_user_email, 'superuser@example.com')
-        self.assertEqual(audit_log_event.message, 'Deactivate by: staffuser@example.com (2)')
+        self.assertEqual(audit_log_event.get_message(), 'Deactivate by: staffuser@example.com (2)')
 
     @django.test.utils.override_settings(ACCOUNTS_ENABLE_AUDIT_LOG=False)
     def test_deactivate_callback_no_audit_log(self):
@@ -479,6 +591,7 @@ class DeactivateCallbackTestCase(SignalTestCase):
         signals.deactivate_callback(sender=self, request=self.request_masquerade, user=self.user_3)
         self.assertEqual(0, UnitTestAuditLogEvent.objects.count())
 
+    @django.test.utils.override_settings(ACCOUNTS_ENABLE_AUDIT_LOG=True)
     def test_signal_registration(self):
         receivers = accountsplus.signals.user_deactivate._live_receivers(self)
         self.assertIn(signals.deactivate_callback, receivers)
@@ -498,7 +611,7 @@ class ActivateCallbackTestCase(SignalTestCase):
         self.assertEqual(audit_log_event.company_id, 1)
         self.assertEqual(audit_log_event.masquerading_user_id, None)
         self.assertEqual(audit_log_event.masquerading_user_email, '')
-        self.assertEqual(audit_log_event.message, 'Activate by: superuser@example.com (1)')
+        self.assertEqual(audit_log_event.get_message(), 'Activate by: superuser@example.com (1)')
 
     @django.test.utils.override_settings(ACCOUNTS_ENABLE_AUDIT_LOG=True)
     def test_activate_callback_masquerade(self):
@@ -509,7 +622,7 @@ class ActivateCallbackTestCase(SignalTestCase):
         self.assertEqual(audit_log_event.company_id, 1)
         self.assertEqual(audit_log_event.masquerading_user_id, 1)
         self.assertEqual(audit_log_event.masquerading_user_email, 'superuser@example.com')
-        self.assertEqual(audit_log_event.message, 'Activate by: staffuser@example.com (2)')
+        self.assertEqual(audit_log_event.get_message(), 'Activate by: staffuser@example.com (2)')
 
     @django.test.utils.override_settings(ACCOUNTS_ENABLE_AUDIT_LOG=False)
     def test_activate_callback_no_audit_log(self):
@@ -521,6 +634,7 @@ class ActivateCallbackTestCase(SignalTestCase):
         signals.activate_callback(sender=self, request=self.request_masquerade, user=self.user_3)
         self.assertEqual(0, UnitTestAuditLogEvent.objects.count())
 
+    @django.test.utils.override_settings(ACCOUNTS_ENABLE_AUDIT_LOG=True)
     def test_signal_registration(self):
         receivers = accountsplus.signals.user_activate._live_receivers(self)
         self.assertIn(signals.activate_callback, receivers)
@@ -541,7 +655,7 @@ class CompanyNameChangeCallbackTestCase(SignalTestCase):
         self.assertEqual(audit_log_event.company_id, 1)
         self.assertEqual(audit_log_event.masquerading_user_id, None)
         self.assertEqual(audit_log_event.masquerading_user_email, '')
-        self.assertEqual(audit_log_event.message, 'Company id: 2 name change from: Old Name to: New Name')
+        self.assertEqual(audit_log_event.get_message(), 'Company id: 2 name change from: Old Name to: New Name')
 
     @django.test.utils.override_settings(ACCOUNTS_ENABLE_AUDIT_LOG=True)
     def test_company_name_change_callback_masquerade(self):
@@ -554,7 +668,7 @@ class CompanyNameChangeCallbackTestCase(SignalTestCase):
         self.assertEqual(audit_log_event.company_id, 1)
         self.assertEqual(audit_log_event.masquerading_user_id, 1)
         self.assertEqual(audit_log_event.masquerading_user_email, 'superuser@example.com')
-        self.assertEqual(audit_log_event.message, 'Company id: 2 name change from: Old Name to: New Name')
+        self.assertEqual(audit_log_event.get_message(), 'Company id: 2 name change from: Old Name to: New Name')
 
     @django.test.utils.override_settings(ACCOUNTS_ENABLE_AUDIT_LOG=False)
     def test_company_name_change_callback_no_audit_log(self):
@@ -569,6 +683,7 @@ class CompanyNameChangeCallbackTestCase(SignalTestCase):
             new_name='New Name')
         self.assertEqual(0, UnitTestAuditLogEvent.objects.count())
 
+    @django.test.utils.override_settings(ACCOUNTS_ENABLE_AUDIT_LOG=True)
     def test_signal_registration(self):
         receivers = accountsplus.signals.company_name_change._live_receivers(self)
         self.assertIn(signals.company_name_change_callback, receivers)
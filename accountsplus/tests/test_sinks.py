@@ -0,0 +1,256 @@
+from __future__ import unicode_literals
+
+import io
+import json
+import logging
+import os
+import shutil
+import socket
+import tempfile
+import threading
+
+import django.core.exceptions
+import django.test
+import django.test.utils
+
+from .. import events, signals, sinks, writers
+from test_models import (UnitTestAuditLogEvent, )
+from test_signals import SignalTestCase
+
+
+logging.disable(logging.CRITICAL)
+
+
+def make_event(message='Test', event_type=None):
+    return UnitTestAuditLogEvent(
+        user_id=1, user_email='superuser@example.com', message=message, event_type=event_type)
+
+
+def read_lines(path):
+    with io.open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f]
+
+
+class FailingSink(sinks.AuditLogSink):
+    def send(self, events):
+        raise IOError('unavailable')
+
+
+class FlakySink(sinks.AuditLogSink):
+    def __init__(self, *args, **kwargs):
+        super(FlakySink, self).__init__(*args, **kwargs)
+        self.sent = []
+
+    def send(self, events):
+        if not self.errors:
+            raise IOError('unavailable')
+        self.sent.extend(events)
+
+
+class SinkTestCase(django.test.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_database_sink(self):
+        sink = sinks.DatabaseSink('database', batch_size=2, flush_interval=0)
+        sink.write(make_event('1'))
+        self.assertEqual(UnitTestAuditLogEvent.objects.count(), 0)
+        with self.assertNumQueries(1):
+            sink.write(make_event('2'))
+        self.assertEqual(UnitTestAuditLogEvent.objects.count(), 2)
+        stats = sink.stats()
+        self.assertEqual(stats['written'], 2)
+        self.assertEqual(stats['batches'], 1)
+        self.assertEqual(stats['errors'], 0)
+        self.assertGreaterEqual(stats['max_latency'], stats['average_latency'])
+
+    def test_rotating_file_sink(self):
+        path = os.path.join(self.directory, 'audit.jsonl')
+        sink = sinks.RotatingFileSink('file', path, max_bytes=1000, backup_count=2, batch_size=3, flush_interval=0)
+        for i in range(12):
+            sink.write(make_event(str(i)))
+        # every batch of three events is about 600 bytes, so each batch starts a new file
+        self.assertListEqual([e['message'] for e in read_lines(path)], ['9', '10', '11'])
+        self.assertListEqual([e['message'] for e in read_lines(path + '.1')], ['6', '7', '8'])
+        self.assertListEqual([e['message'] for e in read_lines(path + '.2')], ['3', '4', '5'])
+        self.assertFalse(os.path.exists(path + '.3'))
+        self.assertEqual(read_lines(path)[0]['model'], 'accountsplus.UnitTestAuditLogEvent')
+
+    def test_rotating_file_sink_shared_path(self):
+        # sinks of several processes rotate the same file without losing or tearing lines
+        path = os.path.join(self.directory, 'audit.jsonl')
+        file_sinks = [sinks.RotatingFileSink('file', path, max_bytes=1000, backup_count=1000) for i in range(4)]
+
+        def send(sink, worker):
+            for i in range(25):
+                sink.send([make_event('{}-{}'.format(worker, i))])
+        threads = [threading.Thread(target=send, args=(sink, worker)) for worker, sink in enumerate(file_sinks)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        names = [name for name in os.listdir(self.directory) if name != 'audit.jsonl.lock']
+        paths = [os.path.join(self.directory, name) for name in names]
+        messages = [e['message'] for p in paths for e in read_lines(p)]
+        self.assertEqual(len(messages), 100)
+        self.assertEqual(len(set(messages)), 100)
+
+    def test_unix_socket_sink(self):
+        path = os.path.join(self.directory, 'collector.sock')
+        sink = sinks.UnixSocketSink('socket', path, batch_size=10, flush_interval=0)
+        sink.write(make_event('1'))
+        # nothing is listening yet, so the batch is kept
+        self.assertEqual(sink.flush(), 0)
+        self.assertEqual(sink.stats()['errors'], 1)
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+        server.listen(1)
+        try:
+            sink.write(make_event('2'))
+            self.assertEqual(sink.flush(), 2)
+            sink.close()
+            connection, address = server.accept()
+            data = connection.makefile().read()
+            connection.close()
+        finally:
+            server.close()
+        self.assertListEqual([json.loads(line)['message'] for line in data.splitlines()], ['1', '2'])
+
+    def test_backpressure_drop(self):
+        sink = FailingSink('failing', batch_size=10, flush_interval=0, max_queue_size=10)
+        for i in range(15):
+            sink.write(make_event(str(i)))
+        self.assertEqual(sink.stats()['dropped'], 5)
+        self.assertEqual(sink.queue[0].message, '5')
+
+    def test_backpressure_block(self):
+        sink = FlakySink('flaky', batch_size=2, flush_interval=0, max_queue_size=2, backpressure='block')
+        for i in range(3):
+            sink.write(make_event(str(i)))
+        # the first batch failed and filled the queue, so the caller sent it again instead of dropping an event
+        self.assertEqual(sink.stats()['dropped'], 0)
+        self.assertListEqual([e.message for e in sink.sent], ['0', '1'])
+        self.assertListEqual([e.message for e in sink.queue], ['2'])
+
+    def test_backpressure_block_timeout(self):
+        sink = FailingSink('failing', batch_size=2, flush_interval=0, max_queue_size=2, backpressure='block',
+                           block_timeout=0)
+        for i in range(3):
+            sink.write(make_event(str(i)))
+        self.assertEqual(sink.stats()['dropped'], 1)
+        self.assertGreaterEqual(sink.stats()['errors'], 2)
+
+    def test_backpressure_spill(self):
+        sink = FailingSink('failing', batch_size=2, flush_interval=0, max_queue_size=2, backpressure='spill',
+                           spill_dir=self.directory)
+        for i in range(5):
+            sink.write(make_event(str(i)))
+        # failed batches are spilled rather than queued again
+        sink.spill_spool.seal()
+        self.assertListEqual(
+            [e['message'] for path in sink.spill_spool.segments() for e in sink.spill_spool.read_segment(path)],
+            ['0', '1', '2', '3'])
+        self.assertEqual(sink.stats()['spilled'], 4)
+        self.assertEqual(sink.stats()['dropped'], 0)
+
+    def test_backpressure_spill_coalesced(self):
+        # the occurrences counted for a spilled event are spilled with it
+        self.addCleanup(writers.set_coalescer, writers.get_coalescer())
+        writers.set_coalescer(writers.AuditLogCoalescer(window=60))
+        sink = FailingSink('failing', batch_size=3, flush_interval=0, backpressure='spill', spill_dir=self.directory,
+                           coalesce=True)
+        for i in range(3):
+            sink.write(make_event())
+        sink.spill_spool.seal()
+        spilled = [e for path in sink.spill_spool.segments() for e in sink.spill_spool.read_segment(path)]
+        self.assertListEqual([e['occurrences'] for e in spilled], [3])
+        self.assertEqual(len(writers.get_coalescer()), 0)
+        # nothing is left for the timer to close
+        self.assertIsNone(writers.get_coalescer().timer)
+
+    def test_invalid_backpressure(self):
+        self.assertRaises(django.core.exceptions.ImproperlyConfigured, sinks.DatabaseSink, 'database',
+                          backpressure='wait')
+        self.assertRaises(django.core.exceptions.ImproperlyConfigured, sinks.DatabaseSink, 'database',
+                          backpressure='spill')
+
+    def test_fanout(self):
+        database = sinks.DatabaseSink('database', event_types=[events.SIGN_IN], batch_size=10, flush_interval=0)
+        path = os.path.join(self.directory, 'audit.jsonl')
+        file_sink = sinks.RotatingFileSink('file', path, batch_size=10, flush_interval=0)
+        fanout = sinks.AuditLogFanout([database, file_sink])
+        fanout.write(make_event('', events.SIGN_IN))
+        fanout.write(make_event('', events.SIGN_OUT))
+        fanout.flush()
+        self.assertListEqual(list(UnitTestAuditLogEvent.objects.values_list('event_type', flat=True)), [events.SIGN_IN])
+        self.assertListEqual([e['event_type'] for e in read_lines(path)], [events.SIGN_IN, events.SIGN_OUT])
+        self.assertEqual(fanout.stats()['file']['written'], 2)
+        self.assertEqual(fanout.stats()['database']['written'], 1)
+
+    def test_create_sink(self):
+        sink = sinks.create_sink('file', {
+            'BACKEND': 'accountsplus.sinks.RotatingFileSink',
+            'BATCH_SIZE': 7,
+            'BACKPRESSURE': 'spill',
+            'SPILL_DIR': self.directory,
+            'OPTIONS': {'path': os.path.join(self.directory, 'audit.jsonl'), 'max_bytes': 100, },
+        })
+        self.assertIsInstance(sink, sinks.RotatingFileSink)
+        self.assertEqual(sink.batch_size, 7)
+        self.assertEqual(sink.max_bytes, 100)
+        self.assertEqual(sink.backpressure, 'spill')
+        self.assertRaises(django.core.exceptions.ImproperlyConfigured, sinks.create_sink, 'x', {'BACKEND': 'x.Y'})
+
+
+@django.test.utils.override_settings(
+    AUTH_USER_MODEL='accountsplus.UnitTestUser',
+    ACCOUNTS_AUDIT_LOG_EVENT_MODEL='accountsplus.UnitTestAuditLogEvent',
+    ACCOUNTS_ENABLE_AUDIT_LOG=True,
+)
+class SinkLogAuditEventTestCase(SignalTestCase):
+    def test_log_audit_event_to_sinks(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'audit.jsonl')
+        with self.settings(ACCOUNTS_AUDIT_LOG_SINKS={
+            'database': {
+                'BACKEND': 'accountsplus.sinks.DatabaseSink',
+                'EVENT_TYPES': [events.PASSWORD_CHANGE],
+                'FLUSH_INTERVAL': 0,
+            },
+            'file': {
+                'BACKEND': 'accountsplus.sinks.RotatingFileSink',
+                'FLUSH_INTERVAL': 0,
+                'OPTIONS': {'path': path, },
+            },
+        }):
+            self.assertListEqual([s.name for s in signals.get_audit_log_sinks()], ['database', 'file'])
+            signals.login_callback(sender=self, request=self.request, user=self.user_1)
+            signals.password_change_callback(sender=self, request=self.request, user=self.user_1)
+            self.assertEqual(UnitTestAuditLogEvent.objects.count(), 0)
+        # the sinks are flushed when the setting changes
+        self.assertIsNone(signals.get_audit_log_sinks())
+        self.assertListEqual(
+            list(UnitTestAuditLogEvent.objects.values_list('event_type', flat=True)), [events.PASSWORD_CHANGE])
+        self.assertListEqual([e['event_type'] for e in read_lines(path)], [events.SIGN_IN, events.PASSWORD_CHANGE])
+
+    @django.test.utils.override_settings(ACCOUNTS_AUDIT_LOG_COALESCE_WINDOW=60)
+    def test_database_sink_coalesced(self):
+        # the database sink's rows are coalesced, other sinks get every event
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'audit.jsonl')
+        with self.settings(ACCOUNTS_AUDIT_LOG_SINKS={
+            'database': {'BACKEND': 'accountsplus.sinks.DatabaseSink', 'FLUSH_INTERVAL': 0, },
+            'file': {
+                'BACKEND': 'accountsplus.sinks.RotatingFileSink', 'FLUSH_INTERVAL': 0, 'OPTIONS': {'path': path, },
+            },
+        }):
+            for i in range(3):
+                signals.login_callback(sender=self, request=self.request, user=self.user_1)
+        self.assertListEqual(list(UnitTestAuditLogEvent.objects.values_list('occurrences', flat=True)), [3])
+        self.assertEqual(len(read_lines(path)), 3)
@@ -0,0 +1,166 @@
+from __future__ import unicode_literals
+
+import datetime
+import io
+import logging
+import os
+import shutil
+import tempfile
+
+import django.core.management
+import django.test
+import django.test.utils
+import django.utils.six
+import django.utils.timezone
+
+from .. import events, signals, spool
+from test_models import (UnitTestAuditLogEvent, )
+from test_signals import SignalTestCase
+
+
+logging.disable(logging.CRITICAL)
+
+
+def make_event(i):
+    return UnitTestAuditLogEvent(
+        user_id=i, user_email='user{}@example.com'.format(i), event_type=events.SIGN_IN,
+        recorded_on=django.utils.timezone.now() + datetime.timedelta(seconds=i))
+
+
+class SpoolTestCase(django.test.SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.spool = spool.AuditLogSpool(self.directory, fsync_interval=0)
+
+    def tearDown(self):
+        self.spool.close()
+        shutil.rmtree(self.directory)
+
+    def read_all(self, audit_log_spool=None):
+        audit_log_spool = audit_log_spool or self.spool
+        audit_log_spool.seal()
+        return [e['user_id'] for path in audit_log_spool.segments() for e in audit_log_spool.read_segment(path)]
+
+    def test_append_and_read(self):
+        self.spool.append([make_event(1), make_event(2)])
+        self.spool.append([make_event(3)])
+        self.assertListEqual(self.spool.segments(), [])
+        self.assertListEqual(self.read_all(), [1, 2, 3])
+        self.assertFalse(os.path.exists(self.spool.active_path))
+        # sealing an empty or missing active segment does nothing
+        self.assertIsNone(self.spool.seal())
+        self.assertEqual(len(self.spool.segments()), 1)
+
+    def test_segments_are_sealed_when_full(self):
+        audit_log_spool = spool.AuditLogSpool(self.directory, segment_bytes=1000)
+        for i in range(10):
+            audit_log_spool.append([make_event(i)])
+        self.assertGreater(len(audit_log_spool.segments()), 1)
+        self.assertListEqual(self.read_all(audit_log_spool), list(range(10)))
+        audit_log_spool.close()
+
+    def test_append_after_another_process_sealed(self):
+        self.spool.append([make_event(1)])
+        other = spool.AuditLogSpool(self.directory)
+        other.seal()
+        # the first spool notices the active segment was sealed and starts a new one instead of writing to the old one
+        self.spool.append([make_event(2)])
+        self.assertEqual(len(self.spool.segments()), 1)
+        self.assertListEqual(self.read_all(), [1, 2])
+
+    def test_concurrent_processes(self):
+        pids = []
+        for worker in range(4):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    audit_log_spool = spool.AuditLogSpool(self.directory, segment_bytes=5000, fsync_interval=0)
+                    for i in range(50):
+                        audit_log_spool.append([make_event(worker * 1000 + i)])
+                finally:
+                    os._exit(0)
+            pids.append(pid)
+        for pid in pids:
+            os.waitpid(pid, 0)
+        user_ids = self.read_all()
+        self.assertEqual(len(user_ids), 200)
+        self.assertEqual(len(set(user_ids)), 200)
+
+    def test_torn_line_is_skipped(self):
+        self.spool.append([make_event(1)])
+        with io.open(self.spool.active_path, 'ab') as f:
+            f.write(b'{"user_id": 2, "user_em')
+        self.assertListEqual(self.read_all(), [1])
+
+
+@django.test.utils.override_settings(
+    ACCOUNTS_AUDIT_LOG_EVENT_MODEL='accountsplus.UnitTestAuditLogEvent',
+)
+class DrainAuditSpoolTestCase(django.test.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.spool = spool.AuditLogSpool(self.directory)
+
+    def tearDown(self):
+        self.spool.close()
+        shutil.rmtree(self.directory)
+
+    def drain(self, **options):
+        out = django.utils.six.StringIO()
+        django.core.management.call_command('drain_audit_spool', directory=self.directory, stdout=out, **options)
+        return out.getvalue()
+
+    def test_drain(self):
+        self.spool.append([make_event(i) for i in range(5)])
+        self.assertIn('Loaded 5 audit log events', self.drain(chunk_size=2))
+        self.assertListEqual(
+            list(UnitTestAuditLogEvent.objects.order_by('user_id').values_list('user_id', flat=True)), list(range(5)))
+        e = UnitTestAuditLogEvent.objects.get(user_id=0)
+        self.assertEqual(e.event_type, events.SIGN_IN)
+        self.assertEqual(self.spool.segments(), [])
+        self.assertIn('Loaded 0 audit log events', self.drain())
+
+    def test_drain_is_idempotent(self):
+        spooled = [make_event(i) for i in range(3)]
+        self.spool.append(spooled)
+        self.drain()
+        # a drain interrupted before removing its segment loads the segment again
+        self.spool.append(spooled + [make_event(3)])
+        self.assertIn('Loaded 1 audit log events', self.drain())
+        self.assertEqual(UnitTestAuditLogEvent.objects.count(), 4)
+
+    def test_drain_large_chunk(self):
+        # the events already loaded are looked up in batches, below SQLite's limit of query parameters
+        spooled = [make_event(i) for i in range(1200)]
+        self.spool.append(spooled)
+        self.assertIn('Loaded 1200 audit log events', self.drain(chunk_size=1200))
+        self.spool.append(spooled)
+        self.assertIn('Loaded 0 audit log events', self.drain(chunk_size=1200))
+
+    def test_drain_requires_directory(self):
+        self.assertRaises(django.core.management.CommandError, django.core.management.call_command,
+                          'drain_audit_spool')
+
+
+@django.test.utils.override_settings(
+    AUTH_USER_MODEL='accountsplus.UnitTestUser',
+    ACCOUNTS_AUDIT_LOG_EVENT_MODEL='accountsplus.UnitTestAuditLogEvent',
+    ACCOUNTS_ENABLE_AUDIT_LOG=True,
+)
+class SpoolSinkTestCase(SignalTestCase):
+    def test_log_audit_event_to_spool(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with self.settings(ACCOUNTS_AUDIT_LOG_SINKS={
+            'spool': {'BACKEND': 'accountsplus.sinks.SpoolSink', 'OPTIONS': {'directory': directory, }, },
+        }):
+            # once the company name is cached the request path only appends to the spool
+            signals.logout_callback(sender=self, request=self.request, user=self.user_1)
+            with self.assertNumQueries(0):
+                signals.logout_callback(sender=self, request=self.request_masquerade_with_email, user=self.user_2)
+        out = django.utils.six.StringIO()
+        django.core.management.call_command('drain_audit_spool', directory=directory, stdout=out)
+        e = UnitTestAuditLogEvent.objects.get(user_id=2)
+        self.assertEqual(e.event_type, events.SIGN_OUT)
+        self.assertEqual(e.company_name, 'Example')
+        self.assertEqual(e.masquerading_user_email, 'superuser@example.com')
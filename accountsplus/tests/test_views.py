@@ -5,11 +5,14 @@ import django.test.utils
 import django.test.client
 from django.conf import settings
 import django.contrib.auth.models
+import django.core.cache
 import django.core.mail
 
 import logging
+import threading
 
-from test_models import (UnitTestCompany, UnitTestUser)
+from .. import events, masquerading
+from test_models import (UnitTestAuditLogEvent, UnitTestCompany, UnitTestUser)
 import test_admin
 
 
@@ -64,6 +67,8 @@ class MasqueradeStartTestCase(django.test.TestCase):
         group.permissions.add(permission_masquerade)
 
     def setUp(self):
+        # the registry of active masquerades is kept in the cache
+        django.core.cache.cache.clear()
         self.group_masquerade = django.contrib.auth.models.Group.objects.get(name='Masquerade')
 
     def test_user_masquerade_as_superuser(self):
@@ -75,6 +80,7 @@ class MasqueradeStartTestCase(django.test.TestCase):
         # test that the user is a masquerading user, and that the user that is masquerading as user 3 is user 1 (superuser)
         self.assertTrue(c.session['is_masquerading'])
         self.assertEqual(c.session['masquerade_user_id'], 1)
+        self.assertEqual(c.session['masquerade_user_email'], 'superuser@example.com')
         self.assertTrue(c.session['masquerade_is_superuser'])
         self.assertEqual(c.session['return_page'], 'admin:index')
 
@@ -260,6 +266,220 @@ class MasqueradeStartTestCase(django.test.TestCase):
         self.assertFalse('masquerade_is_superuser' in c.session)
         self.assertFalse('return_page' in c.session)
 
+    def test_user_masquerade_user_permission(self):
+        # the permission can be given to the user directly as well as through a group
+        u = UnitTestUser.objects.get(pk=2)
+        u.user_permissions.add(django.contrib.auth.models.Permission.objects.get(codename='masquerade'))
+        c = django.test.client.Client()
+        self.assertTrue(c.login(email='staffuser@example.com', password='password'))
+        c.get('/admin/masquerade/3/')
+        self.assertEqual(c.session['_auth_user_id'], '3')
+        self.assertEqual(c.session['masquerade_user_id'], 2)
+
+    def test_end_masquerade(self):
+        u = UnitTestUser.objects.get(pk=2)
+        u.groups.add(self.group_masquerade)
+        c = django.test.client.Client()
+        self.assertTrue(c.login(email='staffuser@example.com', password='password'))
+        c.get('/admin/masquerade/3/')
+        r = c.get('/admin/masquerade/end/')
+        self.assertRedirects(r, '/admin/', fetch_redirect_response=False)
+        # test that the staffuser is logged in again and the masquerade is over
+        self.assertEqual(c.session['_auth_user_id'], '2')
+        self.assertFalse('is_masquerading' in c.session)
+        self.assertFalse('masquerade_user_id' in c.session)
+
+    @django.test.utils.override_settings(ACCOUNTS_ENABLE_AUDIT_LOG=True)
+    def test_end_masquerade_sign_out(self):
+        u = UnitTestUser.objects.get(pk=2)
+        u.groups.add(self.group_masquerade)
+        c = django.test.client.Client()
+        self.assertTrue(c.login(email='staffuser@example.com', password='password'))
+        c.get('/admin/masquerade/3/')
+        c.get('/admin/masquerade/end/')
+        # the masqueraded user is signed out before the masquerade ends
+        sign_out, masquerade_end = UnitTestAuditLogEvent.objects.filter(
+            event_type__in=(events.SIGN_OUT, events.MASQUERADE_END)).order_by('id')
+        self.assertEqual(sign_out.event_type, events.SIGN_OUT)
+        self.assertEqual(sign_out.user_id, 3)
+        self.assertEqual(sign_out.masquerading_user_id, 2)
+        self.assertEqual(masquerade_end.event_type, events.MASQUERADE_END)
+        self.assertEqual(masquerade_end.user_id, 2)
+        self.assertIsNone(masquerade_end.masquerading_user_id)
+
+    @django.test.utils.override_settings(ACCOUNTS_MASQUERADE_TOKENS=True)
+    def test_masquerade_token(self):
+        u = UnitTestUser.objects.get(pk=2)
+        u.groups.add(self.group_masquerade)
+        c = django.test.client.Client()
+        self.assertTrue(c.login(email='staffuser@example.com', password='password'))
+        session_key = c.session.session_key
+        r = c.get('/admin/masquerade/3/')
+        self.assertEqual(r.status_code, 302)
+        # the session is left alone: the masquerade is carried by the token
+        self.assertEqual(c.session.session_key, session_key)
+        self.assertEqual(c.session['_auth_user_id'], '2')
+        self.assertFalse('is_masquerading' in c.session)
+        self.assertIn('masquerade', c.cookies)
+        r = c.get('/password_change/')
+        self.assertEqual(r.context['user'].pk, 3)
+        self.assertTrue(r.context['is_masquerading'])
+        self.assertEqual(r.wsgi_request.masquerade.user_id, 2)
+        self.assertEqual(r.wsgi_request.masquerade.user_email, 'staffuser@example.com')
+
+        # logging out ends the masquerade instead
+        r = c.get('/logout/')
+        self.assertRedirects(r, '/admin/masquerade/end/', fetch_redirect_response=False)
+        r = c.get('/admin/masquerade/end/')
+        self.assertRedirects(r, '/admin/', fetch_redirect_response=False)
+        self.assertEqual(c.cookies['masquerade'].value, '')
+        self.assertEqual(c.session.session_key, session_key)
+        r = c.get('/password_change/')
+        self.assertEqual(r.context['user'].pk, 2)
+        self.assertFalse(r.context['is_masquerading'])
+
+    @django.test.utils.override_settings(ACCOUNTS_MASQUERADE_TOKENS=True)
+    def test_masquerade_token_other_session(self):
+        u = UnitTestUser.objects.get(pk=2)
+        u.groups.add(self.group_masquerade)
+        c = django.test.client.Client()
+        self.assertTrue(c.login(email='staffuser@example.com', password='password'))
+        c.get('/admin/masquerade/3/')
+        token = c.cookies['masquerade'].value
+
+        # the token is only valid with the session it was made for
+        c = django.test.client.Client()
+        self.assertTrue(c.login(email='staffuser@example.com', password='password'))
+        c.cookies['masquerade'] = token
+        r = c.get('/password_change/')
+        self.assertEqual(r.context['user'].pk, 2)
+        self.assertFalse(r.context['is_masquerading'])
+
+        # and can't be tampered with
+        c.cookies['masquerade'] = token[:-1]
+        r = c.get('/password_change/')
+        self.assertEqual(r.context['user'].pk, 2)
+
+    def test_active_masquerades(self):
+        u = UnitTestUser.objects.get(pk=2)
+        u.groups.add(self.group_masquerade)
+        c = django.test.client.Client()
+        self.assertTrue(c.login(email='staffuser@example.com', password='password'))
+        c.get('/admin/masquerade/3/')
+        admin_client = django.test.client.Client()
+        admin_client.force_login(UnitTestUser.objects.get(pk=1))
+        r = admin_client.get('/admin/accountsplus/unittestuser/masquerades/')
+        self.assertContains(r, 'regularuser@example.com (3)')
+        r = admin_client.get('/admin/accountsplus/unittestuser/masquerades/?format=json')
+        masquerades = r.json()['masquerades']
+        self.assertEqual(len(masquerades), 1)
+        self.assertEqual(masquerades[0]['user_email'], 'staffuser@example.com')
+        self.assertEqual(masquerades[0]['masquerade_as_id'], 3)
+        self.assertEqual(masquerades[0]['id'], c.session['masquerade_id'])
+
+        # ending a masquerade removes it from the registry
+        c.get('/admin/masquerade/end/')
+        self.assertListEqual(masquerading.active_masquerades(), [])
+        # and only users that can change users can list masquerades
+        r = c.get('/admin/accountsplus/unittestuser/masquerades/')
+        self.assertEqual(r.status_code, 403)
+
+    @django.test.utils.override_settings(ACCOUNTS_ENABLE_AUDIT_LOG=True)
+    def test_end_masquerades(self):
+        u = UnitTestUser.objects.get(pk=2)
+        u.groups.add(self.group_masquerade)
+        c = django.test.client.Client()
+        self.assertTrue(c.login(email='staffuser@example.com', password='password'))
+        c.get('/admin/masquerade/3/')
+        admin_client = django.test.client.Client()
+        admin_client.force_login(UnitTestUser.objects.get(pk=1))
+        r = admin_client.post('/admin/accountsplus/unittestuser/masquerades/?format=json',
+                              data={'masquerade_id': [c.session['masquerade_id'], 'unknown']})
+        self.assertEqual(r.json(), {'ended': 1})
+        self.assertListEqual(masquerading.active_masquerades(), [])
+        # the masqueraded user is signed out on their next request
+        c.get('/password_change/')
+        self.assertFalse('_auth_user_id' in c.session)
+        # and the end of the masquerade is recorded for the user masquerading
+        sign_out, masquerade_end = UnitTestAuditLogEvent.objects.filter(
+            event_type__in=(events.SIGN_OUT, events.MASQUERADE_END)).order_by('id')
+        self.assertEqual(sign_out.user_id, 3)
+        self.assertEqual(sign_out.masquerading_user_id, 2)
+        self.assertEqual(masquerade_end.event_type, events.MASQUERADE_END)
+        self.assertEqual(masquerade_end.user_id, 2)
+        self.assertIsNone(masquerade_end.masquerading_user_id)
+        self.assertEqual(events.loads_event_data(masquerade_end.event_data)['masquerade_as_id'], 3)
+
+    def test_register_concurrently(self):
+        # masquerades started and ended at the same time by several processes are all kept track of
+        user = UnitTestUser.objects.get(pk=3)
+        started = [masquerading.Masquerade(2, 'staffuser@example.com', masquerade_id='started-{}'.format(i))
+                   for i in range(20)]
+        ended = [masquerading.Masquerade(2, 'staffuser@example.com', masquerade_id='ended-{}'.format(i))
+                 for i in range(20)]
+        for masquerade in ended:
+            masquerading.register(masquerade, user)
+
+        def start(masquerade):
+            masquerading.register(masquerade, user)
+
+        def end(masquerade):
+            self.assertEqual(masquerading.end_masquerades([masquerade.masquerade_id]), 1)
+        threads = [threading.Thread(target=start, args=(m, )) for m in started]
+        threads += [threading.Thread(target=end, args=(m, )) for m in ended]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertSetEqual(set(m['id'] for m in masquerading.active_masquerades()),
+                            set(m.masquerade_id for m in started))
+        # an ended masquerade can only be ended once
+        self.assertEqual(masquerading.end_masquerades(['ended-0', 'started-0', 'started-0']), 1)
+
+    def test_masquerade_registry_locked(self):
+        # a request doesn't wait for the lock of the registry's index: the masquerade is added to it later
+        u = UnitTestUser.objects.get(pk=2)
+        u.groups.add(self.group_masquerade)
+        django.core.cache.cache.add(masquerading.INDEX_LOCK_CACHE_KEY, 'other', masquerading.INDEX_LOCK_TIMEOUT)
+        c = django.test.client.Client()
+        self.assertTrue(c.login(email='staffuser@example.com', password='password'))
+        r = c.get('/admin/masquerade/3/')
+        self.assertEqual(r.status_code, 302)
+        self.assertEqual(c.session['_auth_user_id'], '3')
+        masquerade_id = c.session['masquerade_id']
+        self.assertListEqual([m['id'] for m in masquerading.active_masquerades()], [masquerade_id])
+
+        # the next update of the index merges it in
+        django.core.cache.cache.delete(masquerading.INDEX_LOCK_CACHE_KEY)
+        other = masquerading.Masquerade(1, 'superuser@example.com', masquerade_id='other')
+        masquerading.register(other, UnitTestUser.objects.get(pk=3))
+        self.assertIsNone(django.core.cache.cache.get(masquerading.PENDING_CACHE_KEY.format(1)))
+        self.assertSetEqual(django.core.cache.cache.get(masquerading.INDEX_CACHE_KEY)['ids'],
+                            set([masquerade_id, 'other']))
+        self.assertEqual(masquerading.end_masquerades([masquerade_id]), 1)
+        self.assertListEqual([m['id'] for m in masquerading.active_masquerades()], ['other'])
+
+    @django.test.utils.override_settings(ACCOUNTS_MASQUERADE_TOKENS=True, ACCOUNTS_ENABLE_AUDIT_LOG=True)
+    def test_end_masquerades_token(self):
+        u = UnitTestUser.objects.get(pk=2)
+        u.groups.add(self.group_masquerade)
+        c = django.test.client.Client()
+        self.assertTrue(c.login(email='staffuser@example.com', password='password'))
+        c.get('/admin/masquerade/3/')
+        masquerade, = masquerading.active_masquerades()
+        self.assertEqual(masquerading.end_masquerades([masquerade['id']]), 1)
+        # the token is ignored from then on
+        r = c.get('/password_change/')
+        self.assertEqual(r.context['user'].pk, 2)
+        self.assertFalse(r.context['is_masquerading'])
+        # the token is dropped and the end of the masquerade recorded once
+        self.assertEqual(c.cookies['masquerade'].value, '')
+        c.get('/password_change/')
+        masquerade_end, = UnitTestAuditLogEvent.objects.filter(event_type=events.MASQUERADE_END)
+        self.assertEqual(masquerade_end.user_id, 2)
+        self.assertIsNone(masquerade_end.masquerading_user_id)
+        self.assertEqual(events.loads_event_data(masquerade_end.event_data)['masquerade_as_id'], 3)
+
     def test_super_masquerade_regular_user(self):
         # give the user masquerade privileges
         u = UnitTestUser.objects.get(pk=3)
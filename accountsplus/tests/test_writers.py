@@ -0,0 +1,237 @@
+from __future__ import unicode_literals
+
+import datetime
+
+import django.test
+import django.test.utils
+import django.utils.timezone
+
+import logging
+import mock
+
+from .. import events, signals, writers
+from test_models import (UnitTestAuditLogEvent, )
+from test_signals import SignalTestCase
+
+
+logging.disable(logging.CRITICAL)
+
+
+def make_event(message='Test'):
+    return UnitTestAuditLogEvent(user_id=1, user_email='superuser@example.com', message=message)
+
+
+class WriteAuditEventsTestCase(django.test.TestCase):
+    def test_write_audit_events(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(writers.write_audit_events([make_event('1'), make_event('2'), make_event('3')]), 3)
+        self.assertListEqual(
+            list(UnitTestAuditLogEvent.objects.order_by('id').values_list('message', flat=True)), ['1', '2', '3'])
+
+    def test_write_audit_events_empty(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(writers.write_audit_events([]), 0)
+
+
+class BufferedAuditLogWriterTestCase(django.test.TestCase):
+    def test_flush_when_batch_full(self):
+        writer = writers.BufferedAuditLogWriter(batch_size=3, flush_interval=0)
+        writer.write(make_event())
+        writer.write(make_event())
+        self.assertEqual(len(writer), 2)
+        self.assertEqual(UnitTestAuditLogEvent.objects.count(), 0)
+        with self.assertNumQueries(1):
+            writer.write(make_event())
+        self.assertEqual(len(writer), 0)
+        self.assertEqual(UnitTestAuditLogEvent.objects.count(), 3)
+
+    def test_flush(self):
+        writer = writers.BufferedAuditLogWriter(batch_size=10, flush_interval=0)
+        writer.write(make_event())
+        self.assertEqual(writer.flush(), 1)
+        self.assertEqual(writer.flush(), 0)
+        self.assertEqual(UnitTestAuditLogEvent.objects.count(), 1)
+
+    def test_flush_interval_schedules_timer(self):
+        writer = writers.BufferedAuditLogWriter(batch_size=10, flush_interval=60)
+        writer.write(make_event())
+        self.assertIsNotNone(writer.timer)
+        writer.flush()
+        self.assertIsNone(writer.timer)
+
+    def test_failed_flush_keeps_events(self):
+        writer = writers.BufferedAuditLogWriter(batch_size=10, flush_interval=0, max_queue_size=10)
+        writer.write(make_event())
+        with mock.patch.object(writers, 'write_audit_events', side_effect=Exception):
+            self.assertEqual(writer.flush(), 0)
+        self.assertEqual(len(writer), 1)
+        self.assertEqual(writer.flush(), 1)
+        self.assertEqual(UnitTestAuditLogEvent.objects.count(), 1)
+
+    def test_queue_is_bounded(self):
+        writer = writers.BufferedAuditLogWriter(batch_size=2, flush_interval=0, max_queue_size=2)
+        with mock.patch.object(writers, 'write_audit_events', side_effect=Exception):
+            for i in range(5):
+                writer.write(make_event(str(i)))
+        self.assertEqual(len(writer), 2)
+        self.assertEqual(writer.dropped, 3)
+        self.assertListEqual([e.message for e in writer.queue], ['3', '4'])
+
+
+class AuditLogCoalescerTestCase(django.test.TestCase):
+    def setUp(self):
+        self.now = django.utils.timezone.now()
+        self.coalescers = []
+
+    def tearDown(self):
+        # stop the timers that would close the windows left open
+        for coalescer in self.coalescers:
+            coalescer._cancel_close()
+
+    def sign_in(self, coalescer, seconds, user_id=1):
+        e = UnitTestAuditLogEvent(
+            user_id=user_id, user_email='user{}@example.com'.format(user_id), event_type=events.SIGN_IN,
+            recorded_on=self.now + datetime.timedelta(seconds=seconds))
+        self.coalescers.append(coalescer)
+        if not coalescer.coalesce(e):
+            e.save()
+        return e
+
+    def test_coalesce_window(self):
+        coalescer = writers.AuditLogCoalescer(window=60)
+        first = self.sign_in(coalescer, 0)
+        # events absorbed into an open window aren't written
+        with self.assertNumQueries(0):
+            for seconds in range(1, 10):
+                self.sign_in(coalescer, seconds)
+        self.sign_in(coalescer, 5, user_id=2)
+        self.assertEqual(UnitTestAuditLogEvent.objects.count(), 2)
+
+        # the first event after the window closes writes the count of the closed window and opens a new one
+        with self.assertNumQueries(2):
+            self.sign_in(coalescer, 61)
+        e = UnitTestAuditLogEvent.objects.get(pk=first.pk)
+        self.assertEqual(e.occurrences, 10)
+        self.assertEqual(e.recorded_on, first.recorded_on)
+        self.assertEqual(e.last_recorded_on, self.now + datetime.timedelta(seconds=9))
+        self.assertEqual(UnitTestAuditLogEvent.objects.filter(user_id=1).count(), 2)
+
+    def test_different_events_are_not_coalesced(self):
+        coalescer = writers.AuditLogCoalescer(window=60)
+        self.sign_in(coalescer, 0)
+        e = UnitTestAuditLogEvent(user_id=1, user_email='user1@example.com', event_type=events.SIGN_OUT)
+        self.assertFalse(coalescer.coalesce(e))
+        e = UnitTestAuditLogEvent(user_id=1, user_email='user1@example.com', event_type=events.SIGN_IN,
+                                  masquerading_user_id=2)
+        self.assertFalse(coalescer.coalesce(e))
+        self.assertEqual(len(coalescer), 3)
+
+    def test_max_keys(self):
+        coalescer = writers.AuditLogCoalescer(window=60, max_keys=2)
+        first = self.sign_in(coalescer, 0, user_id=1)
+        self.sign_in(coalescer, 1, user_id=1)
+        self.sign_in(coalescer, 2, user_id=2)
+        # opening a third window closes the oldest one
+        self.sign_in(coalescer, 3, user_id=3)
+        self.assertEqual(len(coalescer), 2)
+        self.assertEqual(UnitTestAuditLogEvent.objects.get(pk=first.pk).occurrences, 2)
+        self.assertFalse(coalescer.coalesce(UnitTestAuditLogEvent(
+            user_id=1, user_email='user1@example.com', event_type=events.SIGN_IN,
+            recorded_on=self.now + datetime.timedelta(seconds=4))))
+
+    def test_close_expired_windows(self):
+        # a window that absorbed events is closed once it expires, without waiting for another event
+        coalescer = writers.AuditLogCoalescer(window=60)
+        with mock.patch.object(writers.threading, 'Timer') as timer:
+            first = self.sign_in(coalescer, -120)
+            self.assertFalse(timer.called)
+            self.sign_in(coalescer, -119)
+            self.sign_in(coalescer, -100, user_id=2)
+            self.sign_in(coalescer, -99, user_id=2)
+            self.assertEqual(timer.call_count, 1)
+            self.assertEqual(timer.call_args[0][0], 0)
+            # what the timer runs
+            self.assertEqual(coalescer.close_expired(), 2)
+            self.assertEqual(UnitTestAuditLogEvent.objects.get(pk=first.pk).occurrences, 2)
+            self.assertEqual(len(coalescer), 0)
+            self.assertIsNone(coalescer.timer)
+            # a window that opens later is closed when it expires
+            self.sign_in(coalescer, -10, user_id=3)
+            self.sign_in(coalescer, -9, user_id=3)
+            self.assertEqual(timer.call_count, 2)
+            self.assertAlmostEqual(timer.call_args[0][0], 50, delta=5)
+            coalescer.flush()
+        self.assertIsNone(coalescer.timer)
+
+    def test_flush_unsaved_event(self):
+        coalescer = writers.AuditLogCoalescer(window=60)
+        events_written = []
+        for seconds in range(3):
+            e = UnitTestAuditLogEvent(user_id=1, user_email='user1@example.com', event_type=events.SIGN_IN,
+                                      recorded_on=self.now + datetime.timedelta(seconds=seconds))
+            if not coalescer.coalesce(e):
+                events_written.append(e)
+        # bulk_create doesn't set the primary key, so the row is found by its values
+        writers.write_audit_events(events_written)
+        self.assertEqual(coalescer.flush(), 1)
+        self.assertEqual(len(coalescer), 0)
+        self.assertEqual(UnitTestAuditLogEvent.objects.get().occurrences, 3)
+
+
+@django.test.utils.override_settings(
+    AUTH_USER_MODEL='accountsplus.UnitTestUser',
+    ACCOUNTS_AUDIT_LOG_EVENT_MODEL='accountsplus.UnitTestAuditLogEvent',
+    ACCOUNTS_ENABLE_AUDIT_LOG=True,
+)
+class CoalescedLogAuditEventTestCase(SignalTestCase):
+    @django.test.utils.override_settings(ACCOUNTS_AUDIT_LOG_COALESCE_WINDOW=60)
+    def test_login_storm(self):
+        for i in range(20):
+            signals.login_callback(sender=self, request=self.request, user=self.user_1)
+            signals.login_callback(sender=self, request=self.request_masquerade, user=self.user_1)
+        self.assertEqual(UnitTestAuditLogEvent.objects.count(), 2)
+        signals.flush_audit_log_coalescer()
+        self.assertListEqual(
+            list(UnitTestAuditLogEvent.objects.order_by('id').values_list('occurrences', flat=True)), [20, 20])
+
+    def test_no_coalescing_by_default(self):
+        for i in range(3):
+            signals.login_callback(sender=self, request=self.request, user=self.user_1)
+        self.assertEqual(UnitTestAuditLogEvent.objects.count(), 3)
+
+
+@django.test.utils.override_settings(
+    AUTH_USER_MODEL='accountsplus.UnitTestUser',
+    ACCOUNTS_AUDIT_LOG_EVENT_MODEL='accountsplus.UnitTestAuditLogEvent',
+    ACCOUNTS_ENABLE_AUDIT_LOG=True,
+)
+class BufferedLogAuditEventTestCase(SignalTestCase):
+    @django.test.utils.override_settings(ACCOUNTS_AUDIT_LOG_BUFFERED=True)
+    def test_log_audit_event_buffered(self):
+        writer = writers.BufferedAuditLogWriter(batch_size=2, flush_interval=0)
+        with mock.patch.object(writers, 'get_buffered_writer', return_value=writer):
+            e = signals.log_audit_event(message='Test', request=self.request, user=self.user_1)
+            self.assertIsNone(e.pk)
+            self.assertEqual(UnitTestAuditLogEvent.objects.count(), 0)
+            signals.log_audit_event(message='Test', request=self.request, user=self.user_1)
+        self.assertEqual(UnitTestAuditLogEvent.objects.count(), 2)
+        # the event time is kept from when the event was raised
+        self.assertEqual(UnitTestAuditLogEvent.objects.order_by('id')[0].recorded_on, e.recorded_on)
+
+    @django.test.utils.override_settings(ACCOUNTS_AUDIT_LOG_BUFFERED=True, ACCOUNTS_AUDIT_LOG_COALESCE_WINDOW=60)
+    def test_log_audit_event_buffered_coalesced(self):
+        writer = writers.BufferedAuditLogWriter(batch_size=10, flush_interval=0, coalesce=True)
+        with mock.patch.object(writers, 'get_buffered_writer', return_value=writer):
+            for i in range(3):
+                signals.login_callback(sender=self, request=self.request, user=self.user_1)
+        # a failed write keeps the event that opened the window, and only it, for the next flush
+        with mock.patch.object(writer, 'write_batch', side_effect=ValueError):
+            writer.flush()
+        self.assertEqual(len(writer), 1)
+        writer.flush()
+        signals.flush_audit_log_coalescer()
+        self.assertListEqual(list(UnitTestAuditLogEvent.objects.values_list('occurrences', flat=True)), [3])
+
+    def test_log_audit_event_unbuffered(self):
+        e = signals.log_audit_event(message='Test', request=self.request, user=self.user_1)
+        self.assertIsNotNone(e.pk)
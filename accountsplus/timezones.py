@@ -0,0 +1,160 @@
+from __future__ import unicode_literals
+
+import datetime
+
+import django.contrib.auth
+import django.contrib.auth.signals
+import django.core.cache
+import django.core.exceptions
+import django.core.signals
+import django.db.models.signals
+import django.utils.timezone
+from django.conf import settings as app_settings
+from django.dispatch import receiver
+
+import pytz
+
+import settings
+
+
+SESSION_KEY = 'user_timezone'
+TIMEZONE_SETTINGS = ('ACCOUNTS_SESSION_TIMEZONE', 'AUTH_USER_MODEL', )
+
+# the user model whose saves are tracked, set by configure() with ACCOUNTS_SESSION_TIMEZONE
+_user_model = None
+# tzinfo objects by timezone name, shared by every request of the process
+_timezones = {}
+
+
+def configure():
+    """
+    Connects the receivers that keep the user's timezone name in the session if ACCOUNTS_SESSION_TIMEZONE is set.
+    """
+    global _user_model
+    if _user_model is not None:
+        django.db.models.signals.post_save.disconnect(user_saved_callback, sender=_user_model)
+    django.contrib.auth.signals.user_logged_in.disconnect(user_logged_in_callback)
+    _user_model = None
+    if not settings.get_session_timezone():
+        return
+    try:
+        _user_model = django.contrib.auth.get_user_model()
+    except django.core.exceptions.ImproperlyConfigured:
+        return
+    django.db.models.signals.post_save.connect(user_saved_callback, sender=_user_model)
+    django.contrib.auth.signals.user_logged_in.connect(user_logged_in_callback)
+
+
+def get_timezone(name):
+    """
+    Returns the tzinfo of a timezone name, memoized for the process.
+    """
+    try:
+        return _timezones[name]
+    except KeyError:
+        timezone = _timezones[name] = pytz.timezone(name)
+        return timezone
+
+
+def get_timezone_name(user):
+    """
+    Returns the name of a user's timezone, or '' if the user has none.
+    """
+    return getattr(user.timezone, 'zone', None) or ''
+
+
+def get_cache_key(user_id):
+    return 'accountsplus:user_timezone:{}'.format(user_id)
+
+
+def get_session_timezone_name(request):
+    """
+    Returns the name of the signed in user's timezone as kept in the session, '' if the user has none, or None if no
+    user is signed in. A timezone changed since the session was started is picked up from the cache, so the user is
+    only loaded for sessions that started before their timezone was kept in them.
+    """
+    session = request.session
+    user_id = session.get(django.contrib.auth.SESSION_KEY)
+    if user_id is None:
+        return None
+    name = session.get(SESSION_KEY)
+    changed_name = django.core.cache.cache.get(get_cache_key(user_id))
+    if changed_name is not None and changed_name != name:
+        name = session[SESSION_KEY] = changed_name
+    if name is None:
+        if not request.user.is_authenticated():
+            return None
+        name = session[SESSION_KEY] = get_timezone_name(request.user)
+    return name
+
+
+def user_logged_in_callback(sender, request, user, **kwargs):
+    request.session[SESSION_KEY] = get_timezone_name(user)
+
+
+def user_saved_callback(sender, instance, created=False, update_fields=None, **kwargs):
+    # the sessions of the user pick the timezone up from the cache, for as long as a session can live
+    if created or (update_fields is not None and 'timezone' not in update_fields):
+        return
+    django.core.cache.cache.set(
+        get_cache_key(instance.pk), get_timezone_name(instance), app_settings.SESSION_COOKIE_AGE)
+
+
+@receiver(django.core.signals.setting_changed)
+def timezone_setting_changed_callback(sender, setting, **kwargs):
+    if setting in TIMEZONE_SETTINGS:
+        configure()
+
+
+def get_user_timezone(user):
+    """
+    Returns the timezone of a signed in user, or the default timezone.
+    """
+    if user.is_authenticated() and user.timezone:
+        return user.timezone
+    return django.utils.timezone.get_default_timezone()
+
+
+class LazyTimezone(datetime.tzinfo):
+    """
+    A tzinfo that stands in for the timezone returned by get_timezone, which is only called the first time the
+    timezone is used. Activating it costs nothing for requests that never convert a datetime.
+    """
+    def __init__(self, get_timezone):
+        self._get_timezone = get_timezone
+        self._timezone = None
+
+    def resolve(self):
+        if self._timezone is None:
+            self._timezone = self._get_timezone()
+        return self._timezone
+
+    def utcoffset(self, dt):
+        return self.resolve().utcoffset(self._naive(dt))
+
+    def dst(self, dt):
+        return self.resolve().dst(self._naive(dt))
+
+    def tzname(self, dt):
+        return self.resolve().tzname(self._naive(dt))
+
+    def fromutc(self, dt):
+        # pytz timezones only convert datetimes that are attached to them
+        return self.resolve().fromutc(dt.replace(tzinfo=self.resolve()))
+
+    def _naive(self, dt):
+        # pytz timezones look up the offset of naive datetimes rather than use the one they are attached to
+        if dt is not None and dt.tzinfo is self:
+            return dt.replace(tzinfo=None)
+        return dt
+
+    def __getattr__(self, name):
+        # pytz's zone, localize() and normalize()
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.resolve(), name)
+
+    def __repr__(self):
+        if self._timezone is None:
+            return '<LazyTimezone (unresolved)>'
+        return '<LazyTimezone {!r}>'.format(self._timezone)
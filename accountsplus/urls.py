@@ -27,4 +27,7 @@ urlpatterns = [
     # masquerade views
     url(r'^admin/masquerade/end/$', views.end_masquerade, name='end_masquerade'),
     url(r'^admin/masquerade/(?P<user_id>\d+)/$', views.masquerade, name='masquerade'),
+
+    # bulk audit log ingestion for other services
+    url(r'^audit-log/ingest/$', views.ingest_audit_events, name='ingest_audit_events'),
 ]
@@ -5,20 +5,28 @@ from django.utils.translation import ugettext as _
 import django.views.decorators.cache
 import django.views.decorators.csrf
 import django.views.decorators.debug
+import django.views.decorators.http
 import django.contrib.auth.decorators
 import django.contrib.auth.views
 import django.contrib.auth.forms
 import django.contrib.auth
+import django.contrib.auth.models
+import django.contrib.auth.signals
 import django.contrib.messages
 import django.shortcuts
 import django.http
 import django.template.response
 import django.utils.module_loading
 import django.core.urlresolvers
+import django.core.exceptions
+import django.db.models
+import django.utils.crypto
 from django.conf import settings as app_settings
 
 from axes import utils
 
+import ingest
+import masquerading
 import signals
 import forms
 import settings
@@ -26,13 +34,50 @@ import settings
 
 logger = logging.getLogger(__name__)
 
+MODEL_BACKEND = 'django.contrib.auth.backends.ModelBackend'
+# the only user columns that the masquerade checks, the audit log and login() need, including the timezone that
+# login() keeps in the session with ACCOUNTS_SESSION_TIMEZONE
+MASQUERADE_USER_FIELDS = ('email', 'password', 'is_superuser', 'last_login', 'company', 'timezone', )
+
+
+def has_masquerade_permission(user):
+    """
+    Returns whether the user has the masquerade permission. With only the model backend, this is one EXISTS query
+    instead of loading every user and group permission of the user.
+    """
+    if not user.is_active:
+        return False
+    if user.is_superuser:
+        return True
+    if list(app_settings.AUTHENTICATION_BACKENDS) != [MODEL_BACKEND] or hasattr(user, '_perm_cache'):
+        return user.has_perm(user.PERMISSION_MASQUERADE)
+    app_label, codename = user.PERMISSION_MASQUERADE.split('.', 1)
+    return django.contrib.auth.models.Permission.objects.filter(
+        django.db.models.Q(user=user) | django.db.models.Q(group__user=user),
+        content_type__app_label=app_label, codename=codename).exists()
+
+
+def get_masquerade_user(user_id):
+    """
+    Loads a user to switch to, with only the columns in MASQUERADE_USER_FIELDS that the user model has.
+    """
+    User = django.contrib.auth.get_user_model()
+    fields = []
+    for name in MASQUERADE_USER_FIELDS:
+        try:
+            User._meta.get_field(name)
+        except django.core.exceptions.FieldDoesNotExist:
+            continue
+        fields.append(name)
+    return User.objects.only(*fields).get(pk=user_id)
+
 
 def logout_then_login(request, login_url=None,  extra_context=None):
     """
     Logs out the user if they are logged in. Then redirects to the log-in page.
     """
     # if a user is masquerading, don't log them out, just kill the masquerade
-    if request.session.get('is_masquerading'):
+    if masquerading.get_masquerade(request) is not None:
         return django.shortcuts.redirect('end_masquerade')
     else:
         return django.contrib.auth.views.logout_then_login(request, login_url, extra_context)
@@ -47,7 +92,7 @@ def masquerade(request, user_id=None):
     if not user_id:
         django.contrib.messages.error(request, 'Masquerade failed: no user specified')
         return django.shortcuts.redirect(return_page)
-    if not request.user.has_perm(User.PERMISSION_MASQUERADE):
+    if not has_masquerade_permission(request.user):
         django.contrib.messages.error(request, 'Masquerade failed: insufficient privileges')
         return django.shortcuts.redirect(return_page)
     if not (request.user.is_superuser or request.user.is_staff):
@@ -55,7 +100,7 @@ def masquerade(request, user_id=None):
         return django.shortcuts.redirect(return_page)
 
     try:
-        user = User.objects.get(pk=user_id)
+        user = get_masquerade_user(user_id)
     except User.DoesNotExist:
         logger.error('User {} ({}) masquerading failed for user {}'.format(request.user.email, request.user.id, user_id))
         django.contrib.messages.error(request, 'Masquerade failed: unknown user {}'.format(user_id))
@@ -68,46 +113,73 @@ def masquerade(request, user_id=None):
         return django.shortcuts.redirect(return_page)
 
     admin_user = request.user
-    user.backend = request.session[django.contrib.auth.BACKEND_SESSION_KEY]
-    # log the new user in
+    masquerade_info = masquerading.Masquerade(
+        admin_user.id, admin_user.email, admin_user.is_superuser, return_page, user.id,
+        masquerading.new_masquerade_id())
     signals.masquerade_start.send(sender=masquerade, request=request, user=admin_user, masquerade_as=user)
-    # this is needed to track whether this login is for a masquerade
-    setattr(user, 'is_masquerading', True)
-    setattr(user, 'masquerading_user', admin_user)
-    django.contrib.auth.login(request, user)
-
-    request.session['is_masquerading'] = True
-    request.session['masquerade_user_id'] = admin_user.id
-    request.session['return_page'] = return_page
-    request.session['masquerade_is_superuser'] = admin_user.is_superuser
+    # the masquerade is registered before the session switches to the user, so a failure leaves the admin signed in
+    masquerading.register(masquerade_info, user)
+    response = django.http.HttpResponseRedirect(app_settings.LOGIN_REDIRECT_URL)
+    if settings.get_masquerade_tokens():
+        # the session stays the admin user's: MasqueradeMiddleware switches to the user for every request that
+        # carries the token
+        masquerading.set_token_cookie(request, response, masquerade_info)
+        request.masquerade = masquerade_info
+        request.user = user
+    else:
+        user.backend = request.session[django.contrib.auth.BACKEND_SESSION_KEY]
+        # this is needed to track whether this login is for a masquerade
+        setattr(user, 'is_masquerading', True)
+        setattr(user, 'masquerading_user', admin_user)
+        # log the new user in
+        django.contrib.auth.login(request, user)
+        masquerading.start_session_masquerade(request, masquerade_info)
 
     logger.info(
-        'User {} ({}) masquerading as {} ({})'.format(admin_user.email, admin_user.id, request.user.email, request.user.id))
+        'User {} ({}) masquerading as {} ({})'.format(admin_user.email, admin_user.id, user.email, user.id))
     django.contrib.messages.success(request, 'Masquerading as user {0}'.format(user.email))
 
-    return django.http.HttpResponseRedirect(app_settings.LOGIN_REDIRECT_URL)
+    return response
 
 
 @django.views.decorators.cache.never_cache
 @django.contrib.auth.decorators.login_required
 def end_masquerade(request):
     User = django.contrib.auth.get_user_model()
-    if 'is_masquerading' not in request.session:
+    masquerade_info = masquerading.get_masquerade(request)
+    if masquerade_info is None:
         return django.shortcuts.redirect('admin:index')
 
-    if 'masquerade_user_id' in request.session:
+    response = django.shortcuts.redirect('admin:index')
+    use_tokens = settings.get_masquerade_tokens()
+    if use_tokens:
+        masquerading.delete_token_cookie(response)
+    if masquerade_info.masquerade_id is not None:
+        masquerading.unregister(masquerade_info.masquerade_id)
+
+    if masquerade_info.user_id is not None:
         try:
             masqueraded_user = request.user
-            user = User.objects.get(
-                pk=request.session['masquerade_user_id'])
-            user.backend = request.session[
-                django.contrib.auth.BACKEND_SESSION_KEY]
-            # this is needed to track whether this login is for a masquerade
-            django.contrib.auth.logout(request)
+            user = get_masquerade_user(masquerade_info.user_id)
+            # the masquerade is dropped first so that its end is recorded for the admin user alone
+            if use_tokens:
+                # the session is still the admin user's own, so there is nothing to sign back in
+                request.masquerade = None
+            else:
+                # login() flushes the masqueraded user's session, so logout() isn't called; the masqueraded user is
+                # still signed out for the audit log and any other user_logged_out receivers
+                django.contrib.auth.signals.user_logged_out.send(
+                    sender=masqueraded_user.__class__, request=request, user=masqueraded_user)
+                user.backend = request.session[
+                    django.contrib.auth.BACKEND_SESSION_KEY]
+                masquerading.end_session_masquerade(request)
             signals.masquerade_end.send(
                 sender=end_masquerade, request=request, user=user,
                 masquerade_as=masqueraded_user)
-            django.contrib.auth.login(request, user)
+            if use_tokens:
+                request.user = user
+            else:
+                django.contrib.auth.login(request, user)
             logging.info('End masquerade user: {} ({}) by: {} ({})'.format(
                 masqueraded_user.email, masqueraded_user.id,
                 user.email, user.id))
@@ -115,9 +187,9 @@ def end_masquerade(request):
         except User.DoesNotExist as e:
             logging.critical(
                 'Masquerading user {} does not exist'.format(
-                    request.session['masquerade_user_id']))
+                    masquerade_info.user_id))
 
-    return django.shortcuts.redirect('admin:index')
+    return response
 
 
 @django.views.decorators.debug.sensitive_post_parameters()
@@ -208,3 +280,33 @@ class UserLockedOutView(GenericLockedView):
 
 class AdminLockedOutView(GenericLockedView):
     urlPattern = 'admin:index'
+
+
+def is_ingest_authorized(request):
+    """
+    Checks the request's bearer token against ACCOUNTS_AUDIT_LOG_INGEST_TOKENS.
+    """
+    scheme, _sep, token = request.META.get('HTTP_AUTHORIZATION', '').partition(' ')
+    if scheme.lower() != 'bearer' or not token:
+        return False
+    return any(django.utils.crypto.constant_time_compare(token.strip(), t)
+               for t in settings.get_audit_log_ingest_tokens())
+
+
+@django.views.decorators.csrf.csrf_exempt
+@django.views.decorators.http.require_POST
+def ingest_audit_events(request):
+    """
+    Records a batch of audit log events sent by another service as newline-delimited JSON, one event per line. The
+    body is validated and inserted as it is read, and the response reports how many events were accepted along with
+    the errors of the rejected lines.
+    """
+    if not is_ingest_authorized(request):
+        response = django.http.HttpResponse('Invalid or missing token', status=401, content_type='text/plain')
+        response['WWW-Authenticate'] = 'Bearer'
+        return response
+    model = signals.get_audit_log_model()
+    if model is None:
+        raise django.http.Http404('The audit log is not enabled')
+    result = ingest.ingest_events(request, model, chunk_size=settings.get_audit_log_batch_size())
+    return django.http.JsonResponse(result.as_dict())
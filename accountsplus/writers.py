@@ -0,0 +1,342 @@
+from __future__ import unicode_literals
+
+import atexit
+import collections
+import datetime
+import logging
+import threading
+
+import django.contrib.auth
+import django.db
+import django.db.models
+import django.db.transaction
+import django.utils.timezone
+
+import rollups
+import settings
+
+
+logger = logging.getLogger(__name__)
+
+_coalescer = None
+
+
+def get_coalescer():
+    return _coalescer
+
+
+def set_coalescer(coalescer):
+    global _coalescer
+    _coalescer = coalescer
+
+
+def coalesce_audit_events(events):
+    """
+    Returns the events that must be written, leaving out the ones merged into an open window of the coalescer. Events
+    are only coalesced as they are about to be written, so a window is never opened by an event that is rolled back or
+    still queued.
+    """
+    if _coalescer is None:
+        return events
+    return [e for e in events if not _coalescer.coalesce(e)]
+
+
+def write_audit_events(events):
+    """
+    Writes unsaved audit log events using one bulk_create per audit log model.
+    """
+    events_by_model = collections.OrderedDict()
+    for e in events:
+        events_by_model.setdefault(e.__class__, []).append(e)
+    for model, model_events in events_by_model.items():
+        model.objects.bulk_create(model_events)
+    rollups.record_events(events)
+    return len(events)
+
+
+class AuditLogCollector(object):
+    """
+    Gathers the audit log events raised while handling a request so that they can be written in one bulk insert.
+    An event only becomes pending once the transaction it was raised in commits, so events raised inside a rolled
+    back transaction are never written. That is the transaction on the user model's database, which is not the
+    audit log's own database when AuditLogRouter sends events elsewhere.
+    """
+    def __init__(self):
+        self.events = []
+
+    def __len__(self):
+        return len(self.events)
+
+    def add(self, event):
+        using = django.db.router.db_for_write(django.contrib.auth.get_user_model())
+        django.db.transaction.on_commit(lambda: self.events.append(event), using=using)
+
+    def flush(self):
+        """
+        Writes the pending events. If the write fails the events that weren't written stay pending and the error is
+        raised.
+        """
+        events, self.events = self.events, []
+        events = coalesce_audit_events(events)
+        try:
+            return write_audit_events(events)
+        except Exception:
+            self.events = events + self.events
+            raise
+
+
+class BufferedAuditLogWriter(object):
+    """
+    Holds audit log events in a bounded in-process queue and writes them with bulk_create once batch_size events
+    are queued or flush_interval seconds have passed since the first queued event. If the queue reaches
+    max_queue_size (because writes are failing), the oldest events are dropped. With coalesce, the events are run
+    through the coalescer as they are flushed.
+    """
+    def __init__(self, batch_size=100, flush_interval=5, max_queue_size=10000, coalesce=False):
+        self.batch_size = batch_size
+        self.coalesce = coalesce
+        self.flush_interval = flush_interval
+        self.max_queue_size = max(max_queue_size, batch_size)
+        self.queue = collections.deque()
+        self.lock = threading.RLock()
+        self.timer = None
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.queue)
+
+    def write(self, event):
+        with self.lock:
+            if len(self.queue) >= self.max_queue_size:
+                self.handle_full_queue()
+            self.queue.append(event)
+            is_full = len(self.queue) >= self.batch_size
+            if not is_full:
+                self._schedule_flush()
+        if is_full:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            self._cancel_flush()
+            events = list(self.queue)
+            self.queue.clear()
+        if self.coalesce:
+            # a failed batch is queued again without the events already counted in a window
+            events = coalesce_audit_events(events)
+        if not events:
+            return 0
+        try:
+            return self.write_batch(events)
+        except Exception:
+            logger.exception('Failed to write {} audit log events'.format(len(events)))
+            self.handle_failed_batch(events)
+            return 0
+
+    def write_batch(self, events):
+        return write_audit_events(events)
+
+    def handle_full_queue(self):
+        """
+        Called with the lock held when an event is written to a full queue. Drops the oldest queued event.
+        """
+        self.queue.popleft()
+        self.dropped += 1
+        logger.error('Audit log queue is full, dropped oldest event')
+
+    def handle_failed_batch(self, events):
+        with self.lock:
+            # put the events back in front of anything queued since, keeping the queue bounded
+            self.queue.extendleft(reversed(events))
+            while len(self.queue) > self.max_queue_size:
+                self.queue.popleft()
+                self.dropped += 1
+
+    def _schedule_flush(self):
+        if self.timer is not None or not self.flush_interval:
+            return
+        self.timer = threading.Timer(self.flush_interval, self._timed_flush)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def _cancel_flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def _timed_flush(self):
+        try:
+            self.flush()
+        finally:
+            # the timer thread opened its own database connections
+            django.db.connections.close_all()
+
+
+class AuditLogCoalescer(object):
+    """
+    Merges identical audit log events (same model, user, event type, data, message and masquerading user) raised
+    within window seconds of the first one into a single row. The first event of a window is written as usual and
+    the events absorbed after it are counted in memory; when the window closes the row's occurrences and
+    last_recorded_on are updated with one UPDATE. At most max_keys windows are kept open, the oldest are closed
+    first. Windows that absorbed events are also closed by a timer once they expire, so their counts are written even
+    if no other event comes along.
+    """
+    def __init__(self, window=60, max_keys=10000):
+        self.window = datetime.timedelta(seconds=window)
+        self.max_keys = max_keys
+        # open windows in the order they were opened: key -> [first event, occurrences, last recorded_on]
+        self.windows = collections.OrderedDict()
+        self.lock = threading.RLock()
+        self.timer = None
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self.windows)
+
+    @staticmethod
+    def get_key(event):
+        return (event.__class__, event.user_id, event.event_type, event.event_data, event.message,
+                event.masquerading_user_id or None)
+
+    def coalesce(self, event):
+        """
+        Returns True if the event was merged into an open window and must not be written, or False if it opens a new
+        window and should be written.
+        """
+        key = self.get_key(event)
+        with self.lock:
+            closed = self._evict(event.recorded_on)
+            window = self.windows.get(key)
+            if window is not None and window[0] is event:
+                # the first event of the window is written again after its write failed
+                return False
+            if window is None:
+                if len(self.windows) >= self.max_keys:
+                    closed.append(self.windows.popitem(last=False)[1])
+                self.windows[key] = [event, 1, event.recorded_on]
+            else:
+                window[1] += 1
+                window[2] = max(window[2], event.recorded_on)
+                self.coalesced += 1
+                self._schedule_close()
+        self._close(closed)
+        return window is not None
+
+    def flush(self):
+        """
+        Closes all open windows, writing the occurrences counted so far.
+        """
+        with self.lock:
+            self._cancel_close()
+            closed = list(self.windows.values())
+            self.windows.clear()
+        return self._close(closed)
+
+    def release(self, events):
+        """
+        Closes the windows opened by events that are about to be written somewhere the UPDATE can't reach them, such
+        as a spool, and adds the occurrences counted so far to the events themselves.
+        """
+        event_ids = set(id(e) for e in events)
+        with self.lock:
+            for key, (event, occurrences, last_recorded_on) in list(self.windows.items()):
+                if id(event) not in event_ids:
+                    continue
+                del self.windows[key]
+                if occurrences > 1:
+                    event.occurrences = (event.occurrences or 1) + occurrences - 1
+                    event.last_recorded_on = last_recorded_on
+            if not any(window[1] > 1 for window in self.windows.values()):
+                self._cancel_close()
+
+    def close_expired(self):
+        """
+        Closes the windows that expired, writing their occurrences, and returns the number of rows updated.
+        """
+        with self.lock:
+            self._cancel_close()
+            closed = self._evict(django.utils.timezone.now())
+            if any(window[1] > 1 for window in self.windows.values()):
+                self._schedule_close()
+        return self._close(closed)
+
+    def _schedule_close(self):
+        # called with the lock held, once the oldest open window expires
+        if self.timer is not None:
+            return
+        first_event = next(iter(self.windows.values()))[0]
+        delay = (first_event.recorded_on + self.window - django.utils.timezone.now()).total_seconds()
+        self.timer = threading.Timer(max(delay, 0), self._timed_close)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def _cancel_close(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def _timed_close(self):
+        try:
+            self.close_expired()
+        finally:
+            # the timer thread opened its own database connections
+            django.db.connections.close_all()
+
+    def _evict(self, now):
+        closed = []
+        while self.windows:
+            key, window = next(iter(self.windows.items()))
+            if window[0].recorded_on + self.window > now:
+                break
+            del self.windows[key]
+            closed.append(window)
+        return closed
+
+    def _close(self, windows):
+        count = 0
+        for event, occurrences, last_recorded_on in windows:
+            if occurrences == 1:
+                continue
+            model = event.__class__
+            if event.pk is not None:
+                queryset = model.objects.filter(pk=event.pk)
+            else:
+                # events written with bulk_create may not have their primary key set
+                queryset = model.objects.filter(
+                    user_id=event.user_id, event_type=event.event_type, event_data=event.event_data,
+                    message=event.message, masquerading_user_id=event.masquerading_user_id,
+                    recorded_on=event.recorded_on)
+            try:
+                updated = queryset.update(
+                    occurrences=django.db.models.F('occurrences') + occurrences - 1,
+                    last_recorded_on=last_recorded_on)
+                if updated and event.event_type is not None:
+                    rollups.add_counts({
+                        (rollups.rollup_date(event.recorded_on), event.company_id or 0, event.event_type):
+                            occurrences - 1})
+                count += updated
+            except Exception:
+                logger.exception('Failed to write {} coalesced audit log events'.format(occurrences - 1))
+        return count
+
+
+_buffered_writer = None
+_buffered_writer_lock = threading.Lock()
+
+
+def get_buffered_writer():
+    """
+    Returns the process-wide BufferedAuditLogWriter, creating it from the ACCOUNTS_AUDIT_LOG_* settings on first use.
+    The writer is flushed when the interpreter exits.
+    """
+    global _buffered_writer
+    if _buffered_writer is None:
+        with _buffered_writer_lock:
+            if _buffered_writer is None:
+                writer = BufferedAuditLogWriter(
+                    batch_size=settings.get_audit_log_batch_size(),
+                    flush_interval=settings.get_audit_log_flush_interval(),
+                    max_queue_size=settings.get_audit_log_queue_size(), coalesce=True)
+                atexit.register(writer.flush)
+                _buffered_writer = writer
+    return _buffered_writer
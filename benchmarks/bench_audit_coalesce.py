@@ -0,0 +1,54 @@
+"""
+Measures audit log throughput during a simulated login storm with and without coalescing of repeated events.
+
+Run with:
+
+    python manage.py test benchmarks --pattern='bench_*.py'
+"""
+from __future__ import print_function, unicode_literals
+
+import logging
+import timeit
+
+import django.test
+import django.test.client
+import django.test.utils
+
+from accountsplus import signals
+from accountsplus.tests.test_models import UnitTestAuditLogEvent, UnitTestUser
+
+
+logging.disable(logging.CRITICAL)
+
+SIGN_IN_COUNT = 10000
+USER_COUNT = 50
+
+
+@django.test.utils.override_settings(
+    AUTH_USER_MODEL='accountsplus.UnitTestUser',
+    ACCOUNTS_ENABLE_AUDIT_LOG=True,
+    ACCOUNTS_AUDIT_LOG_EVENT_MODEL='accountsplus.UnitTestAuditLogEvent',
+)
+class AuditLogCoalesceBenchmark(django.test.TransactionTestCase):
+    def setUp(self):
+        self.users = [UnitTestUser.objects.create_user('user{}@example.com'.format(i), 'password',
+                                                       first_name='User', last_name=str(i))
+                      for i in range(USER_COUNT)]
+        self.request = django.test.client.RequestFactory().post('/admin/login/')
+        self.request.session = {}
+
+    def report(self, name, seconds):
+        print('\n{:<40} {:>8.3f}s {:>10.0f} sign ins/s {:>8} rows'.format(
+            name, seconds, SIGN_IN_COUNT / seconds, UnitTestAuditLogEvent.objects.count()))
+
+    def storm(self):
+        for i in range(SIGN_IN_COUNT):
+            signals.login_callback(sender=self, request=self.request, user=self.users[i % USER_COUNT])
+        signals.flush_audit_log_coalescer()
+
+    def test_login_storm(self):
+        self.report('login storm', timeit.timeit(self.storm, number=1))
+
+    def test_login_storm_coalesced(self):
+        with self.settings(ACCOUNTS_AUDIT_LOG_COALESCE_WINDOW=60):
+            self.report('login storm (coalesced, 60s window)', timeit.timeit(self.storm, number=1))
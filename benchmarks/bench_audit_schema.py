@@ -0,0 +1,72 @@
+"""
+Compares insert and query cost of BaseAuditLogEvent against the leaner BaseCompactAuditLogEvent.
+
+Run with:
+
+    python manage.py test benchmarks --pattern='bench_*.py'
+"""
+from __future__ import print_function, unicode_literals
+
+import datetime
+import logging
+import timeit
+
+import django.db
+import django.test
+import django.utils.timezone
+
+from accountsplus.tests.test_models import UnitTestAuditLogEvent, UnitTestCompactAuditLogEvent
+
+
+logging.disable(logging.CRITICAL)
+
+EVENT_COUNT = 20000
+BATCH_SIZE = 500
+QUERY_COUNT = 200
+
+
+def make_events(model, count):
+    now = django.utils.timezone.now()
+    return [model(user_id=i % 500, user_email='user{}@example.com'.format(i % 500), company_id=i % 50,
+                  company_name='Company {}'.format(i % 50), message='Sign in',
+                  recorded_on=now - datetime.timedelta(seconds=count - i))
+            for i in range(count)]
+
+
+class AuditLogSchemaBenchmark(django.test.TransactionTestCase):
+    def report(self, name, seconds, count):
+        print('\n{:<52} {:>8.3f}s {:>10.0f} ops/s'.format(name, seconds, count / seconds))
+
+    def query_plan(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with django.db.connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            return ' '.join(str(row[-1]) for row in cursor.fetchall())
+
+    def benchmark_model(self, model):
+        name = model.__name__
+        events = make_events(model, EVENT_COUNT)
+
+        def insert():
+            for i in range(0, len(events), BATCH_SIZE):
+                model.objects.bulk_create(events[i:i + BATCH_SIZE])
+        self.report('{} insert'.format(name), timeit.timeit(insert, number=1), EVENT_COUNT)
+
+        def company_events():
+            for company_id in range(QUERY_COUNT):
+                list(model.objects.filter(company_id=company_id % 50).order_by('-recorded_on')[:50])
+        self.report('{} company events by time'.format(name), timeit.timeit(company_events, number=1), QUERY_COUNT)
+        print(self.query_plan(model.objects.filter(company_id=1).order_by('-recorded_on')[:50]))
+
+        def user_events():
+            for user_id in range(QUERY_COUNT):
+                list(model.objects.filter(user_id=user_id, recorded_on__gte=events[0].recorded_on).order_by(
+                    '-recorded_on')[:50])
+        self.report('{} user events by time'.format(name), timeit.timeit(user_events, number=1), QUERY_COUNT)
+        print(self.query_plan(model.objects.filter(user_id=1).order_by('-recorded_on')[:50]))
+
+    def test_audit_log_event(self):
+        self.benchmark_model(UnitTestAuditLogEvent)
+
+    def test_compact_audit_log_event(self):
+        self.benchmark_model(UnitTestCompactAuditLogEvent)
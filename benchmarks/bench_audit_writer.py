@@ -0,0 +1,53 @@
+"""
+Compares writing audit log events one save() at a time against the BufferedAuditLogWriter.
+
+Run with:
+
+    python manage.py test benchmarks --pattern='bench_*.py'
+"""
+from __future__ import print_function, unicode_literals
+
+import logging
+import timeit
+
+import django.test
+
+from accountsplus import writers
+from accountsplus.tests.test_models import UnitTestAuditLogEvent
+
+
+logging.disable(logging.CRITICAL)
+
+EVENT_COUNT = 2000
+
+
+def make_events(count):
+    return [UnitTestAuditLogEvent(user_id=i, user_email='user{}@example.com'.format(i), message='Sign in')
+            for i in range(count)]
+
+
+class AuditLogWriterBenchmark(django.test.TransactionTestCase):
+    def report(self, name, seconds):
+        print('\n{:<30} {:>8.3f}s {:>10.0f} events/s'.format(name, seconds, EVENT_COUNT / seconds))
+
+    def test_per_event_save(self):
+        events = make_events(EVENT_COUNT)
+
+        def run():
+            for e in events:
+                e.save()
+        self.report('save() per event', timeit.timeit(run, number=1))
+        self.assertEqual(UnitTestAuditLogEvent.objects.count(), EVENT_COUNT)
+
+    def test_buffered_writer(self):
+        for batch_size in (10, 100, 500):
+            UnitTestAuditLogEvent.objects.all().delete()
+            events = make_events(EVENT_COUNT)
+            writer = writers.BufferedAuditLogWriter(batch_size=batch_size, flush_interval=0)
+
+            def run():
+                for e in events:
+                    writer.write(e)
+                writer.flush()
+            self.report('buffered, batch_size={}'.format(batch_size), timeit.timeit(run, number=1))
+            self.assertEqual(UnitTestAuditLogEvent.objects.count(), EVENT_COUNT)
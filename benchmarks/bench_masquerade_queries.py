@@ -0,0 +1,103 @@
+"""
+Pins the number of queries that starting and ending a masquerade costs with the audit log enabled, and reports how
+long each takes.
+
+Run with:
+
+    python manage.py test benchmarks --pattern='bench_masquerade_queries.py'
+"""
+from __future__ import print_function, unicode_literals
+
+import logging
+import timeit
+
+import django.contrib.auth.models
+import django.core.cache
+import django.test
+import django.test.utils
+
+from accountsplus import events
+# registers the test models with the admin site that the masquerade views redirect to
+from accountsplus.tests import test_admin  # noqa: F401
+from accountsplus.tests.test_models import UnitTestAuditLogEvent, UnitTestCompany, UnitTestUser
+
+
+logging.disable(logging.CRITICAL)
+
+ROUNDS = 200
+
+# the request's user, the masquerade permission, the user to switch to, the masquerade_start event, login()'s
+# last_login update and the sign in event
+START_QUERY_BUDGET = 6
+# superusers skip the permission query
+SUPERUSER_START_QUERY_BUDGET = 5
+# the request's user, the admin user, axes' logout record and the sign out event of the masqueraded user, the
+# masquerade_end event, login()'s last_login update and the sign in event
+END_QUERY_BUDGET = 7
+
+
+@django.test.utils.override_settings(
+    AUTH_USER_MODEL='accountsplus.UnitTestUser',
+    ACCOUNTS_ENABLE_AUDIT_LOG=True,
+    ACCOUNTS_AUDIT_LOG_EVENT_MODEL='accountsplus.UnitTestAuditLogEvent',
+)
+class MasqueradeQueryBenchmark(django.test.TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        company = UnitTestCompany.objects.create(name='Example')
+        UnitTestUser.objects.create_superuser(
+            email='superuser@example.com', password='password', first_name='Super', last_name='User', company=company)
+        staffuser = UnitTestUser.objects.create_user(
+            email='staffuser@example.com', password='password', first_name='Staff', last_name='User', is_staff=True,
+            company=company)
+        UnitTestUser.objects.create_user(
+            email='regularuser@example.com', password='password', first_name='Regular', last_name='User',
+            company=company)
+        group = django.contrib.auth.models.Group.objects.create(name='Masquerade')
+        group.permissions.add(django.contrib.auth.models.Permission.objects.get(codename='masquerade'))
+        staffuser.groups.add(group)
+
+    def setUp(self):
+        django.core.cache.cache.clear()
+
+    def report(self, name, seconds):
+        print('\n{:<52} {:>8.3f}ms'.format(name, seconds * 1000 / ROUNDS))
+
+    def start(self):
+        response = self.client.get('/admin/masquerade/3/')
+        self.assertEqual(self.client.session['masquerade_user_id'], self.admin_id)
+        return response
+
+    def end(self):
+        response = self.client.get('/admin/masquerade/end/')
+        self.assertNotIn('is_masquerading', self.client.session)
+        return response
+
+    def benchmark(self, email, start_budget):
+        self.admin_id = UnitTestUser.objects.get(email=email).pk
+        # the first sign in also caches the company name that every audit log event records
+        self.assertTrue(self.client.login(email=email, password='password'))
+        with self.assertNumQueries(start_budget):
+            self.start()
+        with self.assertNumQueries(END_QUERY_BUDGET):
+            self.end()
+        self.assertEqual(self.client.session['_auth_user_id'], str(self.admin_id))
+        self.assertEqual(UnitTestAuditLogEvent.objects.filter(
+            user_id=self.admin_id, event_type__in=(events.MASQUERADE_START, events.MASQUERADE_END)).count(), 2)
+
+        def cycle():
+            self.start()
+            self.end()
+        self.report('{} masquerade start and end'.format(email), timeit.timeit(cycle, number=ROUNDS))
+
+    def test_staff_masquerade(self):
+        self.benchmark('staffuser@example.com', START_QUERY_BUDGET)
+
+    def test_superuser_masquerade(self):
+        self.benchmark('superuser@example.com', SUPERUSER_START_QUERY_BUDGET)
+
+    @django.test.utils.override_settings(ACCOUNTS_SESSION_TIMEZONE=True)
+    def test_staff_masquerade_session_timezone(self):
+        # keeping the timezone of the users signed in and back in doesn't load them again
+        self.benchmark('staffuser@example.com', START_QUERY_BUDGET)
+        self.assertEqual(self.client.session['user_timezone'], 'America/New_York')
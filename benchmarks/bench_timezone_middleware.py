@@ -0,0 +1,97 @@
+"""
+Compares the per-request cost of TimezoneMiddleware activating the signed in user's timezone eagerly, with
+ACCOUNTS_LAZY_TIMEZONE and with ACCOUNTS_SESSION_TIMEZONE, for a request that never converts a datetime and one that
+does.
+
+Run with:
+
+    python manage.py test benchmarks --pattern='bench_timezone_middleware.py'
+"""
+from __future__ import print_function, unicode_literals
+
+import datetime
+import logging
+import timeit
+
+import django.contrib.auth.middleware
+import django.contrib.sessions.middleware
+import django.core.cache
+import django.test
+import django.test.client
+import django.test.utils
+import django.utils.timezone
+from django.conf import settings
+
+import pytz
+
+from accountsplus import middleware
+from accountsplus.tests.test_models import UnitTestUser
+
+
+logging.disable(logging.CRITICAL)
+
+ROUNDS = 2000
+
+# the user SELECT; the session is read from the cache
+EAGER_QUERY_BUDGET = 1
+LAZY_QUERY_BUDGET = 0
+# the timezone name is kept in the session, so converting a datetime doesn't load the user either
+SESSION_QUERY_BUDGET = 0
+
+
+@django.test.utils.override_settings(AUTH_USER_MODEL='accountsplus.UnitTestUser')
+class TimezoneMiddlewareBenchmark(django.test.TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        UnitTestUser.objects.create_user(
+            email='user@example.com', password='password', first_name='Test', last_name='User',
+            timezone=pytz.timezone('Asia/Singapore'))
+
+    def setUp(self):
+        django.core.cache.cache.clear()
+        self.addCleanup(django.utils.timezone.deactivate)
+        client = django.test.client.Client()
+        # the session keeps the timezone name whatever the mode; only ACCOUNTS_SESSION_TIMEZONE reads it
+        with self.settings(ACCOUNTS_SESSION_TIMEZONE=True):
+            client.force_login(UnitTestUser.objects.get(email='user@example.com'))
+        self.session_key = client.session.session_key
+        self.factory = django.test.client.RequestFactory()
+        self.session_middleware = django.contrib.sessions.middleware.SessionMiddleware()
+        self.auth_middleware = django.contrib.auth.middleware.AuthenticationMiddleware()
+        self.masquerade_middleware = middleware.MasqueradeMiddleware()
+        self.timezone_middleware = middleware.TimezoneMiddleware()
+        self.value = datetime.datetime(2016, 1, 1, 12, 0, tzinfo=pytz.utc)
+
+    def report(self, name, seconds):
+        print('\n{:<52} {:>8.3f}ms'.format(name, seconds * 1000 / ROUNDS))
+
+    def request(self, convert=False):
+        request = self.factory.get('/health/')
+        request.COOKIES[settings.SESSION_COOKIE_NAME] = self.session_key
+        self.session_middleware.process_request(request)
+        self.auth_middleware.process_request(request)
+        self.masquerade_middleware.process_request(request)
+        self.timezone_middleware.process_request(request)
+        if convert:
+            self.assertEqual(django.utils.timezone.localtime(self.value).hour, 20)
+        return request
+
+    def benchmark(self, name, query_budget, convert_query_budget=EAGER_QUERY_BUDGET):
+        with self.assertNumQueries(query_budget):
+            self.request()
+        with self.assertNumQueries(convert_query_budget):
+            self.request(convert=True)
+        self.report('{} middleware, no datetime'.format(name), timeit.timeit(self.request, number=ROUNDS))
+        self.report('{} middleware, one datetime'.format(name),
+                    timeit.timeit(lambda: self.request(convert=True), number=ROUNDS))
+
+    def test_eager(self):
+        self.benchmark('eager', EAGER_QUERY_BUDGET)
+
+    @django.test.utils.override_settings(ACCOUNTS_LAZY_TIMEZONE=True)
+    def test_lazy(self):
+        self.benchmark('lazy', LAZY_QUERY_BUDGET)
+
+    @django.test.utils.override_settings(ACCOUNTS_SESSION_TIMEZONE=True)
+    def test_session(self):
+        self.benchmark('session', SESSION_QUERY_BUDGET, SESSION_QUERY_BUDGET)
@@ -29,7 +29,12 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': 'db.sqlite',
-    }
+    },
+    # used by the tests of accountsplus.routers.AuditLogRouter
+    'audit': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': 'audit.sqlite',
+    },
 }
 
 ROOT_URLCONF = 'urls'
@@ -46,6 +51,7 @@ MIDDLEWARE = (
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.auth.middleware.SessionAuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
+    'accountsplus.middleware.MasqueradeMiddleware',
     'accountsplus.middleware.TimezoneMiddleware',
 )
 